@@ -256,3 +256,57 @@ MELON_APP_KEY = env('MELON_APP_KEY')
 # Set this env if http requests should be proxied
 # Note that melon api requests will never be proxied
 REQUESTS_HTTP_PROXY = env('REQUESTS_HTTP_PROXY', default=None)
+
+# Per-process cache of unpacked charts in front of the shared chart cache
+# (number of charts, and seconds between shared cache generation checks)
+CHART_LOCAL_CACHE_SIZE = env.int('CHART_LOCAL_CACHE_SIZE', default=48)
+CHART_LOCAL_CACHE_TTL = env.float('CHART_LOCAL_CACHE_TTL', default=5.0)
+
+# Cached chart rebuild lock expiry, and maximum number of seconds to wait for
+# a rebuild by another process before serving a stale chart
+CHART_CACHE_LOCK_TIMEOUT = env.int('CHART_CACHE_LOCK_TIMEOUT', default=30)
+CHART_CACHE_LOCK_WAIT = env.float('CHART_CACHE_LOCK_WAIT', default=2.0)
+
+# HTTP caching for chart pages and API responses. Charts older than
+# CHART_HTTP_IMMUTABLE_AGE hours are cached as immutable for
+# CHART_HTTP_IMMUTABLE_MAX_AGE seconds, newer charts for CHART_HTTP_MAX_AGE
+CHART_HTTP_MAX_AGE = env.int('CHART_HTTP_MAX_AGE', default=60)
+CHART_HTTP_IMMUTABLE_AGE = env.int('CHART_HTTP_IMMUTABLE_AGE', default=48)
+CHART_HTTP_IMMUTABLE_MAX_AGE = env.int('CHART_HTTP_IMMUTABLE_MAX_AGE', default=365 * 24 * 60 * 60)
+
+# Pooled HTTP sessions used by the chart services: connections kept and
+# concurrent requests allowed per host and process, and retries (with
+# exponential backoff factor) for failed requests
+HTTP_CLIENT_POOL_SIZE = env.int('HTTP_CLIENT_POOL_SIZE', default=8)
+HTTP_CLIENT_RETRIES = env.int('HTTP_CLIENT_RETRIES', default=2)
+HTTP_CLIENT_BACKOFF = env.float('HTTP_CLIENT_BACKOFF', default=0.5)
+HTTP_CLIENT_HOST_CONCURRENCY = env.int('HTTP_CLIENT_HOST_CONCURRENCY', default=4)
+
+# Number of threads used to download chart pages concurrently
+CHART_FETCH_THREADS = env.int('CHART_FETCH_THREADS', default=4)
+
+# Maximum number of requests in flight for the async chart ingestion engine
+CHART_ASYNC_CONCURRENCY = env.int('CHART_ASYNC_CONCURRENCY', default=16)
+
+# Archive the raw responses for every fetched hourly chart (gzip compression level)
+CHART_SNAPSHOT_ARCHIVE = env.bool('CHART_SNAPSHOT_ARCHIVE', default=True)
+CHART_SNAPSHOT_COMPRESSION = env.int('CHART_SNAPSHOT_COMPRESSION', default=6)
+
+# Seconds to cache Melon search API results, and searches without results
+MELON_SEARCH_TTL = env.int('MELON_SEARCH_TTL', default=7 * 24 * 60 * 60)
+MELON_SEARCH_NEGATIVE_TTL = env.int('MELON_SEARCH_NEGATIVE_TTL', default=6 * 60 * 60)
+
+# Seconds to wait after an hourly chart update before aggregating the hour,
+# updates from other services which arrive in the meantime are coalesced
+CHART_AGGREGATE_DELAY = env.int('CHART_AGGREGATE_DELAY', default=60)
+
+# Check incremental aggregate chart updates against a full regeneration
+CHART_AGGREGATE_VERIFY = env.bool('CHART_AGGREGATE_VERIFY', default=False)
+
+# Hourly chart backlog: missing hours planned per service on each run, number
+# of updates started together and seconds between them, and seconds before an
+# hour whose update failed is planned again
+CHART_BACKLOG_HOURS = env.int('CHART_BACKLOG_HOURS', default=20)
+CHART_BACKLOG_CONCURRENCY = env.int('CHART_BACKLOG_CONCURRENCY', default=6)
+CHART_BACKLOG_INTERVAL = env.int('CHART_BACKLOG_INTERVAL', default=20)
+CHART_BACKLOG_RETRY_DELAY = env.int('CHART_BACKLOG_RETRY_DELAY', default=60 * 60)
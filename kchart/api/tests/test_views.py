@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+from datetime import date, datetime
+import json
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from test_plus.test import TestCase
+
+from kchart.api.views import aggregate_chart_validators
+from kchart.charts.chartcache import local_cache
+from kchart.charts.models import (
+    AggregateHourlySongChart,
+    Album,
+    Artist,
+    Chart,
+    HourlySongChart,
+    HourlySongChartEntry,
+    MusicService,
+    Song,
+)
+from kchart.charts.utils import KR_TZ
+
+
+class TestSongViewSet(TestCase):
+
+    def setUp(self):
+        MusicService.objects.create(name='Melon', slug='melon')
+        artist = Artist.objects.create(name='artist')
+        album = Album.objects.create(name='album', release_date=date(2016, 6, 1))
+        self.songs = []
+        for i in range(5):
+            song = Song.objects.create(name='song {}'.format(i), album=album, release_date=date(2016, 6, 1))
+            song.artists.add(artist)
+            self.songs.append(song)
+
+    def test_list_query_count(self):
+        url = '/api/v1/songs/?ids={}&extra=melon'
+        with CaptureQueriesContext(connection) as single:
+            response = self.client.get(url.format(self.songs[0].pk))
+        self.assertEqual(response.status_code, 200)
+        with CaptureQueriesContext(connection) as bulk:
+            response = self.client.get(url.format(','.join(str(song.pk) for song in self.songs)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(single), len(bulk))
+        self.assertEqual([song['id'] for song in response.data], [song.pk for song in self.songs])
+        self.assertEqual(response.data[0]['chart_details']['realtime']['melon'], {'has_charted': False})
+
+    def test_list_requires_ids(self):
+        response = self.client.get('/api/v1/songs/')
+        self.assertEqual(response.status_code, 400)
+
+
+class TestHourlySongChartViewSet(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        self.hour = KR_TZ.localize(datetime(2016, 6, 26, 13))
+        service = MusicService.objects.create(name='Melon', slug='melon')
+        self.chart = Chart.objects.create(service=service, name='Melon realtime', url='http://melon/')
+        album = Album.objects.create(name='album', release_date=date(2016, 6, 1))
+        artist = Artist.objects.create(name='artist')
+        hourly_chart = HourlySongChart.objects.create(chart=self.chart, hour=self.hour)
+        for i in range(3):
+            song = Song.objects.create(name='song {}'.format(i), album=album, release_date=date(2016, 6, 1))
+            song.artists.add(artist)
+            HourlySongChartEntry.objects.create(hourly_chart=hourly_chart, song=song, position=i + 1)
+
+    def test_retrieve_cached(self):
+        response = self.client.get('/api/v1/charts/realtime/melon/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['chart'], {'name': 'Melon realtime', 'url': 'http://melon/'})
+        self.assertEqual([entry['position'] for entry in response.data['entries']], [1, 2, 3])
+        self.assertEqual(response.data['entries'][0]['song']['artists'][0]['name'], 'artist')
+        with CaptureQueriesContext(connection) as cached:
+            response = self.client.get('/api/v1/charts/realtime/melon/?hour=2016062613')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([q for q in cached if 'SAVEPOINT' not in q['sql']]), 0)
+
+    def test_retrieve_missing(self):
+        self.assertEqual(self.client.get('/api/v1/charts/realtime/nosuchservice/').status_code, 404)
+        self.assertEqual(self.client.get('/api/v1/charts/realtime/melon/?hour=2016062612').status_code, 404)
+
+
+class TestAggregateHourlySongChartViewSet(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        self.hour = KR_TZ.localize(datetime(2016, 6, 26, 13))
+        service = MusicService.objects.create(name='Melon', slug='melon')
+        chart = Chart.objects.create(service=service, name='Melon realtime', url='http://melon/')
+        album = Album.objects.create(name='album', release_date=date(2016, 6, 1))
+        hourly_chart = HourlySongChart.objects.create(chart=chart, hour=self.hour)
+        for i in range(3):
+            song = Song.objects.create(name='song {}'.format(i), album=album, release_date=date(2016, 6, 1))
+            HourlySongChartEntry.objects.create(hourly_chart=hourly_chart, song=song, position=i + 1)
+        AggregateHourlySongChart.generate(hour=self.hour)
+
+    def test_retrieve_rendered(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v1/charts/realtime/?hour=2016062613')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([q for q in queries if 'SAVEPOINT' not in q['sql']]), 0)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([entry['position'] for entry in data['entries']], [1, 2, 3])
+        self.assertEqual(data['component_charts'][0]['name'], 'Melon realtime')
+        etag = response['ETag']
+        response = self.client.get('/api/v1/charts/realtime/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        AggregateHourlySongChart.invalidate_cached_chart(self.hour)
+        local_cache.clear()
+        response = self.client.get('/api/v1/charts/realtime/?hour=2016062613')
+        self.assertEqual(response['ETag'], etag)
+
+    def test_conditional_get(self):
+        # validators are only sent for charts cached for longer than the local cache ttl
+        ttl = local_cache.ttl
+        local_cache.ttl = 0
+        try:
+            response = self.client.get('/api/v1/charts/realtime/?hour=2016062613')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('immutable', response['Cache-Control'])
+            etag = response['ETag']
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/api/v1/charts/realtime/?hour=2016062613', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(len([q for q in queries if 'SAVEPOINT' not in q['sql']]), 0)
+            response = self.client.get(
+                '/api/v1/charts/realtime/',
+                HTTP_IF_MODIFIED_SINCE=response['Last-Modified']
+            )
+            self.assertEqual(response.status_code, 304)
+            self.assertNotIn('immutable', response['Cache-Control'])
+            # the etag only depends on the rendered body
+            AggregateHourlySongChart.generate(hour=self.hour, regenerate=True)
+            response = self.client.get('/api/v1/charts/realtime/?hour=2016062613', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            HourlySongChartEntry.objects.filter(position=3).delete()
+            AggregateHourlySongChart.generate(hour=self.hour, regenerate=True)
+            response = self.client.get('/api/v1/charts/realtime/?hour=2016062613', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+        finally:
+            local_cache.ttl = ttl
+
+    def test_validators_without_cached_chart(self):
+        AggregateHourlySongChart.invalidate_cached_chart(self.hour)
+        local_cache.clear()
+        request = RequestFactory().get('/api/v1/charts/realtime/?hour=2016062613')
+        request.accepted_renderer = JSONRenderer()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertIsNone(aggregate_chart_validators(request))
+        self.assertEqual(len(queries), 0)
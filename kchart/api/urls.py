@@ -13,9 +13,13 @@ from .views import (
 aggregate_hourly_song_chart_detail = AggregateHourlySongChartViewSet.as_view({'get': 'retrieve'})
 hourly_song_chart_detail = HourlySongChartViewSet.as_view({'get': 'retrieve'})
 song_detail = SongViewSet.as_view({'get': 'retrieve'})
+song_list = SongViewSet.as_view({'get': 'list'})
+song_history = SongViewSet.as_view({'get': 'history'})
 
 urlpatterns = [
     url(r'^charts/realtime/$', aggregate_hourly_song_chart_detail, name='realtime'),
     url(r'^charts/realtime/(?P<slug>.+)/$', hourly_song_chart_detail, name='realtime-service'),
+    url(r'^songs/$', song_list, name='song-list'),
     url(r'^songs/(?P<pk>\d+)/$', song_detail, name='song-detail'),
+    url(r'^songs/(?P<pk>\d+)/history/$', song_history, name='song-history'),
 ]
@@ -1,84 +1,231 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
-from datetime import datetime
-
-from rest_framework.exceptions import NotFound
-from rest_framework.mixins import RetrieveModelMixin
+from datetime import datetime, timedelta
+
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.decorators import method_decorator
+from django.utils.http import parse_etags, quote_etag
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.mixins import ListModelMixin, RetrieveModelMixin
+from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 
 from ..charts.models import (
     AggregateHourlySongChart,
+    Chart,
     HourlySongChart,
     MusicService,
     Song
 )
 from ..charts.serializers import (
-    AggregateHourlySongChartSerializer,
-    HourlySongChartSerializer,
+    CachedAggregateHourlySongChartSerializer,
+    CachedHourlySongChartSerializer,
     SongDetailSerializer,
 )
-from ..charts.utils import KR_TZ
+from ..charts.httpcache import conditional, get_validators
+from ..charts.utils import KR_TZ, strip_to_hour, utcnow
+
+
+def parse_hour_param(hour_str):
+    try:
+        return KR_TZ.localize(datetime.strptime(hour_str, '%Y%m%d%H'))
+    except ValueError:
+        raise NotFound('Invalid hour parameter')
+
+
+def rendered_response(request, rendered):
+    '''Return a pre-rendered JSON body, or 304 if the client already has it
+
+    :param kchart.charts.chartcache.RenderedChart rendered: The rendered body
+    :rtype: django.http.HttpResponse
+    '''
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if rendered.etag in etags or '*' in etags:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(rendered.body, content_type='application/json')
+    response['ETag'] = quote_etag(rendered.etag)
+    return response
+
+
+def hourly_chart_validators(request, slug=None, **kwargs):
+    chart_id = Chart.get_id_for_slug(slug)
+    if not chart_id:
+        return None
+    hour_str = request.GET.get('hour', None)
+    if hour_str:
+        hour = parse_hour_param(hour_str)
+    else:
+        hour = HourlySongChart.get_latest_hour(chart_id)
+        if not hour:
+            return None
+    return get_validators(
+        HourlySongChart.get_cache_key(chart_id, hour),
+        hour,
+        request.accepted_renderer.format,
+        latest=not hour_str
+    )
+
+
+def aggregate_chart_validators(request, **kwargs):
+    hour_str = request.GET.get('hour', None)
+    if hour_str:
+        hour = parse_hour_param(hour_str)
+    else:
+        hour = AggregateHourlySongChart.get_latest_hour()
+        if not hour:
+            return None
+    # JSON is served from the pre-rendered body, and validated with the same etag as rendered_response
+    return get_validators(
+        AggregateHourlySongChart.get_cache_key(hour),
+        hour,
+        request.accepted_renderer.format,
+        latest=not hour_str,
+        rendered=request.accepted_renderer.format == 'json'
+    )
 
 
 class HourlySongChartViewSet(RetrieveModelMixin, GenericViewSet):
     '''Viewset for viewing hourly song charts'''
 
-    serializer_class = HourlySongChartSerializer
+    serializer_class = CachedHourlySongChartSerializer
+
+    @method_decorator(conditional(hourly_chart_validators))
+    def retrieve(self, request, *args, **kwargs):
+        return super(HourlySongChartViewSet, self).retrieve(request, *args, **kwargs)
 
     def get_object(self):
-        q = HourlySongChart.objects
-        service = None
-        if 'slug' in self.kwargs:
-            try:
-                service = MusicService.objects.get(slug=self.kwargs['slug'])
-                q = q.filter(chart__service=service)
-            except MusicService.DoesNotExist:
-                raise NotFound('No such music service')
-        else:
+        chart_id = Chart.get_id_for_slug(self.kwargs.get('slug'))
+        if not chart_id:
             raise NotFound('No such music service')
         hour_str = self.request.query_params.get('hour', None)
         if hour_str:
-            try:
-                hour = KR_TZ.localize(datetime.strptime(hour_str, '%Y%m%d%H'))
-            except ValueError:
-                raise NotFound('Invalid hour parameter')
+            hour = parse_hour_param(hour_str)
         else:
-            hour = HourlySongChart.objects.filter(chart__service=service).first().hour
-        q = q.filter(hour=hour)
-        return q.first()
+            hour = HourlySongChart.get_latest_hour(chart_id)
+        chart = None
+        if hour:
+            chart = HourlySongChart.get_cached_chart(chart_id, hour)
+        if not chart:
+            raise NotFound('No chart data available for this hour')
+        return chart
 
 
 class AggregateHourlySongChartViewSet(RetrieveModelMixin, GenericViewSet):
     '''Viewset for viewing hourly song charts'''
 
-    serializer_class = AggregateHourlySongChartSerializer
+    serializer_class = CachedAggregateHourlySongChartSerializer
     lookup_field = 'hour'
 
-    def get_object(self):
-        q = AggregateHourlySongChart.objects
+    def get_hour(self):
         hour_str = self.request.query_params.get('hour', None)
         if hour_str:
-            try:
-                hour = KR_TZ.localize(datetime.strptime(hour_str, '%Y%m%d%H'))
-            except ValueError:
-                raise NotFound('Invalid hour parameter')
-            q = q.filter(hour=hour)
-        return q.first()
+            return parse_hour_param(hour_str)
+        return AggregateHourlySongChart.get_latest_hour()
+
+    @method_decorator(conditional(aggregate_chart_validators))
+    def retrieve(self, request, *args, **kwargs):
+        # JSON responses are served from the pre-rendered body when possible
+        if request.accepted_renderer.format == 'json':
+            hour = self.get_hour()
+            if hour:
+                rendered = AggregateHourlySongChart.get_rendered_chart(hour)
+                if rendered:
+                    return rendered_response(request, rendered)
+        return super(AggregateHourlySongChartViewSet, self).retrieve(request, *args, **kwargs)
+
+    def get_object(self):
+        hour = self.get_hour()
+        chart = None
+        if hour:
+            chart = AggregateHourlySongChart.get_cached_chart(hour)
+        if not chart:
+            raise NotFound('No chart data available for this hour')
+        return chart
 
 
-class SongViewSet(RetrieveModelMixin, GenericViewSet):
-    ''' Viewset for songs'''
+class SongViewSet(ListModelMixin, RetrieveModelMixin, GenericViewSet):
+    ''' Viewset for songs
+
+    Listing songs requires an ids query parameter (i.e. ?ids=1,2,3) and returns
+    details for each of the requested songs using a constant number of queries.
+    '''
 
     serializer_class = SongDetailSerializer
+    max_list_ids = 100
+
+    def get_queryset(self):
+        ids_str = self.request.query_params.get('ids', '')
+        try:
+            ids = set(int(pk) for pk in ids_str.split(',') if pk)
+        except ValueError:
+            raise ParseError('Invalid ids parameter')
+        if not ids:
+            raise ParseError('ids parameter is required')
+        if len(ids) > self.max_list_ids:
+            raise ParseError('At most {} ids may be requested at once'.format(self.max_list_ids))
+        return Song.objects.filter(pk__in=ids).select_related('album').prefetch_related(
+            'artists',
+            'chart_summaries',
+        ).order_by('pk')
+
+    # (default, maximum) history range for each resolution
+    history_ranges = {
+        'hour': (timedelta(days=7), timedelta(days=93)),
+        'day_best': (timedelta(days=365), timedelta(days=3660)),
+        'day_avg': (timedelta(days=365), timedelta(days=3660)),
+    }
 
     def get_object(self):
-        q = Song.objects.get(pk=int(self.kwargs['pk']))
-        return q
+        try:
+            return Song.objects.get(pk=int(self.kwargs['pk']))
+        except Song.DoesNotExist:
+            raise NotFound('No such song')
+
+    def history(self, request, *args, **kwargs):
+        '''Return the song's chart position history
+
+        Query parameters: start and end (YYYYMMDDHH KST), resolution (hour,
+        day_best or day_avg) and extra (comma separated service slugs).
+        '''
+        resolution = request.query_params.get('resolution', 'hour')
+        if resolution not in self.history_ranges:
+            raise ParseError('Invalid resolution parameter')
+        (default_range, max_range) = self.history_ranges[resolution]
+        end_str = request.query_params.get('end', None)
+        end = parse_hour_param(end_str) if end_str else strip_to_hour(utcnow())
+        start_str = request.query_params.get('start', None)
+        start = parse_hour_param(start_str) if start_str else end - default_range
+        if start > end:
+            raise ParseError('start must not be after end')
+        if end - start > max_range:
+            raise ParseError('{} resolution history is limited to {} days'.format(resolution, max_range.days))
+        song = self.get_object()
+        services = self.get_serializer_context().get('include_services', [])
+        history = song.get_position_history(start, end, resolution=resolution, services=services)
+        if resolution == 'hour':
+            key_name = 'hour'
+        else:
+            key_name = 'date'
+        series = {}
+        for (slug, points) in history.items():
+            series[slug] = [{key_name: key, 'position': position} for (key, position) in points]
+        return Response({
+            'song': song.pk,
+            'resolution': resolution,
+            'start': start,
+            'end': end,
+            'series': series,
+        })
 
     def get_serializer_context(self):
         extra = self.request.query_params.get('extra', None)
         if extra:
-            return {'include_service_slugs': extra.split(',')}
+            slugs = extra.split(',')
+            return {
+                'include_service_slugs': slugs,
+                'include_services': list(MusicService.objects.filter(slug__in=slugs)),
+            }
         else:
             return {}
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+'''Asynchronous chart ingestion
+
+AsyncChartFetcher downloads many (service, hour) charts concurrently on an
+asyncio event loop, so that a single worker can ingest every service for an
+hour, or many backlog hours, at once. Parsing (which may match songs against
+the database) and database writes stay synchronous, and run one chart at a
+time on a single writer thread as soon as all of a chart's pages have been
+downloaded, so that downloads continue while charts are written.
+
+Requests are sent through a Transport, so the engine can be pointed at a
+local (fake) server or given an in-memory transport in tests.
+AiohttpTransport uses the aiohttp package (see requirements/base.txt),
+ThreadedTransport sends requests with the pooled blocking client in a thread
+pool and is only used by default if aiohttp is not installed.
+'''
+from __future__ import unicode_literals, absolute_import
+
+import asyncio
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.utils.six.moves.urllib.parse import urlsplit
+from requests.exceptions import HTTPError
+
+from . import httpclient
+from .chartservice import REQUESTS_TIMEOUT, ua
+from .utils import strip_to_hour, utcnow
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+logger = logging.getLogger('django')
+
+FetchResult = namedtuple('FetchResult', ['slug', 'hour', 'result', 'error'])
+
+
+class Transport(object):
+    '''Sends ChartRequests for AsyncChartFetcher'''
+
+    def _prepare(self, request):
+        '''Apply the proxy and user agent settings to a ChartRequest
+
+        :returns: (url, params, headers, proxy_url, timeout)
+        :rtype: tuple
+        '''
+        headers = dict(request.headers)
+        timeout = REQUESTS_TIMEOUT
+        proxy = None
+        if request.proxy:
+            headers['User-Agent'] = ua.random
+            proxies = httpclient.get_proxies()
+            if proxies:
+                proxy = proxies['http']
+                timeout = 10 * timeout
+        return (request.url, request.params, headers, proxy, timeout)
+
+    async def get(self, request):
+        '''Send a request
+
+        :param kchart.charts.chartservice.ChartRequest request: The request
+        :returns: The response body
+        :rtype: str
+        :raises requests.exceptions.HTTPError: for error responses
+        '''
+        raise NotImplementedError
+
+    async def close(self):
+        '''Release any resources held by the transport, it may still be reused afterwards'''
+        pass
+
+
+class ThreadedTransport(Transport):
+    '''Sends requests through kchart.charts.httpclient in a thread pool'''
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or settings.CHART_ASYNC_CONCURRENCY
+        self.executor = None
+
+    async def get(self, request):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        (url, params, headers, proxy, timeout) = self._prepare(request)
+        if proxy:
+            proxies = {'http': proxy, 'https': proxy}
+        else:
+            proxies = {}
+        r = await asyncio.get_event_loop().run_in_executor(
+            self.executor,
+            partial(httpclient.get, url, params=params, headers=headers, proxies=proxies, timeout=timeout)
+        )
+        r.raise_for_status()
+        return r.text
+
+    async def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+class AiohttpTransport(Transport):
+    '''Sends requests with aiohttp'''
+
+    def __init__(self):
+        if aiohttp is None:
+            raise ImproperlyConfigured('AiohttpTransport requires the aiohttp package')
+        self.session = None
+
+    async def _get(self, url, kwargs):
+        async with self.session.get(url, **kwargs) as response:
+            if response.status >= 400:
+                raise HTTPError('{} returned HTTP status {}'.format(url, response.status))
+            return await response.text()
+
+    async def get(self, request):
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        (url, params, headers, proxy, timeout) = self._prepare(request)
+        kwargs = {'params': params, 'headers': headers}
+        if proxy:
+            kwargs['proxy'] = proxy
+        return await asyncio.wait_for(self._get(url, kwargs), timeout)
+
+    async def close(self):
+        if self.session is not None:
+            # ClientSession.close() is a coroutine in newer aiohttp releases
+            result = self.session.close()
+            if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+                await result
+            self.session = None
+
+
+def default_transport():
+    '''Return an AiohttpTransport, or a ThreadedTransport if aiohttp is not installed'''
+    if aiohttp is not None:
+        return AiohttpTransport()
+    return ThreadedTransport()
+
+
+class AsyncChartFetcher(object):
+    '''Fetches many hourly charts concurrently'''
+
+    def __init__(self, transport=None, concurrency=None, host_concurrency=None):
+        '''
+        :param Transport transport: The transport to use, see default_transport
+        :param int concurrency: The maximum number of requests in flight
+        :param int host_concurrency: The maximum number of requests in flight to a single host
+        '''
+        self.transport = transport
+        self.concurrency = concurrency or settings.CHART_ASYNC_CONCURRENCY
+        self.host_concurrency = host_concurrency or settings.HTTP_CLIENT_HOST_CONCURRENCY
+
+    def _run(self, coro_func):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        transport = self.transport or default_transport()
+        try:
+            return loop.run_until_complete(coro_func(transport))
+        finally:
+            # sessions and pools are bound to this loop
+            loop.run_until_complete(transport.close())
+            loop.close()
+            asyncio.set_event_loop(None)
+
+    def _downloader(self, transport):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        host_semaphores = defaultdict(lambda: asyncio.Semaphore(self.host_concurrency))
+
+        async def download(request):
+            async with semaphore:
+                async with host_semaphores[urlsplit(request.url).netloc.lower()]:
+                    return await transport.get(request)
+
+        return download
+
+    def download(self, request_groups):
+        '''Download groups of requests concurrently
+
+        :param list request_groups: A list of lists of ChartRequests
+        :returns: A list of lists of response bodies, in the same order as the requests
+        :rtype: list
+        '''
+        async def run(transport):
+            download = self._downloader(transport)
+            return await asyncio.gather(*[
+                asyncio.gather(*[download(request) for request in requests])
+                for requests in request_groups
+            ])
+
+        return [list(texts) for texts in self._run(run)]
+
+    def fetch(self, jobs, dry_run=False, force_update=False):
+        '''Fetch the specified hourly charts and write them to the database
+
+        Melon only provides its live chart, so the hour in melon jobs only
+        determines whether an existing chart is skipped.
+
+        :param jobs: An iterable of (service, hour) pairs, where service is a BaseChartService instance
+            and hour is None for the current live chart
+        :param bool dry_run: True if the parsed chart data should be returned rather than written
+        :param bool force_update: True if existing complete charts should be re-fetched
+        :returns: A list of FetchResult, in the same order as jobs
+        :rtype: list
+        '''
+        jobs = [(service, strip_to_hour(hour or utcnow())) for (service, hour) in jobs]
+        results = [None] * len(jobs)
+        writer = ThreadPoolExecutor(max_workers=1)
+
+        def write_chart(service, hour, texts):
+            # synchronous archive, parse and write stage
+            if not dry_run:
+                service._archive_hourly_chart(hour, texts)
+            (hour, entries) = service._parse_hourly_chart_responses(hour, texts, dry_run=dry_run)
+            if dry_run:
+                return (hour, entries)
+            return (hour, service._write_hourly_chart(hour, entries, force_update=force_update))
+
+        async def fetch_chart(download, i, service, hour):
+            try:
+                texts = await asyncio.gather(*[download(request) for request in service._hourly_chart_requests(hour)])
+                return (i, texts, None)
+            except Exception as exc:
+                return (i, None, exc)
+
+        async def run(transport):
+            loop = asyncio.get_event_loop()
+            download = self._downloader(transport)
+            pending = []
+            for (i, (service, hour)) in enumerate(jobs):
+                if not force_update:
+                    chart = service._get_complete_chart(hour)
+                    if chart:
+                        results[i] = FetchResult(service.SLUG, hour, chart, None)
+                        continue
+                pending.append(asyncio.ensure_future(fetch_chart(download, i, service, hour)))
+            for future in asyncio.as_completed(pending):
+                (i, texts, exc) = await future
+                (service, hour) = jobs[i]
+                if exc is None:
+                    try:
+                        (hour, result) = await loop.run_in_executor(writer, partial(write_chart, service, hour, texts))
+                        results[i] = FetchResult(service.SLUG, hour, result, None)
+                        continue
+                    except Exception as e:
+                        exc = e
+                logger.error('Failed to fetch {} chart for {}: {}'.format(service.SLUG, hour, exc))
+                results[i] = FetchResult(service.SLUG, hour, None, exc)
+            return results
+
+        try:
+            return self._run(run)
+        finally:
+            # the writer thread has its own database connection
+            writer.submit(connection.close)
+            writer.shutdown(wait=True)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+'''Local matching against the known Melon catalog
+
+Songs from other services are first looked up by normalized name among the
+songs, albums and artists we have already stored for Melon. A song is only
+matched locally if exactly one known Melon song has the same normalized song
+and album names and shares at least one artist, otherwise matching falls back
+to the Melon search API.
+
+The local resolve rate and an estimate of the search time saved are recorded
+as shared metrics (see get_stats).
+'''
+from __future__ import unicode_literals, absolute_import
+
+import re
+import time
+
+from . import metrics
+from .models import MusicServiceArtist, Song
+from .utils import normalize_name
+
+
+RESOLVED = metrics.register('catalog-resolved', 'Songs matched against the local Melon catalog')
+MISSED = metrics.register('catalog-missed', 'Songs which could not be matched against the local Melon catalog')
+LOOKUP_MS = metrics.register('catalog-lookup-ms', 'Total local Melon catalog lookup time (ms)')
+SEARCH_MS = metrics.register('catalog-search-ms', 'Total Melon search API matching time (ms) after local misses')
+
+
+def _artist_keys(artist_name):
+    keys = set([normalize_name(artist_name)])
+    # other services may append a translation in parentheses
+    m = re.match(r'^(.*)\(.*\)$', artist_name.strip())
+    if m:
+        keys.add(normalize_name(m.group(1)))
+    keys.discard('')
+    return keys
+
+
+def find_song(melon_service, alt_service, song, album, artists):
+    '''Find a known Melon song matching an alternate service song
+
+    Arguments are the same as for MelonChartService.match_song. When a song
+    is found, 'melon_id' is set for each of its artists in artists.
+
+    :param MusicService melon_service: The Melon service
+    :param MusicService alt_service: The alternate service
+    :returns: The matched song, or None
+    :rtype: Song
+    '''
+    start = time.time()
+    try:
+        matched = _find_song(melon_service, alt_service, song, album, artists)
+    finally:
+        metrics.incr(LOOKUP_MS, int((time.time() - start) * 1000))
+    metrics.incr(RESOLVED if matched else MISSED)
+    return matched
+
+
+def _find_song(melon_service, alt_service, song, album, artists):
+    name = normalize_name(song['song_name'])
+    if not name:
+        return None
+    candidates = list(
+        Song.objects.filter(
+            normalized_name=name,
+            service_songs__service=melon_service,
+        ).select_related('album').prefetch_related('artists')
+    )
+    if not candidates:
+        return None
+    album_name = normalize_name(album['album_name'])
+    candidates = [s for s in candidates if s.album.normalized_name == album_name]
+    if not candidates:
+        return None
+    # artists which have already been matched for the alternate service
+    artist_ids = set(MusicServiceArtist.objects.filter(
+        service=alt_service,
+        service_artist_id__in=[artist['artist_id'] for artist in artists],
+    ).values_list('artist_id', flat=True))
+    artist_keys = set()
+    for artist in artists:
+        artist_keys |= _artist_keys(artist['artist_name'])
+    matches = []
+    for candidate in candidates:
+        candidate_artists = list(candidate.artists.all())
+        if (set(a.pk for a in candidate_artists) & artist_ids or
+                set(a.normalized_name for a in candidate_artists) & artist_keys):
+            matches.append(candidate)
+    if len(matches) != 1:
+        return None
+    matched = matches[0]
+    melon_ids = dict(MusicServiceArtist.objects.filter(
+        service=melon_service,
+        artist__in=matched.artists.all(),
+    ).values_list('artist__normalized_name', 'service_artist_id'))
+    for artist in artists:
+        for key in _artist_keys(artist['artist_name']):
+            if key in melon_ids:
+                artist['melon_id'] = melon_ids[key]
+                break
+    return matched
+
+
+def record_search_time(elapsed):
+    '''Record time spent matching a song with the Melon search API'''
+    metrics.incr(SEARCH_MS, int(elapsed * 1000))
+
+
+def get_stats():
+    '''Return local catalog matching statistics
+
+    saved_ms is an estimate, based on the average search API matching time
+    per locally missed song.
+
+    :returns: {'resolve_rate': <float>, 'saved_ms': <int>}, or None if nothing has been matched
+    :rtype: dict
+    '''
+    counters = metrics.get_counters([RESOLVED, MISSED, LOOKUP_MS, SEARCH_MS])
+    total = counters[RESOLVED] + counters[MISSED]
+    if not total:
+        return None
+    saved_ms = 0
+    if counters[MISSED]:
+        saved_ms = int(counters[RESOLVED] * counters[SEARCH_MS] / counters[MISSED] - counters[LOOKUP_MS])
+    return {'resolve_rate': counters[RESOLVED] / total, 'saved_ms': saved_ms}
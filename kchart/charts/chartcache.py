@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+'''Compact cached representations of hourly charts
+
+Charts are cached as flat tuples of primitive values rather than as pickled
+model instances, so cached charts are small, fast to load and unaffected by
+model field changes. Payloads are versioned with SCHEMA_VERSION, which must be
+bumped whenever the payload layout changes.
+
+Unpacked charts are returned as namedtuples which mirror the attributes used
+by the chart templates and API serializers.
+
+Unpacked charts are also kept in a per-process LRU cache in front of the
+shared (redis) cache. Each cached chart has a generation counter stored in the
+shared cache, which is bumped whenever the chart changes so that every process
+drops its stale local copy.
+
+The aggregate chart API response body is also cached as pre-rendered JSON
+bytes alongside each aggregate chart payload, so that the API can serve it
+without running any serializers.
+
+The time each chart was cached, the ETag of its pre-rendered body and the
+latest available chart hour are kept in small separate keys, so that HTTP
+validators can be computed without loading any charts (see
+kchart.charts.httpcache).
+
+Rebuilding a missing chart is single-flight: only the process holding the
+rebuild lock queries the database, while other processes wait briefly for the
+rebuilt chart or are served the previous hour's chart marked as stale.
+'''
+from __future__ import unicode_literals, absolute_import
+
+from collections import namedtuple, OrderedDict
+from datetime import datetime, timedelta
+import hashlib
+import threading
+import time
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from pytz import utc
+from rest_framework.renderers import JSONRenderer
+
+from . import metrics
+
+
+SCHEMA_VERSION = 1
+
+# Only the entries which are actually rendered are cached
+CHART_ENTRY_LIMIT = 100
+
+AGGREGATE_CHART_SLUG = 'kchart'
+
+EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+
+CachedArtist = namedtuple('CachedArtist', ['id', 'name', 'debut_date'])
+CachedAlbum = namedtuple('CachedAlbum', ['id', 'name'])
+CachedSong = namedtuple('CachedSong', ['id', 'name', 'artists', 'album', 'release_date'])
+CachedEntry = namedtuple('CachedEntry', ['song', 'position', 'prev_position', 'score'])
+CachedHourlyChart = namedtuple('CachedHourlyChart', ['slug', 'name', 'url', 'weight', 'hour', 'entries'])
+CachedAggregateChart = namedtuple('CachedAggregateChart', ['name', 'hour', 'entries', 'charts', 'stale'])
+RenderedChart = namedtuple('RenderedChart', ['etag', 'body'])
+
+REBUILDS = metrics.register('chart-cache-rebuilds', 'Charts rebuilt from the database after a cache miss')
+COALESCED = metrics.register('chart-cache-coalesced', 'Cache misses which waited on a rebuild by another process')
+STALE = metrics.register('chart-cache-stale', 'Cache misses served the previous hour as a stale chart')
+
+# Seconds between checks for a chart being rebuilt by another process
+REBUILD_POLL_INTERVAL = 0.05
+
+
+def _date_str(d):
+    if d:
+        return d.isoformat()
+    return None
+
+
+def _pack(hour, charts):
+    '''Pack a list of charts into a cache payload
+
+    :param datetime hour: The chart hour
+    :param list charts: A list of (slug, name, url, weight, entries) tuples, where entries is an
+        iterable of chart entry model instances
+    :rtype: tuple
+    '''
+    songs = []
+    song_indexes = {}
+
+    def song_index(song):
+        if song.pk not in song_indexes:
+            song_indexes[song.pk] = len(songs)
+            songs.append((
+                song.pk,
+                song.name,
+                song.album.pk,
+                song.album.name,
+                _date_str(song.release_date),
+                tuple((a.pk, a.name, _date_str(a.debut_date)) for a in song.artists.all()),
+            ))
+        return song_indexes[song.pk]
+
+    packed_charts = []
+    for (slug, name, url, weight, entries) in charts:
+        packed_entries = tuple(
+            (song_index(entry.song), entry.position, entry.prev_position, getattr(entry, 'score', None))
+            for entry in entries
+            if entry.position <= CHART_ENTRY_LIMIT
+        )
+        packed_charts.append((slug, name, url, weight, packed_entries))
+    hour_ts = int((hour - EPOCH).total_seconds())
+    return (SCHEMA_VERSION, hour_ts, tuple(songs), tuple(packed_charts))
+
+
+def _unpack(payload):
+    '''Unpack a cache payload into a list of CachedHourlyChart
+
+    :returns: The unpacked charts, or None if the payload was packed with a different schema version
+    :rtype: list
+    '''
+    if not isinstance(payload, tuple) or not payload or payload[0] != SCHEMA_VERSION:
+        return None
+    (version, hour_ts, packed_songs, packed_charts) = payload
+    hour = EPOCH + timedelta(seconds=hour_ts)
+    songs = [
+        CachedSong(
+            song_id,
+            song_name,
+            tuple(CachedArtist._make(artist) for artist in artists),
+            CachedAlbum(album_id, album_name),
+            release_date,
+        )
+        for (song_id, song_name, album_id, album_name, release_date, artists) in packed_songs
+    ]
+    charts = []
+    for (slug, name, url, weight, packed_entries) in packed_charts:
+        entries = tuple(
+            CachedEntry(songs[i], position, prev_position, score)
+            for (i, position, prev_position, score) in packed_entries
+        )
+        charts.append(CachedHourlyChart(slug, name, url, weight, hour, entries))
+    return charts
+
+
+def pack_aggregate_chart(chart):
+    '''Pack an AggregateHourlySongChart into a cache payload
+
+    The chart should have its entries and component chart entries prefetched.
+    '''
+    charts = [(AGGREGATE_CHART_SLUG, str(chart.name), '', 1.0, chart.entries.all())]
+    for hourly_chart in chart.charts.all():
+        c = hourly_chart.chart
+        charts.append((c.service.slug, c.name, c.url, c.weight, hourly_chart.entries.all()))
+    return _pack(chart.hour, charts)
+
+
+def unpack_aggregate_chart(payload):
+    '''Unpack a payload created with pack_aggregate_chart
+
+    :rtype: CachedAggregateChart
+    '''
+    charts = _unpack(payload)
+    if not charts:
+        return None
+    aggregate = charts[0]
+    return CachedAggregateChart(aggregate.name, aggregate.hour, aggregate.entries, tuple(charts[1:]), False)
+
+
+def pack_hourly_chart(hourly_chart):
+    '''Pack a (service) HourlySongChart into a cache payload
+
+    The chart should have chart__service selected and its entries prefetched.
+    '''
+    c = hourly_chart.chart
+    return _pack(hourly_chart.hour, [(c.service.slug, c.name, c.url, c.weight, hourly_chart.entries.all())])
+
+
+def unpack_hourly_chart(payload):
+    '''Unpack a payload created with pack_hourly_chart
+
+    :rtype: CachedHourlyChart
+    '''
+    charts = _unpack(payload)
+    if not charts:
+        return None
+    return charts[0]
+
+
+def render_json(data):
+    '''Render serialized chart data as a JSON response body
+
+    :param data: Serializer output
+    :returns: The rendered body along with its (unquoted) ETag
+    :rtype: RenderedChart
+    '''
+    body = JSONRenderer().render(data)
+    return RenderedChart(hashlib.sha1(body).hexdigest(), body)
+
+
+def get_rendered_key(key):
+    return '{}-json'.format(key)
+
+
+class LocalChartCache(object):
+    '''Per-process, size bounded LRU cache of unpacked charts
+
+    Entries are stored along with the shared cache generation they were loaded
+    from and the time that generation was last checked.
+    '''
+
+    Entry = namedtuple('Entry', ['chart', 'generation', 'checked'])
+
+    def __init__(self, max_size, ttl):
+        '''
+        :param int max_size: The maximum number of charts to keep
+        :param float ttl: Number of seconds an entry may be served without re-checking its generation
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self._entries[key] = entry
+            return entry
+
+    def set(self, key, chart, generation, checked):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = self.Entry(chart, generation, checked)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_cache = LocalChartCache(settings.CHART_LOCAL_CACHE_SIZE, settings.CHART_LOCAL_CACHE_TTL)
+
+
+def get_generation_key(key):
+    return '{}-generation'.format(key)
+
+
+def get_modified_key(key):
+    return '{}-modified'.format(key)
+
+
+def get_rendered_etag_key(key):
+    return '{}-json-etag'.format(key)
+
+
+def get_modified(key):
+    '''Return the time the chart currently cached under key was cached
+
+    This is set alongside the chart payload, and removed when the chart is
+    invalidated.
+
+    :returns: A unix timestamp, or None if the chart is not cached
+    :rtype: float
+    '''
+    return cache.get(get_modified_key(key))
+
+
+def get_cached_latest_hour(key, query):
+    '''Return the latest chart hour tracked under key
+
+    :param str key: The latest hour cache key
+    :param callable query: Returns the latest hour from the database (or None), used when the
+        latest hour is not cached
+    :rtype: datetime
+    '''
+    hour_ts = cache.get(key)
+    if hour_ts is not None:
+        return EPOCH + timedelta(seconds=hour_ts)
+    hour = query()
+    if hour:
+        advance_latest_hour(key, hour)
+    return hour
+
+
+def advance_latest_hour(key, hour):
+    '''Advance the latest chart hour tracked under key to hour
+
+    The tracked hour is never moved backwards, so backlogged charts may be
+    safely reported here.
+    '''
+    hour_ts = int((hour - EPOCH).total_seconds())
+    if not cache.add(key, hour_ts, None):
+        current = cache.get(key)
+        if current is None or current < hour_ts:
+            cache.set(key, hour_ts, None)
+
+
+def bump_generation(key):
+    '''Mark the chart cached under key as changed, invalidating all local copies
+
+    :returns: The new generation
+    :rtype: int
+    '''
+    local_cache.discard(key)
+    local_cache.discard(get_rendered_key(key))
+    generation_key = get_generation_key(key)
+    try:
+        return cache.incr(generation_key)
+    except ValueError:
+        if cache.add(generation_key, 1, None):
+            return 1
+        return cache.incr(generation_key)
+
+
+def get_cached(key, load, local_key=None):
+    '''Return the unpacked chart cached under key, going through the local cache
+
+    Local entries are served without touching the shared cache for up to
+    local_cache.ttl seconds, after which their generation is re-checked.
+
+    :param str key: The shared cache key
+    :param callable load: Called with no arguments on a local miss, and should return the
+        unpacked chart (or None)
+    :param str local_key: Local cache key, for values derived from the chart cached under key
+        (defaults to key)
+    '''
+    if local_key is None:
+        local_key = key
+    now = time.time()
+    entry = local_cache.get(local_key)
+    if entry and now - entry.checked < local_cache.ttl:
+        return entry.chart
+    # read the generation before loading so that a concurrent bump can never
+    # leave stale data tagged with the new generation
+    generation = cache.get(get_generation_key(key), 0)
+    if entry and entry.generation == generation:
+        local_cache.set(local_key, entry.chart, generation, now)
+        return entry.chart
+    chart = load()
+    if chart is None or getattr(chart, 'stale', False):
+        local_cache.discard(local_key)
+    else:
+        local_cache.set(local_key, chart, generation, now)
+    return chart
+
+
+def rebuild_once(key, build, fetch, stale=None):
+    '''Rebuild the chart cached under key, coalescing concurrent rebuilds
+
+    Only the caller which acquires the rebuild lock runs build(). Other callers
+    poll fetch() for up to CHART_CACHE_LOCK_WAIT seconds, and then fall back to
+    stale() if it returns a chart. If no chart is available at all the caller
+    rebuilds the chart itself.
+
+    :param str key: The shared cache key
+    :param callable build: Rebuilds, caches and returns the chart
+    :param callable fetch: Returns the chart from the shared cache, or None
+    :param callable stale: Returns a substitute chart marked as stale, or None
+    '''
+    lock_key = '{}-lock'.format(key)
+    token = uuid4().hex
+    if not cache.add(lock_key, token, settings.CHART_CACHE_LOCK_TIMEOUT):
+        metrics.incr(COALESCED)
+        deadline = time.time() + settings.CHART_CACHE_LOCK_WAIT
+        while time.time() < deadline:
+            time.sleep(REBUILD_POLL_INTERVAL)
+            chart = fetch()
+            if chart is not None:
+                return chart
+            if cache.get(lock_key) is None:
+                # the rebuild finished without caching anything
+                break
+        else:
+            if stale:
+                chart = stale()
+                if chart is not None:
+                    metrics.incr(STALE)
+                    return chart
+        if not cache.add(lock_key, token, settings.CHART_CACHE_LOCK_TIMEOUT):
+            return build()
+    metrics.incr(REBUILDS)
+    try:
+        return build()
+    finally:
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
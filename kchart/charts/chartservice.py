@@ -1,18 +1,23 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
 
-from datetime import datetime, date
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, date, timedelta
+import json
 import logging
 import re
+import time
 
 from lxml.html import fromstring, tostring
 from fake_useragent import UserAgent
-import requests
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
-from django.db.models import Count, F
+from django.db import transaction
 
+from . import catalog, httpclient
+from .searchcache import memoize_search
 from .models import (
     Artist,
     Album,
@@ -23,11 +28,12 @@ from .models import (
     MusicServiceSong,
     Chart,
     HourlySongChart,
-    HourlySongChartEntry,
-    AggregateHourlySongChart,
+    HourlySongChartSnapshot,
+    SongChartSummary,
+    ChartStats,
     UnknownServiceSong,
 )
-from .utils import KR_TZ, strip_to_hour, utcnow, melon_hour
+from .utils import KR_TZ, strip_to_hour, utcnow, melon_hour, melonify_name
 
 
 logger = logging.getLogger('django')
@@ -35,15 +41,39 @@ logger = logging.getLogger('django')
 ua = UserAgent()
 REQUESTS_TIMEOUT = 6.05
 
+# An HTTP request for (part of) a chart. proxy is True if the request should
+# be sent through REQUESTS_HTTP_PROXY with a randomized user agent
+ChartRequest = namedtuple('ChartRequest', ['url', 'params', 'headers', 'proxy'])
+
 
 def randomized_get(url, headers={}, timeout=REQUESTS_TIMEOUT, **kwargs):
-    if settings.REQUESTS_HTTP_PROXY:
-        proxies = {'http': settings.REQUESTS_HTTP_PROXY, 'https': settings.REQUESTS_HTTP_PROXY}
+    proxies = httpclient.get_proxies()
+    if proxies:
         timeout = 10 * timeout
-    else:
-        proxies = {}
-    headers.update({'User-Agent': ua.random})
-    return requests.get(url, headers=headers, timeout=timeout, proxies=proxies, **kwargs)
+    headers = dict(headers, **{'User-Agent': ua.random})
+    return httpclient.get(url, headers=headers, timeout=timeout, proxies=proxies, **kwargs)
+
+
+class ResolvedSongs(object):
+    '''Chart page songs which have already been matched, or are known to be unmatchable'''
+
+    def __init__(self, known=None, unknown=None):
+        '''
+        :param dict known: service song id -> Song for matched songs
+        :param set unknown: Service song ids for unmatchable songs
+        '''
+        self.known = known or {}
+        self.unknown = unknown or set()
+
+    def __contains__(self, service_song_id):
+        return service_song_id in self.known or service_song_id in self.unknown
+
+    def get_entry(self, service_song_id, position):
+        '''Return the chart entry for a resolved song, or None if it is unmatchable'''
+        if service_song_id in self.known:
+            return {'song': self.known[service_song_id], 'position': position}
+        logger.info('Skipping unmatchable song {}'.format(service_song_id))
+        return None
 
 
 class BaseChartService(object):
@@ -55,6 +85,8 @@ class BaseChartService(object):
     ALBUM_URL = '{album_id}'
     SONG_URL = '{song_id}'
     SLUG = ''
+    # Number of pages in a (scraped) hourly chart
+    HOURLY_CHART_PAGES = 1
 
     def __init__(self):
         if not self.NAME:
@@ -81,6 +113,130 @@ class BaseChartService(object):
             service.save()
         return service
 
+    def _map_concurrently(self, func, items):
+        '''Call func for each item using a bounded thread pool
+
+        Results are yielded as (item, result) pairs in completion order. func
+        must not access the database, results should be processed by the caller.
+        '''
+        with ThreadPoolExecutor(max_workers=settings.CHART_FETCH_THREADS) as executor:
+            futures = dict((executor.submit(func, item), item) for item in items)
+            for future in as_completed(futures):
+                yield (futures[future], future.result())
+
+    def _hourly_chart_page_request(self, hour, page=1):
+        '''Return the request for the specified hourly chart page
+
+        :rtype: ChartRequest
+        '''
+        raise NotImplementedError
+
+    def _hourly_chart_requests(self, hour):
+        '''Return the requests for every page of the specified hourly chart
+
+        :rtype: list
+        '''
+        return [self._hourly_chart_page_request(hour, page) for page in range(1, self.HOURLY_CHART_PAGES + 1)]
+
+    def _download_hourly_chart_page(self, hour, page=1):
+        '''Download the specified hourly chart page
+
+        :rtype: str
+        '''
+        request = self._hourly_chart_page_request(hour, page)
+        r = randomized_get(request.url, headers=request.headers, params=request.params)
+        r.raise_for_status()
+        return r.text
+
+    def _parse_hourly_chart_page(self, text, dry_run=False):
+        '''Parse a downloaded hourly chart page into a list of chart entries'''
+        raise NotImplementedError
+
+    def _parse_hourly_chart_responses(self, hour, texts, dry_run=False):
+        '''Parse the downloaded responses for the requests from _hourly_chart_requests
+
+        :returns: (hour, entries) for the chart contained in the responses
+        :rtype: tuple
+        '''
+        entries = []
+        for text in texts:
+            entries.extend(self._parse_hourly_chart_page(text, dry_run=dry_run))
+        return (hour, entries)
+
+    def _archive_hourly_chart(self, hour, texts):
+        '''Archive the downloaded responses for the requests from _hourly_chart_requests'''
+        HourlySongChartSnapshot.archive(self.hourly_chart, hour, texts)
+
+    def _scrape_hourly_chart_page(self, hour, page=1, dry_run=False):
+        return self._parse_hourly_chart_page(self._download_hourly_chart_page(hour, page), dry_run=dry_run)
+
+    def _get_hourly_chart(self, hour, dry_run=False):
+        '''Fetch all HOURLY_CHART_PAGES pages of the specified hourly chart
+
+        Pages are downloaded concurrently, and each page is parsed as soon as
+        it has been downloaded. Unless this is a dry run the downloaded pages
+        are archived, even if they could not be parsed.
+        '''
+        texts = {}
+        pages = {}
+        error = None
+        for (page, text) in self._map_concurrently(
+            lambda page: self._download_hourly_chart_page(hour, page),
+            range(1, self.HOURLY_CHART_PAGES + 1)
+        ):
+            texts[page] = text
+            if error is None:
+                try:
+                    pages[page] = self._parse_hourly_chart_page(text, dry_run=dry_run)
+                except Exception as exc:
+                    error = exc
+        if not dry_run:
+            self._archive_hourly_chart(hour, [texts[page] for page in sorted(texts)])
+        if error is not None:
+            raise error
+        entries = []
+        for page in sorted(pages):
+            entries.extend(pages[page])
+        return entries
+
+    def _get_complete_chart(self, hour):
+        '''Return the existing hourly chart for hour if it is complete, otherwise None'''
+        try:
+            chart = HourlySongChart.objects.get(chart=self.hourly_chart, hour=hour)
+            if chart.is_complete:
+                return chart
+        except ObjectDoesNotExist:
+            pass
+        except MultipleObjectsReturned:
+            pass
+        return None
+
+    def _write_hourly_chart(self, hour, entries, force_update=False):
+        '''Write fetched chart entries to the database
+
+        The hour's entries are replaced in a single transaction, see HourlySongChart.write_entries
+
+        :param datetime hour: The chart hour
+        :param list entries: A list of {'song': <Song>, 'position': <int>} dicts, entries without a song are skipped
+        :param bool force_update: True if an existing complete chart should be overwritten
+        :rtype: HourlySongChart
+        '''
+        with transaction.atomic():
+            (hourly_song_chart, created) = HourlySongChart.objects.get_or_create(chart=self.hourly_chart, hour=hour)
+            if not created and not force_update and hourly_song_chart.is_complete:
+                logger.info('Skipping db update for existing {} chart'.format(self.SLUG))
+                return hourly_song_chart
+            hourly_song_chart.write_entries(
+                (song_data['song'].pk, song_data['position']) for song_data in entries if song_data['song']
+            )
+            SongChartSummary.update_for_chart(hourly_song_chart)
+            ChartStats.update_for_chart(hourly_song_chart)
+        logger.info('Wrote {} realtime chart for {} to database'.format(self.SLUG, hour))
+        HourlySongChart.invalidate_cached_chart(hourly_song_chart.chart_id, hourly_song_chart.hour)
+        HourlySongChart.invalidate_cached_chart(hourly_song_chart.chart_id, hourly_song_chart.hour + timedelta(hours=1))
+        HourlySongChart.set_latest_hour(hourly_song_chart.chart_id, hourly_song_chart.hour)
+        return hourly_song_chart
+
     def fetch_hourly(self, hour=None, dry_run=False, force_update=False):
         '''Fetch the specified hourly chart for this service and update the relevant table
 
@@ -89,25 +245,46 @@ class BaseChartService(object):
         :param bool dry_run: True if the chart data should not be written to the database.
         :param bool force_update: True if existing chart data should be overwritten
         '''
-        raise NotImplementedError
+        if hour:
+            hour = strip_to_hour(hour)
+        else:
+            hour = strip_to_hour(utcnow())
+        if not force_update:
+            chart = self._get_complete_chart(hour)
+            if chart:
+                logger.info('Skipping fetch for existing {} chart'.format(self.SLUG))
+                return chart
+        data = self._get_hourly_chart(hour, dry_run=dry_run)
+        if len(data) != 100:
+            logger.warning('{} returned unexpected number of chart entries: {}'.format(self.NAME, len(data)))
+        logger.info('Fetched {} realtime chart for {}'.format(self.SLUG, hour))
+        if dry_run:
+            return data
+        return self._write_hourly_chart(hour, data, force_update=force_update)
 
     def get_incomplete(self):
+        '''Return this service's hourly charts with fewer than 100 entries
+
+        Uses the partial index on incomplete charts, so the cost does not grow with chart history.
+        '''
         return HourlySongChart.objects.filter(
-            chart__service=self.service
-        ).annotate(
-            Count(F('entries'))
-        ).filter(
-            entries__count__lt=100
+            chart__service=self.service,
+            entry_count__lt=100
         ).all()
 
     def refetch_incomplete(self, dry_run=False):
-        '''Re-fetch any incomplete charts for this service'''
+        '''Re-fetch any incomplete charts for this service
+
+        Each refetched hour is scheduled for aggregation, see kchart.charts.tasks.schedule_aggregation
+        '''
+        # tasks depend on this module
+        from .tasks import schedule_aggregation
         incomplete = self.get_incomplete()
         logger.info('Refetching {} incomplete {} charts'.format(len(incomplete), self.SLUG))
         for chart in incomplete:
             self.fetch_hourly(hour=chart.hour, dry_run=dry_run, force_update=True)
             if not dry_run:
-                AggregateHourlySongChart.generate(hour=chart.hour, regenerate=True)
+                schedule_aggregation(chart.hour)
 
     @classmethod
     def match_song(cls, alt_service, song, album, artists, try_artist=False, try_album=False):
@@ -125,6 +302,30 @@ class BaseChartService(object):
         '''
         raise NotImplementedError
 
+    def _resolve_songs(self, service_song_ids):
+        '''Resolve all of a chart page's known songs with one query for each table
+
+        Only songs which are not resolved need to go through song matching.
+
+        :param list service_song_ids: The service song ids scraped from the page
+        :rtype: ResolvedSongs
+        '''
+        service_song_ids = set(i for i in service_song_ids if i is not None)
+        if not service_song_ids:
+            return ResolvedSongs()
+        known = dict(
+            (service_song.service_song_id, service_song.song)
+            for service_song in MusicServiceSong.objects.filter(
+                service=self.service,
+                service_song_id__in=service_song_ids
+            ).select_related('song')
+        )
+        unknown = set(UnknownServiceSong.objects.filter(
+            service=self.service,
+            service_song_id__in=service_song_ids - set(known)
+        ).values_list('service_song_id', flat=True))
+        return ResolvedSongs(known, unknown)
+
     def match_to_other_service(self, alt_service_cls, song_data, album_data, artists):
         '''Attempt to match a song for this service to another service
 
@@ -198,6 +399,12 @@ class MelonChartService(BaseChartService):
     SONG_URL = 'http://www.melon.com/song/detail.htm?songId={song_id}'
     SLUG = 'melon'
     VARIOUS_ARTISTS_ID = 2727
+    REALTIME_CHART_API_URL = 'http://apis.skplanetx.com/melon/charts/realtime'
+    REALTIME_CHART_API_PARAMS = {
+        'version': 1,
+        'page': 1,
+        'count': 100,
+    }
 
     def __init__(self):
         super(MelonChartService, self).__init__()
@@ -210,10 +417,13 @@ class MelonChartService(BaseChartService):
             }
         )
 
+    @classmethod
+    def api_headers(cls):
+        return {'Accept': 'application/json', 'appKey': settings.MELON_APP_KEY}
+
     @classmethod
     def api_get_json(cls, url, params=None):
-        headers = {'Accept': 'application/json', 'appKey': settings.MELON_APP_KEY}
-        r = requests.get(url, params=params, headers=headers, timeout=REQUESTS_TIMEOUT)
+        r = httpclient.get(url, params=params, headers=cls.api_headers(), timeout=REQUESTS_TIMEOUT)
         r.raise_for_status()
         return r.json()
 
@@ -345,6 +555,46 @@ class MelonChartService(BaseChartService):
         defaults['album'] = album
         return melon.get_song_from_melon(song_data['songId'], defaults=defaults)
 
+    def _hourly_chart_requests(self, hour):
+        # The melon API only provides the live chart
+        return [ChartRequest(self.REALTIME_CHART_API_URL, self.REALTIME_CHART_API_PARAMS, self.api_headers(), False)]
+
+    def _parse_hourly_chart_responses(self, hour, texts, dry_run=False):
+        return self._parse_realtime_chart(json.loads(texts[0])['melon'], dry_run=dry_run)
+
+    def _archive_hourly_chart(self, hour, texts):
+        # archive under the chart's own hour rather than the requested hour
+        try:
+            melon_data = json.loads(texts[0])['melon']
+            hour = melon_hour(melon_data['rankDay'], melon_data['rankHour'])
+        except (ValueError, KeyError, TypeError):
+            pass
+        super(MelonChartService, self)._archive_hourly_chart(hour, texts)
+
+    def _parse_realtime_chart(self, melon_data, dry_run=False):
+        '''Parse a realtime chart API response
+
+        :returns: (hour, entries) for the chart, where entries is the unmodified melon_data for dry runs
+        :rtype: tuple
+        '''
+        if melon_data['count'] != 100:
+            raise ValueError('Melon returned unexpected number of chart entries: {}'.format(melon_data['count']))
+        rank_hour = melon_hour(melon_data['rankDay'], melon_data['rankHour'])
+        logger.info('Fetched melon realtime chart for {}'.format(rank_hour))
+        if dry_run:
+            return (rank_hour, melon_data)
+        resolved = self._resolve_songs([int(song_data['songId']) for song_data in melon_data['songs']['song']])
+        entries = []
+        for song_data in melon_data['songs']['song']:
+            song = resolved.known.get(int(song_data['songId']))
+            if song is None:
+                song = self.get_or_create_song_from_melon_data(song_data)
+            entries.append({
+                'song': song,
+                'position': song_data['currentRank'],
+            })
+        return (rank_hour, entries)
+
     def fetch_hourly(self, hour=None, dry_run=False, force_update=False):
         if hour:
             raise ValueError(
@@ -353,49 +603,26 @@ class MelonChartService(BaseChartService):
             )
         hour = strip_to_hour(utcnow())
         if not force_update:
-            try:
-                chart = HourlySongChart.objects.get(chart=self.hourly_chart, hour=hour)
-                if chart and chart.entries.count() and not force_update:
-                    logger.info('Skipping fetch for existing melon chart')
-                    return chart
-            except ObjectDoesNotExist:
-                pass
-            except MultipleObjectsReturned:
-                pass
-        url = 'http://apis.skplanetx.com/melon/charts/realtime'
-        params = {
-            'version': 1,
-            'page': 1,
-            'count': 100,
-        }
-        melon_data = self.api_get_json(url, params)['melon']
-        if melon_data['count'] != 100:
-            raise ValueError('Melon returned unexpected number of chart entries: {}'.format(melon_data['count']))
-        rank_hour = melon_hour(melon_data['rankDay'], melon_data['rankHour'])
-        logger.info('Fetched melon realtime chart for {}'.format(rank_hour))
+            chart = self._get_complete_chart(hour)
+            if chart:
+                logger.info('Skipping fetch for existing melon chart')
+                return chart
+        r = httpclient.get(
+            self.REALTIME_CHART_API_URL,
+            params=self.REALTIME_CHART_API_PARAMS,
+            headers=self.api_headers(),
+            timeout=REQUESTS_TIMEOUT
+        )
+        r.raise_for_status()
+        if not dry_run:
+            self._archive_hourly_chart(hour, [r.text])
+        (rank_hour, entries) = self._parse_hourly_chart_responses(hour, [r.text], dry_run=dry_run)
         if dry_run:
-            return melon_data
-        (hourly_song_chart, created) = HourlySongChart.objects.get_or_create(chart=self.hourly_chart, hour=rank_hour)
-        if not created and hourly_song_chart.entries.count() and not force_update:
-            logger.info('Skipping db update for existing melon chart')
-            return hourly_song_chart
-        for song_data in melon_data['songs']['song']:
-            song = self.get_or_create_song_from_melon_data(song_data)
-            defaults = {'position': song_data['currentRank']}
-            (chart_entry, created) = HourlySongChartEntry.objects.get_or_create(
-                hourly_chart=hourly_song_chart,
-                song=song,
-                defaults=defaults
-            )
-            if not created and chart_entry.position != song_data['currentRank']:
-                chart_entry.position = song_data['currentRank']
-                chart_entry.save()
-            chart_entry.update_prev_position()
-        logger.info('Wrote melon realtime chart for {} to database'.format(rank_hour))
-        hourly_song_chart.update_next_chart()
-        return hourly_song_chart
+            return entries
+        return self._write_hourly_chart(rank_hour, entries, force_update=force_update)
 
     @classmethod
+    @memoize_search('artist')
     def search_artist(cls, name, page=1):
         url = 'http://apis.skplanetx.com/melon/artists'
         params = {
@@ -422,13 +649,10 @@ class MelonChartService(BaseChartService):
 
     @classmethod
     def melonify_name(cls, name):
-        # Melon use U+FFE6 FULLWIDTH WON SIGN
-        # Other services use U+20A9 WON SIGN
-        name = re.sub('[₩]', '￦', name)
-        name = re.sub('[\'"`‘]', '', name)
-        return name
+        return melonify_name(name)
 
     @classmethod
+    @memoize_search('album')
     def search_album(cls, name, page=1, artist_names=[], replace_amp=True):
         url = 'http://apis.skplanetx.com/melon/albums'
         orig_name = name
@@ -480,6 +704,7 @@ class MelonChartService(BaseChartService):
         return (albums, next_page)
 
     @classmethod
+    @memoize_search('song')
     def search_song(cls, name, page=1, artist_names=[], album_name=''):
         url = 'http://apis.skplanetx.com/melon/songs'
         # melon prefers and for titles but & in featured artist lists
@@ -548,6 +773,22 @@ class MelonChartService(BaseChartService):
             return None
         except UnknownServiceSong.DoesNotExist:
             pass
+        if not try_artist and not try_album:
+            # the local lookup does not depend on the search options, so it
+            # only needs to be done for the first attempt
+            local_song = catalog.find_song(melon.service, alt_service, song, album, artists)
+            if local_song:
+                logger.debug('Matched song {} from local catalog'.format(song))
+                return local_song
+        start = time.time()
+        try:
+            return cls._search_song(melon, alt_service, song, album, artists, try_artist, try_album)
+        finally:
+            catalog.record_search_time(time.time() - start)
+
+    @classmethod
+    def _search_song(cls, melon, alt_service, song, album, artists, try_artist=False, try_album=False):
+        '''Match a song using the Melon search API'''
         for artist in artists:
             try:
                 # Check for existing matched artists
@@ -652,6 +893,7 @@ class GenieChartService(BaseChartService):
     ALBUM_URL = 'http://www.genie.co.kr/detail/albumInfo?axnm={album_id}'
     SONG_URL = 'http://www.genie.co.kr/detail/songInfo?xgnm={song_id}'
     SLUG = 'genie'
+    HOURLY_CHART_PAGES = 2
 
     def __init__(self):
         super(GenieChartService, self).__init__()
@@ -676,14 +918,35 @@ class GenieChartService(BaseChartService):
             return None
         return int(m.group('album_id'))
 
-    def _split_genie_artist(self, name, artist_id):
+    def _download_artist_page(self, artist_id):
+        r = randomized_get(self.ARTIST_URL.format(artist_id=artist_id))
+        r.raise_for_status()
+        return r.text
+
+    def _prefetch_artist_pages(self, list_entries, resolved):
+        '''Concurrently download the artist pages needed to split collab artists in a chart page
+
+        Only entries for songs which have not already been resolved need their artists split.
+
+        :returns: A dict of artist_id -> artist page text
+        :rtype: dict
+        '''
+        artist_ids = set()
+        for list_entry in list_entries:
+            if int(list_entry.get('songid')) in resolved:
+                continue
+            artist_a = list_entry.find(".//span[@class='meta']/a[@class='artist']")
+            if artist_a is not None and '&' in artist_a.text:
+                artist_ids.add(self._get_artist_id_from_a(artist_a))
+        return dict(self._map_concurrently(self._download_artist_page, artist_ids))
+
+    def _split_genie_artist(self, name, artist_id, artist_page=None):
         # Genie lists collab'd artists as a group, all other services split
         # them so we determine if we need to split here
         if '&' in name:
-            url = self.ARTIST_URL.format(artist_id=artist_id)
-            r = randomized_get(url)
-            r.raise_for_status()
-            html = fromstring(r.text)
+            if artist_page is None:
+                artist_page = self._download_artist_page(artist_id)
+            html = fromstring(artist_page)
             main_infos = html.find_class('artist-main-infos')[0]
             type_span = main_infos.find("./div[@class='info-zone']/ul[@class='info-data']/li")
             if '프로젝트' in type_span.text_content():
@@ -699,7 +962,11 @@ class GenieChartService(BaseChartService):
                     return artists
         return [{'artist_name': MelonChartService.melonify_name(name), 'artist_id': artist_id}]
 
-    def _scrape_chart_entry(self, entry_element, dry_run=False):
+    def _scrape_chart_entry(self, entry_element, dry_run=False, artist_pages=None, resolved=None):
+        if artist_pages is None:
+            artist_pages = {}
+        if resolved is None:
+            resolved = ResolvedSongs()
         rank = None
         for cls in entry_element.classes:
             m = re.match('rank-(?P<rank>\d+)', cls)
@@ -708,19 +975,16 @@ class GenieChartService(BaseChartService):
         if not rank:
             raise RuntimeError('Got unexpected genie chart HTML')
         song_id = int(entry_element.get('songid'))
-        try:
+        if song_id in resolved:
             # If we've already gotten this song, return it now. Normally this
             # check is performed in MelonChartService.match_song(), but for
             # genie we do this check here to avoid potential unnecessary artist lookup requests
-            genie_song = MusicServiceSong.objects.get(service=self.service, service_song_id=song_id)
-            return {'song': genie_song.song, 'position': rank}
-        except MusicServiceSong.DoesNotExist:
-            pass
+            return resolved.get_entry(song_id, rank)
         music_span = entry_element.find("./span[@class='music-info']/span[@class='music_area']/span[@class='music']")
         artist_a = music_span.find("./span[@class='meta']/a[@class='artist']")
         artist_name = artist_a.text.strip()
         artist_id = self._get_artist_id_from_a(artist_a)
-        artists = self._split_genie_artist(artist_name, artist_id)
+        artists = self._split_genie_artist(artist_name, artist_id, artist_pages.get(artist_id))
         album_a = music_span.find("./span[@class='meta']/a[@class='albumtitle']")
         album_id = self._get_album_id_from_a(album_a)
         album_name = album_a.text.strip()
@@ -775,9 +1039,8 @@ class GenieChartService(BaseChartService):
                 )
         return {'song': song, 'position': rank}
 
-    def _scrape_hourly_chart_page(self, hour, page=1, dry_run=False):
+    def _hourly_chart_page_request(self, hour, page=1):
         kr_hour = hour.astimezone(KR_TZ)
-        url = self.hourly_chart.url
         params = {
             'ditc': 'D',
             'rtm': 'Y',
@@ -785,64 +1048,24 @@ class GenieChartService(BaseChartService):
             'hh': kr_hour.strftime('%H'),
             'pg': page,
         }
-        r = randomized_get(url, params=params)
-        r.raise_for_status()
-        html = fromstring(r.text)
+        return ChartRequest(self.hourly_chart.url, params, {}, True)
+
+    def _parse_hourly_chart_page(self, text, dry_run=False):
+        html = fromstring(text)
         song_list = html.find_class('list-wrap')
         if len(song_list) != 1:
             raise RuntimeError('Got unexpected genie chart HTML')
+        list_entries = list(song_list[0])
+        resolved = self._resolve_songs([int(list_entry.get('songid')) for list_entry in list_entries])
+        artist_pages = self._prefetch_artist_pages(list_entries, resolved)
         entries = []
-        for list_entry in song_list[0]:
-            entry = self._scrape_chart_entry(list_entry, dry_run=dry_run)
+        for list_entry in list_entries:
+            entry = self._scrape_chart_entry(list_entry, dry_run=dry_run, artist_pages=artist_pages,
+                                             resolved=resolved)
             if entry:
                 entries.append(entry)
         return entries
 
-    def _get_hourly_chart(self, hour, dry_run=False):
-        pg1_data = self._scrape_hourly_chart_page(hour, page=1, dry_run=dry_run)
-        pg2_data = self._scrape_hourly_chart_page(hour, page=2, dry_run=dry_run)
-        return pg1_data + pg2_data
-
-    def fetch_hourly(self, hour=None, dry_run=False, force_update=False):
-        if hour:
-            hour = strip_to_hour(hour)
-        else:
-            hour = strip_to_hour(utcnow())
-        if not force_update:
-            try:
-                chart = HourlySongChart.objects.get(chart=self.hourly_chart, hour=hour)
-                if chart and chart.entries.count() == 100 and not force_update:
-                    logger.info('Skipping fetch for existing genie chart')
-                    return chart
-            except ObjectDoesNotExist:
-                pass
-            except MultipleObjectsReturned:
-                pass
-        genie_data = self._get_hourly_chart(hour, dry_run=dry_run)
-        if len(genie_data) != 100:
-            logger.warning('Genie returned unexpected number of chart entries: {}'.format(len(genie_data)))
-        logger.info('Fetched genie realtime chart for {}'.format(hour))
-        if dry_run:
-            return genie_data
-        (hourly_song_chart, created) = HourlySongChart.objects.get_or_create(chart=self.hourly_chart, hour=hour)
-        if not created and hourly_song_chart.entries.count() == 100:
-            logger.info('Skipping db update for existing genie chart')
-            return hourly_song_chart
-        for song_data in genie_data:
-            defaults = {'position': song_data['position']}
-            (chart_entry, created) = HourlySongChartEntry.objects.get_or_create(
-                hourly_chart=hourly_song_chart,
-                song=song_data['song'],
-                defaults=defaults
-            )
-            if not created and chart_entry.position != song_data['position']:
-                chart_entry.position = song_data['position']
-                chart_entry.save()
-            chart_entry.update_prev_position()
-        logger.info('Wrote genie realtime chart for {} to database'.format(hour))
-        hourly_song_chart.update_next_chart()
-        return hourly_song_chart
-
 
 class MnetChartService(BaseChartService):
 
@@ -852,6 +1075,7 @@ class MnetChartService(BaseChartService):
     ALBUM_URL = 'http://www.mnet.com/album/{album_id}'
     SONG_URL = 'http://www.mnet.com/track/{song_id}'
     SLUG = 'mnet'
+    HOURLY_CHART_PAGES = 2
 
     def __init__(self):
         super(MnetChartService, self).__init__()
@@ -887,16 +1111,7 @@ class MnetChartService(BaseChartService):
             return int(m.group('album_id'))
         return None
 
-    def _scrape_chart_row(self, tr, dry_run=False):
-        rank = None
-        rank_span = tr.find_class('MMLI_RankNum')[0]
-        for cls in rank_span.classes:
-            m = re.match('^MMLI_RankNum(?:Best)?_(?P<rank>\d+)$', cls.strip())
-            if m:
-                rank = int(m.group('rank'))
-                break
-        if not rank:
-            raise RuntimeError('Got unexpected mnet chart HTML')
+    def _scrape_song_data(self, tr):
         song_a = tr.find(".//a[@class='MMLI_Song']")
         if song_a is not None:
             song_data = {
@@ -910,6 +1125,23 @@ class MnetChartService(BaseChartService):
             song_data = {'song_name': MelonChartService.melonify_name(song_a.text.strip())}
             song_a = tr.find(".//a[@class='MMLI_SongInfo']")
             song_data['song_id'] = self._get_song_id_from_a(song_a)
+        return song_data
+
+    def _scrape_chart_row(self, tr, dry_run=False, resolved=None):
+        if resolved is None:
+            resolved = ResolvedSongs()
+        rank = None
+        rank_span = tr.find_class('MMLI_RankNum')[0]
+        for cls in rank_span.classes:
+            m = re.match('^MMLI_RankNum(?:Best)?_(?P<rank>\d+)$', cls.strip())
+            if m:
+                rank = int(m.group('rank'))
+                break
+        if not rank:
+            raise RuntimeError('Got unexpected mnet chart HTML')
+        song_data = self._scrape_song_data(tr)
+        if not dry_run and song_data['song_id'] in resolved:
+            return resolved.get_entry(song_data['song_id'], rank)
         artists = []
         for artist_a in tr.findall(".//a[@class='MMLIInfo_Artist']"):
             artist_data = {
@@ -947,71 +1179,30 @@ class MnetChartService(BaseChartService):
         else:
             return {'song': song, 'position': rank}
 
-    def _scrape_hourly_chart_page(self, hour, page=1, dry_run=False):
+    def _hourly_chart_page_request(self, hour, page=1):
         kr_hour = hour.astimezone(KR_TZ)
         url = '{}{}'.format(self.hourly_chart.url, kr_hour.strftime('%Y%m%d%H'))
         params = {
             'pNum': page,
         }
-        r = randomized_get(url, params=params)
-        r.raise_for_status()
-        html = fromstring(r.text)
+        return ChartRequest(url, params, {}, True)
+
+    def _parse_hourly_chart_page(self, text, dry_run=False):
+        html = fromstring(text)
         chart_div = html.find_class('MMLTable')
         if len(chart_div) != 1:
             raise RuntimeError('Got unexpected mnet chart HTML')
+        rows = chart_div[0].findall('.//tbody/tr')
+        resolved = ResolvedSongs()
+        if not dry_run:
+            resolved = self._resolve_songs([self._scrape_song_data(tr)['song_id'] for tr in rows])
         entries = []
-        for tr in chart_div[0].findall('.//tbody/tr'):
-            entry = self._scrape_chart_row(tr, dry_run=dry_run)
+        for tr in rows:
+            entry = self._scrape_chart_row(tr, dry_run=dry_run, resolved=resolved)
             if entry:
                 entries.append(entry)
         return entries
 
-    def _get_hourly_chart(self, hour, dry_run=False):
-        pg1_data = self._scrape_hourly_chart_page(hour, page=1, dry_run=dry_run)
-        pg2_data = self._scrape_hourly_chart_page(hour, page=2, dry_run=dry_run)
-        return pg1_data + pg2_data
-
-    def fetch_hourly(self, hour=None, dry_run=False, force_update=False):
-        if hour:
-            hour = strip_to_hour(hour)
-        else:
-            hour = strip_to_hour(utcnow())
-        if not force_update:
-            try:
-                chart = HourlySongChart.objects.get(chart=self.hourly_chart, hour=hour)
-                if chart and chart.entries.count() == 100 and not force_update:
-                    logger.info('Skipping fetch for existing mnet chart')
-                    return chart
-            except ObjectDoesNotExist:
-                pass
-            except MultipleObjectsReturned:
-                pass
-        mnet_data = self._get_hourly_chart(hour, dry_run=dry_run)
-        if len(mnet_data) != 100:
-            logger.warning('Mnet returned unexpected number of chart entries: {}'.format(len(mnet_data)))
-        logger.info('Fetched mnet realtime chart for {}'.format(hour))
-        if dry_run:
-            return mnet_data
-        (hourly_song_chart, created) = HourlySongChart.objects.get_or_create(chart=self.hourly_chart, hour=hour)
-        if not created and hourly_song_chart.entries.count() == 100:
-            logger.info('Skipping db update for existing mnet chart')
-            return hourly_song_chart
-        for song_data in mnet_data:
-            if song_data['song']:
-                defaults = {'position': song_data['position']}
-                (chart_entry, created) = HourlySongChartEntry.objects.get_or_create(
-                    hourly_chart=hourly_song_chart,
-                    song=song_data['song'],
-                    defaults=defaults
-                )
-                if not created and chart_entry.position != song_data['position']:
-                    chart_entry.position = song_data['position']
-                    chart_entry.save()
-                chart_entry.update_prev_position()
-        logger.info('Wrote mnet realtime chart for {} to database'.format(hour))
-        hourly_song_chart.update_next_chart()
-        return hourly_song_chart
-
 
 class BugsChartService(BaseChartService):
 
@@ -1079,14 +1270,21 @@ class BugsChartService(BaseChartService):
             return int(m.group('album_id'))
         return None
 
-    def _scrape_chart_row(self, tr, dry_run=False):
-        rank_span = tr.find("./td/div[@class='ranking']/strong")
-        rank = int(rank_span.text.strip())
+    def _scrape_song_data(self, tr):
         song_a = tr.find("./th/p[@class='title']/a")
-        song_data = {
+        return {
             'song_id': self._get_song_id_from_a(song_a),
             'song_name': MelonChartService.melonify_name(song_a.text.strip()),
         }
+
+    def _scrape_chart_row(self, tr, dry_run=False, resolved=None):
+        if resolved is None:
+            resolved = ResolvedSongs()
+        rank_span = tr.find("./td/div[@class='ranking']/strong")
+        rank = int(rank_span.text.strip())
+        song_data = self._scrape_song_data(tr)
+        if not dry_run and song_data['song_id'] in resolved:
+            return resolved.get_entry(song_data['song_id'], rank)
         if tr.get('multiartist') == 'Y':
             artist_a = tr.find("./td/p[@class='artist']/a[@class='more']")
             artists = self._get_multi_artists_from_a(artist_a)
@@ -1118,67 +1316,30 @@ class BugsChartService(BaseChartService):
         else:
             return {'song': song, 'position': rank}
 
-    def _get_hourly_chart(self, hour, dry_run=False):
+    def _hourly_chart_page_request(self, hour, page=1):
         kr_hour = hour.astimezone(KR_TZ)
-        url = self.hourly_chart.url
         params = {
             'chartdate': kr_hour.strftime('%Y%m%d'),
             'charthour': kr_hour.strftime('%H'),
         }
-        r = randomized_get(url, params=params)
-        r.raise_for_status()
-        html = fromstring(r.text)
+        return ChartRequest(self.hourly_chart.url, params, {}, True)
+
+    def _parse_hourly_chart_page(self, text, dry_run=False):
+        html = fromstring(text)
         chart_table = html.find_class('byChart')
         if len(chart_table) != 1:
             raise RuntimeError('Got unexpected bugs chart HTML')
+        rows = chart_table[0].findall('.//tbody/tr')
+        resolved = ResolvedSongs()
+        if not dry_run:
+            resolved = self._resolve_songs([self._scrape_song_data(tr)['song_id'] for tr in rows])
         entries = []
-        for tr in chart_table[0].findall('.//tbody/tr'):
-            entry = self._scrape_chart_row(tr, dry_run=dry_run)
+        for tr in rows:
+            entry = self._scrape_chart_row(tr, dry_run=dry_run, resolved=resolved)
             if entry:
                 entries.append(entry)
         return entries
 
-    def fetch_hourly(self, hour=None, dry_run=False, force_update=False):
-        if hour:
-            hour = strip_to_hour(hour)
-        else:
-            hour = strip_to_hour(utcnow())
-        if not force_update:
-            try:
-                chart = HourlySongChart.objects.get(chart=self.hourly_chart, hour=hour)
-                if chart and chart.entries.count() == 100 and not force_update:
-                    logger.info('Skipping fetch for existing bugs chart')
-                    return chart
-            except ObjectDoesNotExist:
-                pass
-            except MultipleObjectsReturned:
-                pass
-        bugs_data = self._get_hourly_chart(hour, dry_run=dry_run)
-        if len(bugs_data) != 100:
-            logger.warning('Bugs returned unexpected number of chart entries: {}'.format(len(bugs_data)))
-        logger.info('Fetched bugs realtime chart for {}'.format(hour))
-        if dry_run:
-            return bugs_data
-        (hourly_song_chart, created) = HourlySongChart.objects.get_or_create(chart=self.hourly_chart, hour=hour)
-        if not created and hourly_song_chart.entries.count() == 100:
-            logger.info('Skipping db update for existing bugs chart')
-            return hourly_song_chart
-        for song_data in bugs_data:
-            if song_data['song']:
-                defaults = {'position': song_data['position']}
-                (chart_entry, created) = HourlySongChartEntry.objects.get_or_create(
-                    hourly_chart=hourly_song_chart,
-                    song=song_data['song'],
-                    defaults=defaults
-                )
-                if not created and chart_entry.position != song_data['position']:
-                    chart_entry.position = song_data['position']
-                    chart_entry.save()
-                chart_entry.update_prev_position()
-        logger.info('Wrote bugs realtime chart for {} to database'.format(hour))
-        hourly_song_chart.update_next_chart()
-        return hourly_song_chart
-
 
 # Add chart services to process here
 CHART_SERVICES = {
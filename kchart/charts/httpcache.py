@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+'''Conditional GET and Cache-Control support for chart views
+
+Responses are validated against the chart hour and the time its cached chart
+last changed (see kchart.charts.chartcache.get_modified_key), so conditional
+requests are answered with 304 without querying the database or loading the
+chart itself.
+
+Charts for hours older than CHART_HTTP_IMMUTABLE_AGE hours are sent with long
+lived immutable caching, while recent hours and requests for the latest chart
+may only be cached for CHART_HTTP_MAX_AGE seconds.
+'''
+from __future__ import unicode_literals, absolute_import
+
+from collections import namedtuple
+from datetime import timedelta
+from functools import wraps
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+
+from .chartcache import get_modified_key, get_rendered_etag_key, local_cache
+from .utils import strip_to_hour, utcnow
+
+
+Validators = namedtuple('Validators', ['etag', 'last_modified', 'cache_control'])
+
+
+def get_cache_control(hour, latest=False, private=False):
+    '''Return the Cache-Control directives for a chart
+
+    :param datetime hour: The chart hour
+    :param bool latest: True if the request was for the latest chart rather than a specific hour
+    :param bool private: True if the response may only be cached by the client (i.e. it includes
+        per-user content), rather than by shared caches
+    :rtype: dict
+    '''
+    scope = 'private' if private else 'public'
+    if not latest and hour < strip_to_hour(utcnow()) - timedelta(hours=settings.CHART_HTTP_IMMUTABLE_AGE):
+        return {scope: True, 'max_age': settings.CHART_HTTP_IMMUTABLE_MAX_AGE, 'immutable': True}
+    return {scope: True, 'max_age': settings.CHART_HTTP_MAX_AGE}
+
+
+def get_validators(key, hour, variant, latest=False, private=False, rendered=False):
+    '''Return the validators for the chart cached under key
+
+    :param str key: The chart cache key
+    :param datetime hour: The chart hour
+    :param str variant: Distinguishes different representations served from the same URL
+    :param bool latest: True if the request was for the latest chart rather than a specific hour
+    :param bool private: True if the response includes per-user content
+    :param bool rendered: True if the response is the chart's pre-rendered body, which is validated
+        with the body's own ETag rather than one derived from the time the chart was cached
+    :returns: The validators, or None if the response should not be cached
+    :rtype: Validators
+    '''
+    keys = [get_modified_key(key)]
+    if rendered:
+        keys.append(get_rendered_etag_key(key))
+    values = cache.get_many(keys)
+    modified = values.get(get_modified_key(key))
+    # Other processes may keep serving their local copy of a changed chart
+    # for up to local_cache.ttl seconds, and that content must never be
+    # tagged with the new validators
+    if modified is None or time.time() - modified < local_cache.ttl:
+        return None
+    if rendered:
+        etag = values.get(get_rendered_etag_key(key))
+        if etag is None:
+            return None
+    else:
+        etag = '{}-{}-{:.6f}'.format(key, variant, modified)
+    return Validators(etag, int(modified), get_cache_control(hour, latest, private))
+
+
+def not_modified(request, validators):
+    '''Return True if the client's copy matches the specified validators'''
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return validators.etag in etags or '*' in etags
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        return if_modified_since is not None and validators.last_modified <= if_modified_since
+    return False
+
+
+def conditional(validators_func):
+    '''View decorator which adds validators and Cache-Control to successful responses
+
+    Conditional GET requests matching the validators are answered with 304
+    without calling the view.
+
+    :param callable validators_func: Called with the view arguments, and should return
+        Validators (or None if the response should not be cached)
+    '''
+    def decorator(func):
+        @wraps(func)
+        def inner(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return func(request, *args, **kwargs)
+            validators = validators_func(request, *args, **kwargs)
+            if validators is None:
+                return func(request, *args, **kwargs)
+            if not_modified(request, validators):
+                response = HttpResponseNotModified()
+            else:
+                response = func(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+            response['ETag'] = quote_etag(validators.etag)
+            response['Last-Modified'] = http_date(validators.last_modified)
+            patch_cache_control(response, **validators.cache_control)
+            return response
+        return inner
+    return decorator
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+'''Pooled keep-alive HTTP sessions for the chart services
+
+Each process keeps one requests Session per host, so that repeated requests
+to a chart service reuse their TCP/TLS connections. The number of concurrent
+requests to each host from a single process is capped at
+HTTP_CLIENT_HOST_CONCURRENCY. Sessions are recreated
+after a fork, since pooled connections must never be shared between (celery
+worker) processes.
+
+Request counts, errors and latencies are recorded per host, both for the
+current process (get_stats) and in the shared chartmetrics counters for the
+known chart service hosts.
+'''
+from __future__ import unicode_literals, absolute_import
+
+from collections import namedtuple
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.utils.six.moves.urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from . import metrics
+
+
+# Hosts with shared per-host counters, requests to any other host are
+# counted under 'other'
+STATS_HOSTS = (
+    'apis.skplanetx.com',
+    'www.melon.com',
+    'www.genie.co.kr',
+    'www.mnet.com',
+    'music.bugs.co.kr',
+    'www.bugs.co.kr',
+)
+
+HostCounters = namedtuple('HostCounters', ['requests', 'errors', 'ms'])
+
+
+def _register_host(host):
+    return HostCounters(
+        metrics.register('http-{}-requests'.format(host), 'HTTP requests to {}'.format(host)),
+        metrics.register('http-{}-errors'.format(host), 'Failed HTTP requests to {}'.format(host)),
+        metrics.register('http-{}-ms'.format(host), 'Total HTTP request time (ms) for {}'.format(host)),
+    )
+
+
+HOST_COUNTERS = dict((host, _register_host(host)) for host in STATS_HOSTS + ('other',))
+
+
+class HostStats(object):
+    '''Per-process request statistics for a single host'''
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    @property
+    def avg_time(self):
+        if not self.requests:
+            return 0.0
+        return self.total_time / self.requests
+
+    def __repr__(self):
+        return '<HostStats requests={} errors={} avg={:.3f}s max={:.3f}s>'.format(
+            self.requests, self.errors, self.avg_time, self.max_time)
+
+
+_lock = threading.Lock()
+_pid = None
+_sessions = {}
+_semaphores = {}
+_stats = {}
+_proxies = None
+
+
+def _reset_if_forked():
+    global _pid, _proxies
+    if _pid != os.getpid():
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        _semaphores.clear()
+        _stats.clear()
+        _proxies = None
+        _pid = os.getpid()
+
+
+def _create_session():
+    session = requests.Session()
+    retry = Retry(
+        total=settings.HTTP_CLIENT_RETRIES,
+        backoff_factor=settings.HTTP_CLIENT_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=settings.HTTP_CLIENT_POOL_SIZE,
+        max_retries=retry,
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session(url):
+    '''Return this process's pooled session for the host of the specified URL
+
+    :rtype: requests.Session
+    '''
+    host = urlsplit(url).netloc.lower()
+    with _lock:
+        _reset_if_forked()
+        session = _sessions.get(host)
+        if session is None:
+            session = _create_session()
+            _sessions[host] = session
+        return session
+
+
+def _get_semaphore(host):
+    with _lock:
+        _reset_if_forked()
+        semaphore = _semaphores.get(host)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(settings.HTTP_CLIENT_HOST_CONCURRENCY)
+            _semaphores[host] = semaphore
+        return semaphore
+
+
+def get_proxies():
+    '''Return the (cached) proxy configuration for scraper requests
+
+    :rtype: dict
+    '''
+    global _proxies
+    with _lock:
+        _reset_if_forked()
+        if _proxies is None:
+            if settings.REQUESTS_HTTP_PROXY:
+                _proxies = {'http': settings.REQUESTS_HTTP_PROXY, 'https': settings.REQUESTS_HTTP_PROXY}
+            else:
+                _proxies = {}
+        return _proxies
+
+
+def _record(host, elapsed, error):
+    with _lock:
+        stats = _stats.get(host)
+        if stats is None:
+            stats = _stats[host] = HostStats()
+        stats.requests += 1
+        stats.total_time += elapsed
+        stats.max_time = max(stats.max_time, elapsed)
+        if error:
+            stats.errors += 1
+    counters = HOST_COUNTERS.get(host, HOST_COUNTERS['other'])
+    metrics.incr(counters.requests)
+    metrics.incr(counters.ms, int(elapsed * 1000))
+    if error:
+        metrics.incr(counters.errors)
+
+
+def get(url, **kwargs):
+    '''Send a GET request using the pooled session for the URL's host
+
+    Takes the same arguments as requests.get
+
+    :rtype: requests.Response
+    '''
+    host = urlsplit(url).netloc.lower()
+    session = get_session(url)
+    with _get_semaphore(host):
+        start = time.time()
+        error = True
+        try:
+            r = session.get(url, **kwargs)
+            error = r.status_code >= 400
+            return r
+        finally:
+            _record(host, time.time() - start, error)
+
+
+def get_stats():
+    '''Return this process's per-host request statistics
+
+    :rtype: dict
+    '''
+    with _lock:
+        _reset_if_forked()
+        return dict(_stats)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+from datetime import datetime
+import pickle
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kchart.charts.chartcache import pack_aggregate_chart, unpack_aggregate_chart
+from kchart.charts.models import AggregateHourlySongChart
+from kchart.charts.utils import KR_TZ
+
+
+class Command(BaseCommand):
+
+    help = 'Compares the size and load time of the compact chart cache payload against a pickled model graph'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--hour', dest='hour', default=None,
+                            help='Chart hour to benchmark (YYYYMMDDHH KST), defaults to the latest chart')
+        parser.add_argument('--iterations', dest='iterations', type=int, default=100,
+                            help='Number of loads to time')
+
+    def handle(self, *args, **options):
+        if options['hour']:
+            try:
+                hour = KR_TZ.localize(datetime.strptime(options['hour'], '%Y%m%d%H'))
+            except ValueError:
+                raise CommandError('Invalid hour (expected YYYYMMDDHH KST): {}'.format(options['hour']))
+        else:
+            hour = AggregateHourlySongChart.objects.values_list('hour', flat=True).first()
+        try:
+            # This is the model graph which was previously pickled into the cache
+            chart = AggregateHourlySongChart.objects.prefetch_related(
+                'entries__song__album',
+                'entries__song__artists',
+                'charts__entries__song__album',
+                'charts__entries__song__artists',
+                'charts__chart__service',
+            ).get(hour=hour)
+        except AggregateHourlySongChart.DoesNotExist:
+            raise CommandError('No chart for {}'.format(hour))
+        iterations = options['iterations']
+        results = []
+
+        model_str = pickle.dumps(chart, pickle.HIGHEST_PROTOCOL)
+        model_time = timeit.timeit(lambda: pickle.loads(model_str), number=iterations)
+        results.append(('pickled models', len(model_str), model_time))
+
+        payload_str = pickle.dumps(pack_aggregate_chart(chart), pickle.HIGHEST_PROTOCOL)
+        payload_time = timeit.timeit(lambda: unpack_aggregate_chart(pickle.loads(payload_str)), number=iterations)
+        results.append(('compact payload', len(payload_str), payload_time))
+
+        self.stdout.write('Chart: {} ({} loads)'.format(chart, iterations))
+        for (name, size, elapsed) in results:
+            self.stdout.write('{:>16}: {:>10} bytes, {:>8.3f} ms/load'.format(
+                name, size, 1000.0 * elapsed / iterations))
+        self.stdout.write('Size ratio: {:.2f}x, load time ratio: {:.2f}x'.format(
+            float(len(model_str)) / len(payload_str), model_time / payload_time))
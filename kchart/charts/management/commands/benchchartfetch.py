@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from kchart.charts import httpclient
+from kchart.charts.asyncfetch import AiohttpTransport, AsyncChartFetcher, ThreadedTransport, aiohttp
+from kchart.charts.chartservice import ChartRequest
+
+
+class FakeChartServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, latency, body):
+        self.latency = latency
+        self.body = body
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeChartHandler)
+
+
+class FakeChartHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+
+    help = ('Benchmarks chart download throughput of the async ingestion engine against '
+            'the per-task (sequential) model, using a local fake HTTP server')
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--charts', dest='charts', type=int, default=24,
+                            help='Number of hourly charts to download')
+        parser.add_argument('--pages', dest='pages', type=int, default=2,
+                            help='Number of pages per chart')
+        parser.add_argument('--latency', dest='latency', type=float, default=0.2,
+                            help='Simulated server response time in seconds')
+        parser.add_argument('--size', dest='size', type=int, default=200 * 1024,
+                            help='Response body size in bytes')
+        parser.add_argument('--concurrency', dest='concurrency', type=int, default=16,
+                            help='Maximum number of requests in flight for the async engine')
+
+    def _report(self, name, requests, elapsed, baseline=None):
+        line = '{:>24}: {:>8.3f} s, {:>8.1f} requests/s'.format(name, elapsed, requests / elapsed)
+        if baseline:
+            line = '{}, {:.1f}x'.format(line, baseline / elapsed)
+        self.stdout.write(line)
+
+    def handle(self, *args, **options):
+        server = FakeChartServer(options['latency'], b'x' * options['size'])
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:{}/chart/'.format(server.server_address[1])
+            request_groups = [
+                [ChartRequest(url, {'chart': chart, 'pg': page}, {}, False) for page in range(1, options['pages'] + 1)]
+                for chart in range(options['charts'])
+            ]
+            total = options['charts'] * options['pages']
+            self.stdout.write('{} charts x {} pages, {:.3f}s latency, {} byte responses'.format(
+                options['charts'], options['pages'], options['latency'], options['size']))
+
+            # one chart at a time with blocking requests, as in a single
+            # update_hourly_chart worker slot
+            start = time.time()
+            for requests in request_groups:
+                for request in requests:
+                    r = httpclient.get(request.url, params=request.params)
+                    r.raise_for_status()
+            baseline = time.time() - start
+            self._report('per-task (sequential)', total, baseline)
+
+            # the fake server counts as a single host, so lift the per-host cap
+            transports = [('async (threaded)', ThreadedTransport)]
+            if aiohttp is not None:
+                transports.append(('async (aiohttp)', AiohttpTransport))
+            else:
+                self.stdout.write('aiohttp is not installed (workers fall back to the threaded transport), '
+                                  'skipping aiohttp transport')
+            for (name, transport_cls) in transports:
+                fetcher = AsyncChartFetcher(
+                    transport=transport_cls(),
+                    concurrency=options['concurrency'],
+                    host_concurrency=options['concurrency'],
+                )
+                start = time.time()
+                fetcher.download(request_groups)
+                self._report(name, total, time.time() - start, baseline)
+            self.stdout.write('Note: the threaded transport is also limited by HTTP_CLIENT_HOST_CONCURRENCY')
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+from django.core.management.base import BaseCommand
+
+from kchart.charts import catalog, metrics
+# import modules which register counters
+import kchart.charts.chartcache  # noqa
+import kchart.charts.httpclient  # noqa
+import kchart.charts.tasks  # noqa
+from kchart.charts.searchcache import get_hit_ratio
+
+
+class Command(BaseCommand):
+
+    help = 'Displays chart cache and ingestion counters'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--reset', dest='reset', action='store_true',
+                            help='Reset all counters after displaying them')
+
+    def handle(self, *args, **options):
+        for (name, value) in metrics.get_counters().items():
+            self.stdout.write('{:>32}: {:>10}  ({})'.format(name, value, metrics.COUNTERS[name]))
+        hit_ratio = get_hit_ratio()
+        if hit_ratio is not None:
+            self.stdout.write('{:>32}: {:>10.1%}'.format('melon-search-hit-ratio', hit_ratio))
+        catalog_stats = catalog.get_stats()
+        if catalog_stats is not None:
+            self.stdout.write('{:>32}: {:>10.1%}'.format('catalog-resolve-rate', catalog_stats['resolve_rate']))
+            self.stdout.write('{:>32}: {:>10}  (estimated)'.format('catalog-saved-ms', catalog_stats['saved_ms']))
+        if options['reset']:
+            metrics.reset()
+            self.stdout.write('Counters reset')
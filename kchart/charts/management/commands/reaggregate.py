@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kchart.charts.tasks import aggregate_all_hourly_charts, get_reaggregation_progress
+
+
+class Command(BaseCommand):
+
+    help = 'Starts a full re-aggregation of all hourly charts, or displays the progress of one'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--range-size', dest='range_size', type=int, default=24 * 7,
+                            help='Number of hours re-aggregated by each task')
+        parser.add_argument('--status', dest='status', metavar='RUN_ID',
+                            help='Display the progress of an existing re-aggregation run')
+
+    def handle(self, *args, **options):
+        if options['status']:
+            progress = get_reaggregation_progress(options['status'])
+            if progress is None:
+                raise CommandError('Unknown re-aggregation run: {}'.format(options['status']))
+            self.stdout.write('{ranges_done}/{ranges} ranges, {hours_done} hours aggregated'.format(**progress))
+            for (start, end) in progress['failed']:
+                self.stderr.write('Failed to aggregate {} to {}'.format(start, end))
+            if progress['finished']:
+                self.stdout.write('Finished')
+            return
+        if options['range_size'] < 1:
+            raise CommandError('--range-size must be positive')
+        # only splits the history and queues the range tasks
+        run_id = aggregate_all_hourly_charts(range_size=options['range_size'])
+        self.stdout.write('Started re-aggregation {}'.format(run_id))
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+from django.core.management.base import BaseCommand
+
+from kchart.charts.models import ChartStats
+
+
+class Command(BaseCommand):
+
+    help = 'Rebuilds site statistics and first chart hours for songs, albums and artists from scratch'
+
+    def handle(self, *args, **options):
+        stats = ChartStats.rebuild()
+        self.stdout.write('{} songs, {} artists, {} albums charted'.format(
+            stats.song_count, stats.artist_count, stats.album_count))
+        for (slug, hour) in sorted(stats.get_first_hours().items()):
+            self.stdout.write('{}: first chart hour {}'.format(slug, hour))
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kchart.charts.chartservice import CHART_SERVICES
+from kchart.charts.models import Song, SongChartSummary
+
+
+class Command(BaseCommand):
+
+    help = 'Rebuilds song chart summaries for the specified charts'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--aggregate', dest='aggregate', action='store_true',
+                            help='Rebuild aggregated chart summaries')
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=1000,
+                            help='Number of songs to rebuild per statement')
+        parser.add_argument('chart', nargs='*')
+
+    def _rebuild(self, name, service, song_ids, chunk_size):
+        written = 0
+        for i in range(0, len(song_ids), chunk_size):
+            chunk = song_ids[i:i + chunk_size]
+            written += SongChartSummary.rebuild(service, song_ids=chunk)
+            self.stdout.write('{}: {}/{} songs processed, {} summaries written'.format(
+                name, i + len(chunk), len(song_ids), written))
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+        for chart in options['chart']:
+            if chart not in CHART_SERVICES:
+                raise CommandError('Unknown chart: {}'.format(chart))
+        song_ids = list(Song.objects.order_by('pk').values_list('pk', flat=True))
+        for chart in options['chart']:
+            service = CHART_SERVICES[chart.lower()]()
+            self._rebuild(chart, service.service, song_ids, options['chunk_size'])
+        if options['aggregate']:
+            self._rebuild('aggregate', None, song_ids, options['chunk_size'])
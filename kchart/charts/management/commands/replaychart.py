@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, connection, transaction
+
+from kchart.charts.chartservice import CHART_SERVICES
+from kchart.charts.models import (
+    AggregateHourlySongChart,
+    HourlySongChart,
+    HourlySongChartEntry,
+    HourlySongChartSnapshot,
+)
+from kchart.charts.utils import KR_TZ
+
+
+def parse_hour(value):
+    try:
+        return KR_TZ.localize(datetime.strptime(value, '%Y%m%d%H'))
+    except ValueError:
+        raise CommandError('Invalid hour (expected YYYYMMDDHH in KST): {}'.format(value))
+
+
+class Command(BaseCommand):
+
+    help = ('Re-parses archived hourly chart snapshots and writes the results to the database, '
+            'without downloading the charts again')
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                            help='Parse snapshots but do not write chart updates to the database')
+        parser.add_argument('--aggregate', dest='aggregate', action='store_true',
+                            help='(Re)generate aggregated charts for the replayed hours')
+        parser.add_argument('--start', dest='start', type=parse_hour,
+                            help='First hour to replay (YYYYMMDDHH in KST), defaults to the earliest snapshot')
+        parser.add_argument('--end', dest='end', type=parse_hour,
+                            help='Last hour to replay (YYYYMMDDHH in KST), defaults to the latest snapshot')
+        parser.add_argument('--workers', dest='workers', type=int, default=4,
+                            help='Number of snapshots to replay in parallel')
+        parser.add_argument('chart', nargs='*')
+
+    def _replay(self, service, snapshot_id, dry_run):
+        '''Replay a single snapshot, returns the replayed chart hour'''
+        try:
+            snapshot = HourlySongChartSnapshot.objects.get(pk=snapshot_id)
+            if dry_run:
+                (hour, entries) = service._parse_hourly_chart_responses(snapshot.hour, snapshot.texts, dry_run=True)
+                return hour
+            # songs matched for the first time may be created concurrently by
+            # another worker, so each snapshot is replayed in a transaction
+            # that can be retried on its own
+            with transaction.atomic():
+                (hour, entries) = service._parse_hourly_chart_responses(snapshot.hour, snapshot.texts)
+                hourly_chart = service._write_hourly_chart(hour, entries, force_update=True)
+            HourlySongChart.invalidate_cached_chart(hourly_chart.chart_id, hourly_chart.hour)
+            return hour
+        finally:
+            connection.close()
+
+    def _replay_chart(self, name, service, snapshot_ids, options):
+        hours = set()
+        retry = []
+        failed = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            futures = dict(
+                (executor.submit(self._replay, service, snapshot_id, options['dry_run']), snapshot_id)
+                for snapshot_id in snapshot_ids
+            )
+            for (i, future) in enumerate(as_completed(futures)):
+                try:
+                    hours.add(future.result())
+                except IntegrityError:
+                    retry.append(futures[future])
+                except Exception as exc:
+                    failed += 1
+                    self.stderr.write('{}: failed to replay snapshot {}: {}'.format(name, futures[future], exc))
+                if (i + 1) % 100 == 0:
+                    self.stdout.write('{}: {}/{} snapshots processed'.format(name, i + 1, len(snapshot_ids)))
+        for snapshot_id in retry:
+            try:
+                hours.add(self._replay(service, snapshot_id, options['dry_run']))
+            except Exception as exc:
+                failed += 1
+                self.stderr.write('{}: failed to replay snapshot {}: {}'.format(name, snapshot_id, exc))
+        self.stdout.write('{}: {} hours replayed, {} snapshots failed'.format(name, len(hours), failed))
+        return hours
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be positive')
+        for chart in options['chart']:
+            if chart not in CHART_SERVICES:
+                raise CommandError('Unknown chart: {}'.format(chart))
+        replayed = set()
+        for chart in options['chart']:
+            service = CHART_SERVICES[chart.lower()]()
+            snapshot_ids = HourlySongChartSnapshot.get_latest_ids(
+                service.hourly_chart,
+                start=options['start'],
+                end=options['end']
+            )
+            hours = self._replay_chart(chart, service, snapshot_ids, options)
+            if options['dry_run'] or not hours:
+                continue
+            # hours replayed in parallel may have been written before their
+            # previous hour, so fix prev positions for the whole range at once
+            HourlySongChartEntry.recompute_prev_positions_in_range(
+                start=min(hours),
+                end=max(hours),
+                chart_filter={'chart': service.hourly_chart}
+            )
+            for hour in hours:
+                HourlySongChart.invalidate_cached_chart(service.hourly_chart.pk, hour)
+            replayed.update(hours)
+        if options['aggregate']:
+            for hour in sorted(replayed):
+                AggregateHourlySongChart.generate(hour=hour, regenerate=True)
@@ -3,6 +3,7 @@ from __future__ import unicode_literals, absolute_import
 
 from django.core.management.base import BaseCommand, CommandError
 
+from kchart.charts.asyncfetch import AsyncChartFetcher, ThreadedTransport, default_transport
 from kchart.charts.chartservice import CHART_SERVICES
 from kchart.charts.models import AggregateHourlySongChart
 
@@ -17,13 +18,29 @@ class Command(BaseCommand):
                             help='Do not write chart updates to the database')
         parser.add_argument('--aggregate', dest='aggregate', action='store_true',
                             help='(Re)generate aggregated chart after update')
+        parser.add_argument('--async', dest='async', action='store_true',
+                            help='Fetch all of the specified charts concurrently')
         parser.add_argument('chart', nargs='*')
 
     def handle(self, *args, **options):
+        services = []
         for chart in options['chart']:
             if chart not in CHART_SERVICES:
                 raise CommandError('Unknown chart: {}'.format(chart))
-            service = CHART_SERVICES[chart.lower()]()
-            service.fetch_hourly(dry_run=options['dry_run'])
+            services.append(CHART_SERVICES[chart.lower()]())
+        if options['async']:
+            transport = default_transport()
+            if isinstance(transport, ThreadedTransport):
+                self.stdout.write('aiohttp is not installed, falling back to the threaded transport')
+            else:
+                self.stdout.write('Fetching with {}'.format(type(transport).__name__))
+            results = AsyncChartFetcher(transport=transport).fetch([(service, None) for service in services],
+                                                                   dry_run=options['dry_run'])
+            for result in results:
+                if result.error is not None:
+                    self.stderr.write('Failed to update {}: {}'.format(result.slug, result.error))
+        else:
+            for service in services:
+                service.fetch_hourly(dry_run=options['dry_run'])
         if options['aggregate']:
             AggregateHourlySongChart.generate(regenerate=True)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kchart.charts.chartservice import CHART_SERVICES
+from kchart.charts.models import AggregateHourlySongChartEntry, HourlySongChartEntry
+from kchart.charts.utils import KR_TZ
+
+
+def parse_hour(hour_str):
+    try:
+        return KR_TZ.localize(datetime.strptime(hour_str, '%Y%m%d%H'))
+    except ValueError:
+        raise CommandError('Invalid hour (expected YYYYMMDDHH KST): {}'.format(hour_str))
+
+
+class Command(BaseCommand):
+
+    help = 'Recomputes previous chart positions for the specified charts'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--aggregate', dest='aggregate', action='store_true',
+                            help='Recompute aggregated chart entries')
+        parser.add_argument('--start', dest='start', default=None,
+                            help='First hour to update (YYYYMMDDHH KST), defaults to the earliest chart')
+        parser.add_argument('--end', dest='end', default=None,
+                            help='Last hour to update (YYYYMMDDHH KST), defaults to the latest chart')
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=24,
+                            help='Number of hourly charts to update per statement')
+        parser.add_argument('chart', nargs='*')
+
+    def _progress(self, name):
+        def callback(done, total, updated):
+            self.stdout.write('{}: {}/{} charts processed, {} entries updated'.format(name, done, total, updated))
+        return callback
+
+    def handle(self, *args, **options):
+        start = parse_hour(options['start']) if options['start'] else None
+        end = parse_hour(options['end']) if options['end'] else None
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+        for chart in options['chart']:
+            if chart not in CHART_SERVICES:
+                raise CommandError('Unknown chart: {}'.format(chart))
+        for chart in options['chart']:
+            service = CHART_SERVICES[chart.lower()]()
+            HourlySongChartEntry.recompute_prev_positions_in_range(
+                start=start,
+                end=end,
+                chunk_size=options['chunk_size'],
+                chart_filter={'chart': service.hourly_chart},
+                callback=self._progress(chart),
+            )
+        if options['aggregate']:
+            AggregateHourlySongChartEntry.recompute_prev_positions_in_range(
+                start=start,
+                end=end,
+                chunk_size=options['chunk_size'],
+                callback=self._progress('aggregate'),
+            )
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+'''Simple counters shared between processes through the django cache
+
+Counters must be registered with a description so that they can be listed by
+the chartmetrics management command.
+'''
+from __future__ import unicode_literals, absolute_import
+
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+
+KEY_PREFIX = 'metrics-'
+
+COUNTERS = OrderedDict()
+
+
+def register(name, description):
+    '''Register a counter
+
+    :param str name: The counter name
+    :param str description: Human readable counter description
+    :returns: The counter name
+    '''
+    COUNTERS[name] = description
+    return name
+
+
+def _key(name):
+    return '{}{}'.format(KEY_PREFIX, name)
+
+
+def incr(name, delta=1):
+    '''Increment the specified counter by delta'''
+    key = _key(name)
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        if not cache.add(key, delta, None):
+            cache.incr(key, delta)
+
+
+def get_counters(names=None):
+    '''Return the current values of the specified counters
+
+    :param list names: Counter names, defaults to all registered counters
+    :rtype: OrderedDict
+    '''
+    if names is None:
+        names = list(COUNTERS)
+    values = cache.get_many([_key(name) for name in names])
+    return OrderedDict((name, values.get(_key(name), 0)) for name in names)
+
+
+def reset(names=None):
+    '''Reset the specified counters (defaults to all registered counters)'''
+    if names is None:
+        names = list(COUNTERS)
+    cache.delete_many([_key(name) for name in names])
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charts', '0011_auto_20160626_1321'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SongChartSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('initial_position', models.SmallIntegerField(verbose_name='Initial chart position')),
+                ('initial_timestamp', models.DateTimeField(verbose_name='Initial chart hour')),
+                ('peak_position', models.SmallIntegerField(verbose_name='Peak chart position')),
+                ('peak_timestamp', models.DateTimeField(verbose_name='Peak chart hour')),
+                ('final_position', models.SmallIntegerField(verbose_name='Final chart position')),
+                ('final_timestamp', models.DateTimeField(verbose_name='Final chart hour')),
+                ('service', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='charts.MusicService')),
+                ('song', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chart_summaries', to='charts.Song')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='songchartsummary',
+            unique_together=set([('song', 'service')]),
+        ),
+    ]
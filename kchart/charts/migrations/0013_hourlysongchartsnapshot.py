@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charts', '0012_songchartsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HourlySongChartSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField(verbose_name='Chart start hour')),
+                ('fetched', models.DateTimeField(auto_now_add=True, verbose_name='Time the chart was fetched')),
+                ('data', models.BinaryField(verbose_name='gzip compressed JSON list of response bodies')),
+                ('chart', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='charts.Chart')),
+            ],
+            options={
+                'ordering': ['-hour', 'chart', '-fetched'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='hourlysongchartsnapshot',
+            index_together=set([('chart', 'hour')]),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+
+from django.db import migrations, models
+
+
+BATCH_SIZE = 1000
+
+
+# A copy of kchart.charts.utils.normalize_name at the time of this migration
+def normalize_name(name):
+    name = re.sub('[₩]', '￦', name)
+    name = re.sub('[\'"`‘]', '', name)
+    return re.sub(r'[\W_]+', '', name.lower())
+
+
+def _update_batch(schema_editor, table, batch):
+    values = ', '.join(['(%s, %s)'] * len(batch))
+    params = []
+    for (pk, normalized_name) in batch:
+        params.extend([pk, normalized_name])
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            '''
+            UPDATE {table} AS t SET normalized_name = v.normalized_name
+            FROM (VALUES {values}) AS v (id, normalized_name)
+            WHERE t.id = v.id
+            '''.format(table=table, values=values),
+            params
+        )
+
+
+def normalize_names(apps, schema_editor):
+    for model_name in ('Artist', 'Album', 'Song'):
+        model = apps.get_model('charts', model_name)
+        table = model._meta.db_table
+        batch = []
+        for (pk, name) in model.objects.order_by('pk').values_list('pk', 'name').iterator():
+            batch.append((pk, normalize_name(name)[:255]))
+            if len(batch) == BATCH_SIZE:
+                _update_batch(schema_editor, table, batch)
+                batch = []
+        if batch:
+            _update_batch(schema_editor, table, batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charts', '0013_hourlysongchartsnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='normalized_name',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=255, verbose_name='Normalized name'),
+        ),
+        migrations.AddField(
+            model_name='artist',
+            name='normalized_name',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=255, verbose_name='Normalized name'),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='normalized_name',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=255, verbose_name='Normalized name'),
+        ),
+        migrations.RunPython(normalize_names, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charts', '0014_normalized_names'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hourlysongchart',
+            name='entry_count',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Number of entries'),
+        ),
+        migrations.RunSQL(
+            '''
+            UPDATE charts_hourlysongchart h
+            SET entry_count = c.entry_count
+            FROM (
+                SELECT hourly_chart_id, COUNT(*) AS entry_count
+                FROM charts_hourlysongchartentry
+                GROUP BY hourly_chart_id
+            ) c
+            WHERE c.hourly_chart_id = h.id
+            ''',
+            migrations.RunSQL.noop
+        ),
+        migrations.RunSQL(
+            '''
+            CREATE INDEX charts_hourlysongchart_incomplete
+            ON charts_hourlysongchart (chart_id, hour)
+            WHERE entry_count < 100
+            ''',
+            'DROP INDEX charts_hourlysongchart_incomplete'
+        ),
+    ]
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charts', '0015_hourlysongchart_entry_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChartStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('song_count', models.PositiveIntegerField(default=0, verbose_name='Charted songs')),
+                ('artist_count', models.PositiveIntegerField(default=0, verbose_name='Charted artists')),
+                ('album_count', models.PositiveIntegerField(default=0, verbose_name='Charted albums')),
+                ('first_hours', models.TextField(default='{}', verbose_name='First chart hour for each service')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='album',
+            name='first_charted',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='First chart hour'),
+        ),
+        migrations.AddField(
+            model_name='artist',
+            name='first_charted',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='First chart hour'),
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='first_charted',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='First chart hour'),
+        ),
+        # same as ChartStats.rebuild
+        migrations.RunSQL(
+            '''
+            UPDATE charts_song AS s SET first_charted = f.hour
+            FROM (
+                SELECT e.song_id, MIN(c.hour) AS hour
+                FROM charts_hourlysongchartentry AS e
+                INNER JOIN charts_hourlysongchart AS c ON c.id = e.hourly_chart_id
+                GROUP BY e.song_id
+            ) AS f
+            WHERE s.id = f.song_id
+            ''',
+            migrations.RunSQL.noop
+        ),
+        migrations.RunSQL(
+            '''
+            UPDATE charts_album AS a SET first_charted = f.hour
+            FROM (
+                SELECT album_id, MIN(first_charted) AS hour
+                FROM charts_song
+                WHERE first_charted IS NOT NULL
+                GROUP BY album_id
+            ) AS f
+            WHERE a.id = f.album_id
+            ''',
+            migrations.RunSQL.noop
+        ),
+        migrations.RunSQL(
+            '''
+            UPDATE charts_artist AS a SET first_charted = f.hour
+            FROM (
+                SELECT sa.artist_id, MIN(s.first_charted) AS hour
+                FROM charts_song_artists AS sa
+                INNER JOIN charts_song AS s ON s.id = sa.song_id
+                WHERE s.first_charted IS NOT NULL
+                GROUP BY sa.artist_id
+            ) AS f
+            WHERE a.id = f.artist_id
+            ''',
+            migrations.RunSQL.noop
+        ),
+        migrations.RunSQL(
+            '''
+            INSERT INTO charts_chartstats (id, song_count, artist_count, album_count, first_hours)
+            SELECT
+                1,
+                (SELECT COUNT(*) FROM charts_song WHERE first_charted IS NOT NULL),
+                (SELECT COUNT(*) FROM charts_artist WHERE first_charted IS NOT NULL),
+                (SELECT COUNT(*) FROM charts_album WHERE first_charted IS NOT NULL),
+                COALESCE((
+                    SELECT json_object_agg(slug, first_hour)::text
+                    FROM (
+                        SELECT s.slug, EXTRACT(EPOCH FROM MIN(h.hour))::bigint AS first_hour
+                        FROM charts_hourlysongchart AS h
+                        INNER JOIN charts_chart AS c ON c.id = h.chart_id
+                        INNER JOIN charts_musicservice AS s ON s.id = c.service_id
+                        GROUP BY s.slug
+                    ) AS f
+                ), '{}')
+            ''',
+            migrations.RunSQL.noop
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    '''Make aggregate chart summaries (with no service) unique by song
+
+    NULL services are distinct in the (song, service) unique constraint.
+    Duplicate aggregate summaries are removed first, run rebuildsummaries
+    --aggregate afterwards to recompute the remaining ones.
+    '''
+
+    dependencies = [
+        ('charts', '0016_chartstats'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            '''
+            DELETE FROM charts_songchartsummary s
+            USING charts_songchartsummary d
+            WHERE s.service_id IS NULL AND d.service_id IS NULL AND s.song_id = d.song_id AND s.id > d.id
+            ''',
+            migrations.RunSQL.noop
+        ),
+        migrations.RunSQL(
+            '''
+            CREATE UNIQUE INDEX charts_songchartsummary_aggregate_song
+            ON charts_songchartsummary (song_id)
+            WHERE service_id IS NULL
+            ''',
+            'DROP INDEX charts_songchartsummary_aggregate_song'
+        ),
+    ]
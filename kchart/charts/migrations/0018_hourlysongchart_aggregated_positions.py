@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charts', '0017_songchartsummary_aggregate_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hourlysongchart',
+            name='aggregated_positions',
+            field=models.TextField(editable=False, null=True, verbose_name='Positions included in the aggregate chart'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('charts', '0018_hourlysongchart_aggregated_positions'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='songchartsummary',
+            index_together=set([
+                ('service', 'initial_timestamp'),
+                ('service', 'peak_timestamp'),
+                ('service', 'final_timestamp'),
+            ]),
+        ),
+    ]
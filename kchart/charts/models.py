@@ -2,36 +2,90 @@
 from __future__ import unicode_literals, absolute_import
 
 from datetime import timedelta
-import pickle
+import gzip
+import json
+import time
 
+from django.conf import settings
 from django.core.cache import cache
-from django.db import models
+from django.db import connection, models, transaction
 from django.db.models import (
+    Avg,
     ExpressionWrapper,
     F,
+    Func,
     Min,
+    Prefetch,
     Sum,
 )
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils.translation import ugettext_lazy as _
 
-from .utils import utcnow, strip_to_hour, KR_TZ
+from .chartcache import (
+    CHART_ENTRY_LIMIT,
+    EPOCH,
+    SCHEMA_VERSION,
+    RenderedChart,
+    advance_latest_hour,
+    bump_generation,
+    get_cached,
+    get_cached_latest_hour,
+    get_modified_key,
+    get_rendered_etag_key,
+    get_rendered_key,
+    local_cache,
+    rebuild_once,
+    render_json,
+    pack_aggregate_chart,
+    pack_hourly_chart,
+    unpack_aggregate_chart,
+    unpack_hourly_chart,
+)
+from .utils import utcnow, strip_to_hour, normalize_name, KR_TZ
+
+
+class KRDate(Func):
+    '''Truncate a timestamp to its (KST) date in the database'''
+
+    template = "(%(expressions)s AT TIME ZONE 'Asia/Seoul')::date"
+
+    def __init__(self, expression, **extra):
+        super(KRDate, self).__init__(expression, output_field=models.DateField(), **extra)
+
+
+class NormalizedNameModel(models.Model):
+    '''Abstract model with an indexed normalized copy of its name
+
+    See kchart.charts.utils.normalize_name
+    '''
+
+    normalized_name = models.CharField(_('Normalized name'), blank=True, max_length=255, db_index=True,
+                                       editable=False)
 
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        self.normalized_name = normalize_name(self.name)[:255]
+        super(NormalizedNameModel, self).save(*args, **kwargs)
 
-class Artist(models.Model):
+
+class Artist(NormalizedNameModel):
 
     name = models.CharField(_('Artist name'), blank=True, max_length=255)
     debut_date = models.DateField(_('Artist debut date'), null=True)
+    first_charted = models.DateTimeField(_('First chart hour'), null=True, editable=False)
 
     def __str__(self):
         return self.name
 
 
-class Album(models.Model):
+class Album(NormalizedNameModel):
 
     name = models.CharField(_('Album name'), blank=True, max_length=255)
     artists = models.ManyToManyField(Artist, related_name='albums')
     release_date = models.DateField(_('Album release date'))
+    first_charted = models.DateTimeField(_('First chart hour'), null=True, editable=False)
 
     def __str__(self):
         artist_names = []
@@ -40,12 +94,13 @@ class Album(models.Model):
         return '{} - {}'.format(', '.join(artist_names), self.name)
 
 
-class Song(models.Model):
+class Song(NormalizedNameModel):
 
     name = models.CharField(_('Song name'), blank=True, max_length=255)
     artists = models.ManyToManyField(Artist, related_name='songs')
     album = models.ForeignKey(Album, on_delete=models.PROTECT, related_name='songs')
     release_date = models.DateField(_('Song release date'))
+    first_charted = models.DateTimeField(_('First chart hour'), null=True, editable=False)
 
     def __str__(self):
         return '{} - {}'.format(self.artist_names, self.name)
@@ -111,37 +166,93 @@ class Song(models.Model):
             raise Song.HasNotCharted()
 
     def get_realtime_details(self, service=None):
+        '''Return realtime chart details for this song from its chart summary
+
+        :param MusicService service: The service to return details for, or None for the aggregate chart
+        '''
         try:
-            details = {'has_charted': True}
-            (initial_position, initial_timestamp) = self.get_initial_realtime_position(service)
-            (peak_position, peak_timestamp) = self.get_peak_realtime_position(service)
-            current_position = self.get_current_realtime_position(service)
-            details['initial_position'] = initial_position
-            details['initial_timestamp'] = initial_timestamp
-            details['peak_position'] = peak_position
-            details['peak_timestamp'] = peak_timestamp
-            details['current_position'] = current_position
-            if not current_position:
-                (final_position, final_timestamp) = self.get_final_realtime_position(service)
-                details['final_position'] = final_position
-                details['final_timestamp'] = final_timestamp
-            return details
-        except Song.HasNotCharted:
+            summary = SongChartSummary.objects.get(song=self, service=service)
+        except SongChartSummary.DoesNotExist:
             return {'has_charted': False}
+        return summary.get_details()
+
+    def get_chart_details(self, include_service_slugs=[], services=None):
+        '''Return chart details for this song
 
-    def get_chart_details(self, include_service_slugs=[]):
+        chart_summaries may be prefetched when fetching details for many songs.
+
+        :param list include_service_slugs: Slugs of the services to include details for
+        :param list services: Already fetched MusicService objects for include_service_slugs
+        '''
+        summaries = {}
+        for summary in self.chart_summaries.all():
+            summaries[summary.service_id] = summary
         realtime_details = {
-            'kchart': self.get_realtime_details(),
+            'kchart': SongChartSummary.get_details_for(summaries.get(None)),
         }
-        for slug in include_service_slugs:
-            try:
-                service = MusicService.objects.get(slug=slug)
-                realtime_details[slug] = self.get_realtime_details(service)
-            except MusicService.DoesNotExist:
-                # ignore invalid query params
-                pass
+        if services is None and include_service_slugs:
+            services = MusicService.objects.filter(slug__in=include_service_slugs)
+        # invalid query params are ignored
+        for service in services or []:
+            realtime_details[service.slug] = SongChartSummary.get_details_for(summaries.get(service.pk))
         return {'realtime': realtime_details}
 
+    def get_position_history(self, start, end, resolution='hour', services=[]):
+        '''Return this song's realtime chart position series
+
+        Series are downsampled in the database. Daily resolutions group hours by
+        their KST date and use either the best (lowest) or the average position
+        for each day.
+
+        :param datetime start: The (inclusive) first hour
+        :param datetime end: The (inclusive) last hour
+        :param str resolution: One of HISTORY_RESOLUTIONS
+        :param list services: The MusicService objects to include series for, in addition to
+            the aggregate chart
+        :returns: A dict mapping chart slugs ('kchart' for the aggregate chart) to lists of
+            (hour or date, position) tuples
+        :rtype: dict
+        '''
+        if resolution not in self.HISTORY_RESOLUTIONS:
+            raise ValueError('Invalid resolution: {}'.format(resolution))
+        querysets = [
+            ('kchart', AggregateHourlySongChartEntry.objects.all()),
+        ]
+        if services:
+            querysets.append((
+                'hourly_chart__chart__service__slug',
+                HourlySongChartEntry.objects.filter(hourly_chart__chart__service__in=services),
+            ))
+        history = {'kchart': []}
+        for service in services:
+            history[service.slug] = []
+        for (slug_field, q) in querysets:
+            q = q.filter(
+                song=self,
+                position__lte=100,
+                hourly_chart__hour__gte=start,
+                hourly_chart__hour__lte=end,
+            )
+            fields = [] if slug_field == 'kchart' else [slug_field]
+            if resolution == 'hour':
+                rows = q.values(*(fields + ['hourly_chart__hour', 'position'])).order_by('hourly_chart__hour')
+                (key_field, value_field) = ('hourly_chart__hour', 'position')
+            else:
+                if resolution == 'day_best':
+                    value = Min('position')
+                else:
+                    value = Avg('position')
+                rows = q.annotate(
+                    date=KRDate('hourly_chart__hour')
+                ).values(*(fields + ['date'])).annotate(value=value).order_by('date')
+                (key_field, value_field) = ('date', 'value')
+            for row in rows:
+                slug = row[slug_field] if fields else 'kchart'
+                history[slug].append((row[key_field], row[value_field]))
+        return history
+
+    HISTORY_RESOLUTIONS = ('hour', 'day_best', 'day_avg')
+
     class HasNotCharted(Exception):
         pass
 
@@ -241,11 +352,33 @@ class Chart(models.Model):
     def slug(self):
         return self.service.slug
 
+    @classmethod
+    def get_id_for_slug(cls, slug):
+        '''Return the id of the specified music service's chart, avoiding a query when possible
+
+        :rtype: int
+        '''
+        key = 'charts-chart-id-{}'.format(slug)
+        chart_id = cache.get(key)
+        if chart_id is None:
+            chart_id = cls.objects.filter(service__slug=slug).order_by('pk').values_list('pk', flat=True).first()
+            if chart_id:
+                cache.set(key, chart_id, 60 * 60)
+        return chart_id
+
 
 class HourlySongChart(models.Model):
 
     chart = models.ForeignKey(Chart, on_delete=models.CASCADE)
     hour = models.DateTimeField(_('Chart start hour'))
+    # maintained by write_entries, incomplete charts (fewer than 100 entries)
+    # are covered by a partial index (see migration 0015)
+    entry_count = models.PositiveSmallIntegerField(_('Number of entries'), default=0, editable=False)
+    # JSON list of the (song id, position) pairs the hour's aggregate chart was
+    # built from, recorded by write_entries until the aggregate chart has
+    # been updated (see AggregateHourlySongChart.update_for_hour)
+    aggregated_positions = models.TextField(_('Positions included in the aggregate chart'), null=True,
+                                            editable=False)
 
     def __str__(self):
         return '{} <{}>'.format(self.chart.name, self.hour.astimezone(KR_TZ).strftime('%Y.%m.%d-%H'))
@@ -254,14 +387,182 @@ class HourlySongChart(models.Model):
         unique_together = ('chart', 'hour')
         ordering = ['-hour', 'chart']
 
+    @property
+    def is_complete(self):
+        return self.entry_count == 100
+
+    def get_aggregated_positions(self):
+        '''Return the positions the aggregate chart was built from, or None if it includes the current entries
+
+        :returns: {<song id>: <position>}
+        :rtype: dict
+        '''
+        if self.aggregated_positions is None:
+            return None
+        return dict(json.loads(self.aggregated_positions))
+
     def update_next_chart(self):
         try:
             next_chart = HourlySongChart.objects.get(chart=self.chart, hour=self.hour + timedelta(hours=1))
-            for entry in next_chart.entries.all():
-                entry.update_prev_position()
+            HourlySongChartEntry.recompute_prev_positions([next_chart.pk])
+            self.invalidate_cached_chart(self.chart_id, next_chart.hour)
         except HourlySongChart.DoesNotExist:
             pass
 
+    def write_entries(self, positions):
+        '''Replace this chart's entries in bulk
+
+        prev_position is recomputed for this chart and the next hour's chart
+        with a single set-based statement, and entry_count is updated. Unless
+        earlier changes are still pending, the previous entries are recorded
+        for the next aggregate chart update. Cached charts are not invalidated.
+
+        :param positions: An iterable of (song_id, position) pairs. If a song
+            appears more than once its last position is used.
+        '''
+        positions = dict(positions)
+        entries = [
+            HourlySongChartEntry(hourly_chart=self, song_id=song_id, position=position)
+            for (song_id, position) in sorted(positions.items(), key=lambda item: item[1])
+        ]
+        chart_ids = [self.pk]
+        chart_ids.extend(HourlySongChart.objects.filter(
+            chart_id=self.chart_id,
+            hour=self.hour + timedelta(hours=1)
+        ).values_list('pk', flat=True))
+        with transaction.atomic():
+            aggregated_positions = HourlySongChart.objects.select_for_update().filter(
+                pk=self.pk
+            ).values_list('aggregated_positions', flat=True).first()
+            if aggregated_positions is None:
+                aggregated_positions = json.dumps(list(self.entries.values_list('song_id', 'position')))
+            self.entries.all().delete()
+            HourlySongChartEntry.objects.bulk_create(entries)
+            HourlySongChartEntry.recompute_prev_positions(chart_ids)
+            self.entry_count = len(entries)
+            self.aggregated_positions = aggregated_positions
+            self.save(update_fields=['entry_count', 'aggregated_positions'])
+
+    @classmethod
+    def find_gaps(cls, chart_ids, start, end):
+        '''Find the hours from start to end (inclusive) which are missing for each chart
+
+        All charts are checked with a single generate_series anti-join, and
+        consecutive missing hours are grouped into ranges.
+
+        :param list chart_ids: Chart ids to check
+        :param datetime start: The first hour to check
+        :param datetime end: The last hour to check
+        :returns: A list of (chart_id, first_hour, last_hour) ranges, latest ranges first
+        :rtype: list
+        '''
+        chart_ids = list(chart_ids)
+        if not chart_ids:
+            return []
+        sql = '''
+            WITH missing AS (
+                SELECT c.id AS chart_id, s.hour
+                FROM {chart_table} AS c
+                CROSS JOIN generate_series(%s::timestamptz, %s::timestamptz, interval '1 hour') AS s (hour)
+                WHERE c.id = ANY(%s) AND NOT EXISTS (
+                    SELECT 1 FROM {hourly_chart_table} AS h WHERE h.chart_id = c.id AND h.hour = s.hour
+                )
+            )
+            SELECT chart_id, MIN(hour), MAX(hour)
+            FROM (
+                SELECT chart_id, hour,
+                    hour - ROW_NUMBER() OVER (PARTITION BY chart_id ORDER BY hour) * interval '1 hour' AS grp
+                FROM missing
+            ) AS g
+            GROUP BY chart_id, grp
+            ORDER BY MAX(hour) DESC, chart_id
+        '''.format(
+            chart_table=Chart._meta.db_table,
+            hourly_chart_table=cls._meta.db_table,
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [strip_to_hour(start), strip_to_hour(end), chart_ids])
+            return [tuple(row) for row in cursor.fetchall()]
+
+    @classmethod
+    def get_latest_hour(cls, chart_id):
+        '''Return the specified chart's latest hour, avoiding a query when possible'''
+        return get_cached_latest_hour(
+            'charts-hourly-{}-latest'.format(chart_id),
+            lambda: cls.objects.filter(chart_id=chart_id).values_list('hour', flat=True).first()
+        )
+
+    @classmethod
+    def set_latest_hour(cls, chart_id, hour):
+        advance_latest_hour('charts-hourly-{}-latest'.format(chart_id), hour)
+
+    @classmethod
+    def get_cache_key(cls, chart_id, hour):
+        hour = strip_to_hour(hour)
+        return 'charts-hourly-{}-v{}-{}'.format(
+            chart_id,
+            SCHEMA_VERSION,
+            hour.astimezone(KR_TZ).strftime('%Y%m%d%H')
+        )
+
+    @classmethod
+    def cache_chart(cls, chart_id, hour):
+        '''Caches the specified chart's hourly chart for the specified hour and then returns it
+
+        :param int chart_id: The Chart id
+        :param datetime hour: The chart hour
+        :rtype: kchart.charts.chartcache.CachedHourlyChart
+        '''
+        hour = strip_to_hour(hour)
+        key = cls.get_cache_key(chart_id, hour)
+        entries = Prefetch(
+            'entries',
+            queryset=HourlySongChartEntry.objects.filter(
+                position__lte=CHART_ENTRY_LIMIT
+            ).select_related('song__album').prefetch_related('song__artists')
+        )
+        try:
+            hourly_chart = HourlySongChart.objects.select_related('chart__service').prefetch_related(
+                entries
+            ).get(chart_id=chart_id, hour=hour)
+        except HourlySongChart.DoesNotExist:
+            cls.invalidate_cached_chart(chart_id, hour)
+            return None
+        payload = pack_hourly_chart(hourly_chart)
+        cache.set_many({key: payload, get_modified_key(key): time.time()}, None)
+        bump_generation(key)
+        return unpack_hourly_chart(payload)
+
+    @classmethod
+    def invalidate_cached_chart(cls, chart_id, hour):
+        '''Remove the specified hourly chart from the shared and per-process caches'''
+        key = cls.get_cache_key(chart_id, hour)
+        cache.delete_many([key, get_modified_key(key)])
+        bump_generation(key)
+
+    @classmethod
+    def get_cached_chart(cls, chart_id, hour):
+        '''Return the specified chart's cached hourly chart, caching it if necessary
+
+        :param int chart_id: The Chart id
+        :param datetime hour: The chart hour
+        :rtype: kchart.charts.chartcache.CachedHourlyChart
+        '''
+        hour = strip_to_hour(hour)
+        key = cls.get_cache_key(chart_id, hour)
+
+        def fetch():
+            return unpack_hourly_chart(cache.get(key))
+
+        def load():
+            chart = fetch()
+            if chart:
+                return chart
+            else:
+                return rebuild_once(key, lambda: cls.cache_chart(chart_id, hour), fetch)
+
+        return get_cached(key, load)
+
 
 class HourlySongChartBacklog(models.Model):
 
@@ -272,17 +573,97 @@ class HourlySongChartBacklog(models.Model):
     )
     last_modified = models.DateTimeField(auto_now=True)
 
-    def find_next_hour_to_backlog(self):
-        hour = strip_to_hour(self.next_backlog_timestamp)
-        try:
-            while HourlySongChart.objects.get(chart=self.chart, hour=hour):
+    def find_missing_hours(self, hours, end):
+        '''Find the latest missing hours before the stored backlog position
+
+        Only the given number of hours up to next_backlog_timestamp (or end, if
+        earlier) are checked. Every hour after the latest missing one has been
+        filled, so next_backlog_timestamp is moved back to it and later runs
+        never check those hours again.
+
+        :param int hours: The number of hours to check
+        :param datetime end: The latest hour to check
+        :returns: The missing hours, latest first
+        :rtype: list
+        '''
+        last = min(strip_to_hour(self.next_backlog_timestamp), strip_to_hour(end))
+        first = last - timedelta(hours=hours - 1)
+        missing = []
+        for (chart_id, first_hour, last_hour) in HourlySongChart.find_gaps([self.chart_id], first, last):
+            hour = last_hour
+            while hour >= first_hour:
+                missing.append(hour)
                 hour = hour - timedelta(hours=1)
-        except HourlySongChart.DoesNotExist:
-            pass
-        if self.next_backlog_timestamp != hour:
-            self.next_backlog_timestamp = hour
+        if missing:
+            position = missing[0]
+        else:
+            position = first - timedelta(hours=1)
+        if self.next_backlog_timestamp != position:
+            self.next_backlog_timestamp = position
             self.save()
-        return hour
+        return missing
+
+
+class HourlySongChartSnapshot(models.Model):
+    '''The raw responses an hourly chart was parsed from
+
+    Snapshots are append-only, every fetch adds a new snapshot so that charts
+    can be re-parsed later (see the replaychart command) without downloading
+    them again.
+    '''
+
+    chart = models.ForeignKey(Chart, on_delete=models.CASCADE, related_name='snapshots')
+    hour = models.DateTimeField(_('Chart start hour'))
+    fetched = models.DateTimeField(_('Time the chart was fetched'), auto_now_add=True)
+    data = models.BinaryField(_('gzip compressed JSON list of response bodies'))
+
+    class Meta:
+        index_together = ('chart', 'hour')
+        ordering = ['-hour', 'chart', '-fetched']
+
+    def __str__(self):
+        return '{} <{}> snapshot'.format(self.chart.name, self.hour.astimezone(KR_TZ).strftime('%Y.%m.%d-%H'))
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            raise ValueError('Chart snapshots cannot be modified')
+        super(HourlySongChartSnapshot, self).save(*args, **kwargs)
+
+    @property
+    def texts(self):
+        '''The archived response bodies, in request order'''
+        return json.loads(gzip.decompress(bytes(self.data)).decode('utf-8'))
+
+    @classmethod
+    def archive(cls, chart, hour, texts):
+        '''Archive the raw responses for an hourly chart
+
+        :param Chart chart: The chart
+        :param datetime hour: The chart hour
+        :param list texts: The response bodies
+        :returns: The new snapshot, or None if archiving is disabled
+        :rtype: HourlySongChartSnapshot
+        '''
+        if not settings.CHART_SNAPSHOT_ARCHIVE:
+            return None
+        data = gzip.compress(json.dumps(list(texts)).encode('utf-8'), settings.CHART_SNAPSHOT_COMPRESSION)
+        return cls.objects.create(chart=chart, hour=strip_to_hour(hour), data=data)
+
+    @classmethod
+    def get_latest_ids(cls, chart, start=None, end=None):
+        '''Return the ids of the most recent snapshot for each archived hour of chart
+
+        :param Chart chart: The chart
+        :param datetime start: The (inclusive) first hour, defaults to the earliest snapshot
+        :param datetime end: The (inclusive) last hour, defaults to the latest snapshot
+        :rtype: list
+        '''
+        q = cls.objects.filter(chart=chart)
+        if start:
+            q = q.filter(hour__gte=start)
+        if end:
+            q = q.filter(hour__lte=end)
+        return list(q.order_by('hour', '-fetched').distinct('hour').values_list('pk', flat=True))
 
 
 class BaseHourlySongChartEntry(models.Model):
@@ -291,19 +672,97 @@ class BaseHourlySongChartEntry(models.Model):
     position = models.SmallIntegerField(_('Chart position'))
     prev_position = models.SmallIntegerField(_('Previous chart position'), null=True, default=None)
 
+    # SQL join condition matching the previous hour's chart (pc) to an entry's
+    # chart (c), must be set by subclasses
+    PREV_CHART_CONDITION = None
+
     class Meta:
         abstract = True
 
+    @classmethod
+    def chart_model(cls):
+        '''Return the hourly chart model that entries of this type belong to'''
+        return cls._meta.get_field('hourly_chart').related_model
+
+    @classmethod
+    def recompute_prev_positions(cls, hourly_chart_ids):
+        '''Recompute prev_position for every entry in the specified charts
+
+        All of the specified charts are updated with a single UPDATE ... FROM
+        statement which self-joins each entry to the same song in the previous
+        hour's chart. Only rows whose prev_position actually changes are written.
+
+        :param list hourly_chart_ids: Primary keys of the hourly charts to update
+        :returns: The number of updated entries
+        :rtype: int
+        '''
+        hourly_chart_ids = list(hourly_chart_ids)
+        if not hourly_chart_ids:
+            return 0
+        sql = '''
+            UPDATE {entry_table} AS e
+            SET prev_position = p.prev_position
+            FROM (
+                SELECT e2.id, CASE WHEN pe.position <= 100 THEN pe.position END AS prev_position
+                FROM {entry_table} AS e2
+                INNER JOIN {chart_table} AS c ON c.id = e2.hourly_chart_id
+                LEFT OUTER JOIN {chart_table} AS pc ON {prev_chart_condition}
+                LEFT OUTER JOIN {entry_table} AS pe ON pe.hourly_chart_id = pc.id AND pe.song_id = e2.song_id
+                WHERE e2.hourly_chart_id = ANY(%s)
+            ) AS p
+            WHERE e.id = p.id AND e.prev_position IS DISTINCT FROM p.prev_position
+        '''.format(
+            entry_table=cls._meta.db_table,
+            chart_table=cls.chart_model()._meta.db_table,
+            prev_chart_condition=cls.PREV_CHART_CONDITION,
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [hourly_chart_ids])
+            return cursor.rowcount
+
+    @classmethod
+    def recompute_prev_positions_in_range(cls, start=None, end=None, chunk_size=24, chart_filter=None,
+                                          callback=None):
+        '''Recompute prev_position for all charts in the specified hour range
+
+        Charts are processed in chunks of chunk_size charts per UPDATE statement.
+
+        :param datetime start: The (inclusive) first hour to update, defaults to the earliest chart
+        :param datetime end: The (inclusive) last hour to update, defaults to the latest chart
+        :param int chunk_size: The number of charts to update per statement
+        :param dict chart_filter: Additional filter kwargs for the chart queryset
+        :param callable callback: Called as callback(charts_done, charts_total, entries_updated)
+            after each chunk
+        :returns: The total number of updated entries
+        :rtype: int
+        '''
+        q = cls.chart_model().objects.all()
+        if start:
+            q = q.filter(hour__gte=start)
+        if end:
+            q = q.filter(hour__lte=end)
+        if chart_filter:
+            q = q.filter(**chart_filter)
+        chart_ids = list(q.order_by('hour').values_list('pk', flat=True))
+        updated = 0
+        for i in range(0, len(chart_ids), chunk_size):
+            chunk = chart_ids[i:i + chunk_size]
+            updated += cls.recompute_prev_positions(chunk)
+            if callback:
+                callback(i + len(chunk), len(chart_ids), updated)
+        return updated
+
     @classmethod
     def update_all_prev_positions(cls):
-        for entry in cls.objects.all():
-            entry.update_prev_position()
+        return cls.recompute_prev_positions_in_range()
 
 
 class HourlySongChartEntry(BaseHourlySongChartEntry):
 
     hourly_chart = models.ForeignKey(HourlySongChart, on_delete=models.CASCADE, related_name='entries')
 
+    PREV_CHART_CONDITION = "pc.chart_id = c.chart_id AND pc.hour = c.hour - interval '1 hour'"
+
     class Meta:
         unique_together = (('hourly_chart', 'song'), ('hourly_chart', 'position'))
         ordering = ['hourly_chart', 'position']
@@ -329,6 +788,8 @@ class AggregateHourlySongChartEntry(BaseHourlySongChartEntry):
     hourly_chart = models.ForeignKey('AggregateHourlySongChart', on_delete=models.CASCADE, related_name='entries')
     score = models.FloatField(_('Aggregated song score'), default=0.0)
 
+    PREV_CHART_CONDITION = "pc.hour = c.hour - interval '1 hour'"
+
     class Meta:
         unique_together = (('hourly_chart', 'song'), ('hourly_chart', 'position'))
         ordering = ['hourly_chart', 'position']
@@ -373,76 +834,188 @@ class AggregateHourlySongChart(models.Model):
     def update_next_chart(self):
         try:
             next_chart = AggregateHourlySongChart.objects.get(hour=self.hour + timedelta(hours=1))
-            for entry in next_chart.entries.all():
-                entry.update_prev_position()
-            if cache.get(self.get_cache_key(self.hour)):
+            AggregateHourlySongChartEntry.recompute_prev_positions([next_chart.pk])
+            if cache.has_key(self.get_cache_key(self.hour)):
                 # only bother with caching the next chart if it was already
                 # cached to begin with
                 self.cache_chart(next_chart.hour)
+            else:
+                self.invalidate_cached_chart(next_chart.hour)
         except AggregateHourlySongChart.DoesNotExist:
             pass
 
+    def write_entries(self, scores):
+        '''Replace this chart's entries in bulk
+
+        Positions are assigned in the order given, and previous positions are
+        looked up from the previous hour's aggregate chart in a single query.
+
+        :param scores: An iterable of (song_id, score) pairs, ordered by descending score
+        '''
+        prev_positions = dict(
+            AggregateHourlySongChartEntry.objects.filter(
+                hourly_chart__hour=self.hour - timedelta(hours=1),
+                position__lte=100,
+            ).values_list('song_id', 'position')
+        )
+        entries = []
+        for (i, (song_id, score)) in enumerate(scores):
+            entries.append(AggregateHourlySongChartEntry(
+                hourly_chart=self,
+                song_id=song_id,
+                score=score,
+                position=i + 1,
+                prev_position=prev_positions.get(song_id),
+            ))
+        with transaction.atomic():
+            self.entries.all().delete()
+            AggregateHourlySongChartEntry.objects.bulk_create(entries)
+
+    @classmethod
+    def get_latest_hour(cls):
+        '''Return the latest aggregate chart hour, avoiding a query when possible'''
+        return get_cached_latest_hour(
+            'charts-realtime-latest',
+            lambda: cls.objects.values_list('hour', flat=True).first()
+        )
+
+    @classmethod
+    def set_latest_hour(cls, hour):
+        advance_latest_hour('charts-realtime-latest', hour)
+
     @classmethod
     def get_cache_key(cls, hour):
         hour = strip_to_hour(hour)
-        return 'charts-realtime-{}'.format(hour.astimezone(KR_TZ).strftime('%Y%m%d%H'))
+        return 'charts-realtime-v{}-{}'.format(SCHEMA_VERSION, hour.astimezone(KR_TZ).strftime('%Y%m%d%H'))
 
     @classmethod
     def cache_chart(cls, hour):
-        '''Caches the chart for the specified hour and then returns it'''
+        '''Caches the chart for the specified hour and then returns it
+
+        :rtype: kchart.charts.chartcache.CachedAggregateChart
+        '''
         hour = strip_to_hour(hour)
         key = cls.get_cache_key(hour)
-        try:
-            chart = AggregateHourlySongChart.objects.prefetch_related(
-                'entries__song__album',
-                'entries__song__artists',
-                'charts__entries__song__album',
-                'charts__entries__song__artists',
-                'charts__chart__service',
-            ).order_by('entries__position').get(
-                hour=hour
+        entries = Prefetch(
+            'entries',
+            queryset=AggregateHourlySongChartEntry.objects.filter(
+                position__lte=CHART_ENTRY_LIMIT
+            ).select_related('song__album').prefetch_related('song__artists')
+        )
+        charts = Prefetch(
+            'charts',
+            queryset=HourlySongChart.objects.select_related('chart__service').prefetch_related(
+                Prefetch(
+                    'entries',
+                    queryset=HourlySongChartEntry.objects.filter(
+                        position__lte=CHART_ENTRY_LIMIT
+                    ).select_related('song__album').prefetch_related('song__artists')
+                )
             )
+        )
+        try:
+            chart = AggregateHourlySongChart.objects.prefetch_related(entries, charts).get(hour=hour)
         except AggregateHourlySongChart.DoesNotExist:
-            cache.delete(key)
+            cls.invalidate_cached_chart(hour)
             return None
-        pickle_str = pickle.dumps(chart)
-        cache.set(key, pickle_str, None)
-        return chart
+        payload = pack_aggregate_chart(chart)
+        cached_chart = unpack_aggregate_chart(payload)
+        rendered = cls.render_chart(cached_chart)
+        cache.set_many({
+            key: payload,
+            get_rendered_key(key): tuple(rendered),
+            get_rendered_etag_key(key): rendered.etag,
+            get_modified_key(key): time.time(),
+        }, None)
+        bump_generation(key)
+        return cached_chart
 
     @classmethod
-    def get_cached_chart(cls, hour):
+    def invalidate_cached_chart(cls, hour):
+        '''Remove the chart for the specified hour from the shared and per-process caches'''
+        key = cls.get_cache_key(hour)
+        cache.delete_many([key, get_rendered_key(key), get_rendered_etag_key(key), get_modified_key(key)])
+        bump_generation(key)
+
+    @classmethod
+    def render_chart(cls, chart):
+        '''Render a cached chart as an API response body
+
+        :param kchart.charts.chartcache.CachedAggregateChart chart: The chart to render
+        :rtype: kchart.charts.chartcache.RenderedChart
+        '''
+        # serializers depend on this module
+        from .serializers import CachedAggregateHourlySongChartSerializer
+        return render_json(CachedAggregateHourlySongChartSerializer(chart).data)
+
+    @classmethod
+    def get_rendered_chart(cls, hour):
+        '''Return the pre-rendered API response body for the specified hour
+
+        Bodies are never rendered for stale charts.
+
+        :returns: The rendered chart, or None if no (up to date) chart is available
+        :rtype: kchart.charts.chartcache.RenderedChart
+        '''
         hour = strip_to_hour(hour)
         key = cls.get_cache_key(hour)
-        pickle_str = cache.get(key)
-        if pickle_str:
-            return pickle.loads(pickle_str)
-        else:
-            return cls.cache_chart(hour)
+        rendered_key = get_rendered_key(key)
+
+        def load():
+            rendered = cache.get(rendered_key)
+            if rendered:
+                return RenderedChart._make(rendered)
+            # Rendered bodies are only written to the shared cache alongside
+            # the chart payload in cache_chart. Drop the local chart so the
+            # body is never rendered from an outdated copy.
+            local_cache.discard(key)
+            chart = cls.get_cached_chart(hour)
+            if not chart or chart.stale:
+                return None
+            return cls.render_chart(chart)
+
+        return get_cached(key, load, local_key=rendered_key)
 
     @classmethod
-    def generate(cls, hour=utcnow(), regenerate=False, cache_result=True):
-        '''Generate an aggregate hourly chart'''
+    def get_cached_chart(cls, hour):
+        '''Return the cached chart for the specified hour, caching it if necessary
+
+        If the chart is already being rebuilt by another process, the previous
+        hour's chart may be returned instead with its stale flag set.
+
+        :rtype: kchart.charts.chartcache.CachedAggregateChart
+        '''
         hour = strip_to_hour(hour)
-        if regenerate:
-            cache.delete(cls.get_cache_key(hour))
-        aggregate_charts = HourlySongChart.objects.filter(hour=hour)
-        (chart, created) = AggregateHourlySongChart.objects.get_or_create(
-            hour=hour
-        )
-        if not created:
-            if regenerate:
-                for entry in chart.entries.all():
-                    entry.delete()
-            else:
-                cls.cache_chart(hour)
-                return chart
-        total_weight = HourlySongChart.objects.filter(
-            hour=hour
-        ).aggregate(Sum('chart__weight'))['chart__weight__sum']
-        if not total_weight:
-            # No charts to aggregate
+        key = cls.get_cache_key(hour)
+
+        def fetch():
+            return unpack_aggregate_chart(cache.get(key))
+
+        def stale():
+            chart = unpack_aggregate_chart(cache.get(cls.get_cache_key(hour - timedelta(hours=1))))
+            if chart:
+                return chart._replace(stale=True)
             return None
-        entries = HourlySongChartEntry.objects.filter(
+
+        def load():
+            chart = fetch()
+            if chart:
+                return chart
+            else:
+                return rebuild_once(key, lambda: cls.cache_chart(hour), fetch, stale)
+
+        return get_cached(key, load)
+
+    @classmethod
+    def compute_scores(cls, hour, total_weight):
+        '''Compute aggregate scores from all of the hour's service charts
+
+        :param datetime hour: The chart hour
+        :param float total_weight: The summed weight of the hour's service charts
+        :returns: A list of (song_id, score) pairs, ordered by descending score
+        :rtype: list
+        '''
+        scores = HourlySongChartEntry.objects.filter(
             hourly_chart__hour=hour
         ).values('song').annotate(
             score=Sum(
@@ -452,27 +1025,635 @@ class AggregateHourlySongChart(models.Model):
                 ) * F('hourly_chart__chart__weight')
             ) / (100.0 * total_weight)
         ).order_by('-score')
-        for (i, entry) in enumerate(entries):
-            song = Song.objects.get(pk=entry['song'])
-            (new_entry, created) = AggregateHourlySongChartEntry.objects.get_or_create(
-                hourly_chart=chart,
-                song=song,
-                defaults={'score': entry['score'], 'position': i + 1},
+        return [(entry['song'], entry['score']) for entry in scores]
+
+    @classmethod
+    def apply_delta(cls, hourly_chart, old_positions, verify=False, cache_result=True):
+        '''Incrementally update an aggregate chart after one of its service charts was rewritten
+
+        Only the rewritten service's contribution to each score is swapped out,
+        and only the rows whose score or position changed are written. The
+        aggregate chart is locked while it is updated, so concurrent updates
+        are applied one after another.
+
+        :param HourlySongChart hourly_chart: The rewritten service chart
+        :param dict old_positions: song id -> position for the service chart's previous entries
+        :param bool verify: True if the result should be checked against a full regeneration
+        :param bool cache_result: True if the updated chart should be cached
+        :returns: The updated chart, or None if the aggregate chart must be fully regenerated
+            (it does not exist yet, its service charts have changed or verification failed,
+            in which case nothing is written)
+        :rtype: AggregateHourlySongChart
+        '''
+        hour = strip_to_hour(hourly_chart.hour)
+        with transaction.atomic():
+            chart = cls.objects.select_for_update().filter(hour=hour).first()
+            if chart is None:
+                return None
+            component_weights = dict(HourlySongChart.objects.filter(hour=hour).values_list('pk', 'chart__weight'))
+            if (hourly_chart.pk not in component_weights or
+                    set(chart.charts.values_list('pk', flat=True)) != set(component_weights)):
+                return None
+            total_weight = sum(component_weights.values())
+            new_positions = dict(hourly_chart.entries.values_list('song_id', 'position'))
+
+            def contribution(positions, song_id):
+                if song_id in positions:
+                    return (101 - positions[song_id]) * component_weights[hourly_chart.pk] / (100.0 * total_weight)
+                return 0.0
+
+            rows = dict(
+                (song_id, (pk, score, position))
+                for (pk, song_id, score, position) in chart.entries.values_list('pk', 'song_id', 'score', 'position')
             )
-            if not created:
-                new_entry.score = entry['score']
-                new_entry.position = i + 1
-                new_entry.save()
-            new_entry.update_prev_position()
-        chart.charts.clear()
-        for c in aggregate_charts.all():
-            chart.charts.add(c)
-        chart.save()
-        chart.update_next_chart()
+            scores = dict((song_id, row[1]) for (song_id, row) in rows.items())
+            for song_id in set(old_positions) | set(new_positions):
+                scores[song_id] = (
+                    scores.get(song_id, 0.0) - contribution(old_positions, song_id) +
+                    contribution(new_positions, song_id)
+                )
+            # songs which left this service chart only remain if another service still charts them
+            dropped = set(old_positions) - set(new_positions)
+            if dropped:
+                dropped -= set(HourlySongChartEntry.objects.filter(
+                    hourly_chart__hour=hour,
+                    song_id__in=dropped,
+                ).exclude(hourly_chart=hourly_chart).values_list('song_id', flat=True))
+            for song_id in dropped:
+                scores.pop(song_id, None)
+            # ties keep their previous relative order
+            ranked = sorted(scores, key=lambda song_id: (-scores[song_id], rows.get(song_id, (0, 0, 32767))[2]))
+            positions = dict((song_id, i + 1) for (i, song_id) in enumerate(ranked))
+            changed = []
+            added = []
+            for song_id in ranked:
+                if song_id not in rows:
+                    added.append(song_id)
+                    continue
+                (pk, score, position) = rows[song_id]
+                if position != positions[song_id] or abs(score - scores[song_id]) > 1e-12:
+                    changed.append((pk, scores[song_id], positions[song_id], position))
+            removed = [rows[song_id][0] for song_id in rows if song_id not in scores]
+            prev_positions = {}
+            if added:
+                prev_positions = dict(AggregateHourlySongChartEntry.objects.filter(
+                    hourly_chart__hour=hour - timedelta(hours=1),
+                    song_id__in=added,
+                    position__lte=100,
+                ).values_list('song_id', 'position'))
+            if removed:
+                AggregateHourlySongChartEntry.objects.filter(pk__in=removed).delete()
+            if changed:
+                cls._update_entries(chart, changed)
+            if added:
+                AggregateHourlySongChartEntry.objects.bulk_create([
+                    AggregateHourlySongChartEntry(
+                        hourly_chart=chart,
+                        song_id=song_id,
+                        score=scores[song_id],
+                        position=positions[song_id],
+                        prev_position=prev_positions.get(song_id),
+                    )
+                    for song_id in added
+                ])
+            if removed or added or any(new != old for (pk, score, new, old) in changed):
+                chart.update_next_chart()
+            SongChartSummary.update_for_chart(chart)
+            if verify and not cls.verify(chart, total_weight):
+                # discard the incorrect update, the chart is left as it was
+                transaction.set_rollback(True)
+                return None
+        if cache_result:
+            cls.cache_chart(hour)
+        return chart
+
+    @classmethod
+    def update_for_hour(cls, hour, verify=False):
+        '''Apply the pending changes of an hour's service charts to its aggregate chart
+
+        Service charts rewritten since the aggregate chart was last updated
+        record the positions it was built from (see HourlySongChart.write_entries),
+        and each change is applied with apply_delta. The aggregate chart is
+        fully regenerated if that is not possible.
+
+        :param datetime hour: The chart hour
+        :param bool verify: True if incremental updates should be checked against a full regeneration
+        :rtype: AggregateHourlySongChart
+        '''
+        hour = strip_to_hour(hour)
+        chart = None
+        with transaction.atomic():
+            # the hour's service chart writes wait until the pending changes
+            # have been applied, service charts are always locked before the
+            # aggregate chart
+            components = list(HourlySongChart.objects.select_for_update().filter(hour=hour).order_by('pk'))
+            pending = [c for c in components if c.aggregated_positions is not None]
+            if not pending:
+                chart = cls.objects.filter(hour=hour).first()
+                if chart:
+                    # nothing has changed
+                    return chart
+            for hourly_chart in pending:
+                chart = cls.apply_delta(hourly_chart, hourly_chart.get_aggregated_positions(), verify=verify,
+                                        cache_result=False)
+                if chart is None:
+                    break
+            if chart is not None:
+                HourlySongChart.objects.filter(pk__in=[c.pk for c in pending]).update(aggregated_positions=None)
+        if chart is None:
+            return cls.generate(hour=hour, regenerate=True)
+        cls.cache_chart(hour)
+        return chart
+
+    @classmethod
+    def _update_entries(cls, chart, changed):
+        '''Write new scores and positions for existing entries
+
+        Moved rows are first given negative positions, so that the unique
+        (hourly_chart, position) constraint holds after every statement.
+
+        :param list changed: A list of (entry id, score, position, old position) tuples
+        '''
+        table = AggregateHourlySongChartEntry._meta.db_table
+        values = ', '.join(['(%s, %s::double precision, %s)'] * len(changed))
+        params = []
+        for (pk, score, position, old_position) in changed:
+            params.extend([pk, score, -position if position != old_position else position])
+        with connection.cursor() as cursor:
+            cursor.execute(
+                '''
+                UPDATE {table} AS e SET score = v.score, position = v.position
+                FROM (VALUES {values}) AS v (id, score, position)
+                WHERE e.id = v.id
+                '''.format(table=table, values=values),
+                params
+            )
+            cursor.execute(
+                'UPDATE {table} SET position = -position WHERE hourly_chart_id = %s AND position < 0'.format(
+                    table=table),
+                [chart.pk]
+            )
+
+    @classmethod
+    def verify(cls, chart, total_weight=None):
+        '''Check an aggregate chart against a full regeneration
+
+        Songs with equal scores may be ranked in any order, so positions only
+        have to match the regenerated scores.
+
+        :param AggregateHourlySongChart chart: The chart to check
+        :param float total_weight: The summed weight of the hour's service charts
+        :returns: True if the chart matches
+        :rtype: bool
+        '''
+        if total_weight is None:
+            total_weight = sum(chart.charts.values_list('chart__weight', flat=True))
+        expected = cls.compute_scores(chart.hour, total_weight)
+        expected_scores = dict(expected)
+        actual = list(chart.entries.order_by('position').values_list('song_id', 'score'))
+        if len(actual) != len(expected) or set(song_id for (song_id, score) in actual) != set(expected_scores):
+            return False
+        for ((song_id, score), (expected_song_id, expected_score)) in zip(actual, expected):
+            # each song must have its own score, and each position the score ranked there
+            if abs(score - expected_scores[song_id]) > 1e-9 or abs(score - expected_score) > 1e-9:
+                return False
+        return True
+
+    @classmethod
+    def generate(cls, hour=utcnow(), regenerate=False, cache_result=True, update_next=True, update_summary=True):
+        '''Generate an aggregate hourly chart
+
+        The hour's service charts and its aggregate chart are locked while the
+        chart is generated, and any pending service chart changes are cleared.
+
+        :param datetime hour: The chart hour
+        :param bool regenerate: True if an existing chart should be regenerated
+        :param bool cache_result: True if the generated chart should be cached
+        :param bool update_next: True if prev_position should be updated for the next hour's chart
+        :param bool update_summary: True if the aggregate song chart summaries should be updated
+        '''
+        hour = strip_to_hour(hour)
+        if regenerate:
+            cls.invalidate_cached_chart(hour)
+        total_weight = None
+        with transaction.atomic():
+            aggregate_charts = list(HourlySongChart.objects.select_for_update().filter(hour=hour).order_by('pk'))
+            (chart, created) = AggregateHourlySongChart.objects.get_or_create(
+                hour=hour
+            )
+            if created or regenerate:
+                chart = cls.objects.select_for_update().get(pk=chart.pk)
+                total_weight = HourlySongChart.objects.filter(
+                    hour=hour
+                ).aggregate(Sum('chart__weight'))['chart__weight__sum']
+                if not total_weight:
+                    # No charts to aggregate
+                    chart.entries.all().delete()
+                else:
+                    chart.write_entries(cls.compute_scores(hour, total_weight))
+                if update_summary:
+                    SongChartSummary.update_for_chart(chart)
+                if total_weight:
+                    chart.charts.clear()
+                    for c in aggregate_charts:
+                        chart.charts.add(c)
+                    chart.save()
+                    if update_next:
+                        chart.update_next_chart()
+                HourlySongChart.objects.filter(
+                    pk__in=[c.pk for c in aggregate_charts]
+                ).update(aggregated_positions=None)
+        cls.set_latest_hour(hour)
+        if not created and not regenerate:
+            cls.cache_chart(hour)
+            return chart
+        if not total_weight:
+            return None
         if cache_result:
             cls.cache_chart(hour)
         else:
             # if we aren't going to cache it make sure we invalidate any
             # existing cache entry
-            cache.delete(cls.get_cache_key(hour))
+            cls.invalidate_cached_chart(hour)
         return chart
+
+
+class SongChartSummary(models.Model):
+    '''Precomputed realtime chart history for a song on a single chart
+
+    Summaries with no service are for the aggregated kchart chart. Summaries
+    are updated incrementally with update_for_chart whenever an hourly chart
+    is written, and can be rebuilt from scratch with rebuild.
+    '''
+
+    song = models.ForeignKey(Song, on_delete=models.CASCADE, related_name='chart_summaries')
+    service = models.ForeignKey(MusicService, on_delete=models.CASCADE, null=True)
+    initial_position = models.SmallIntegerField(_('Initial chart position'))
+    initial_timestamp = models.DateTimeField(_('Initial chart hour'))
+    peak_position = models.SmallIntegerField(_('Peak chart position'))
+    peak_timestamp = models.DateTimeField(_('Peak chart hour'))
+    final_position = models.SmallIntegerField(_('Final chart position'))
+    final_timestamp = models.DateTimeField(_('Final chart hour'))
+
+    class Meta:
+        # aggregate chart summaries are unique by song through a partial
+        # index (see migration 0017)
+        unique_together = ('song', 'service')
+        # summaries referencing a re-written hour are found by timestamp (see update_for_chart)
+        index_together = [
+            ('service', 'initial_timestamp'),
+            ('service', 'peak_timestamp'),
+            ('service', 'final_timestamp'),
+        ]
+
+    def get_details(self):
+        '''Return chart details in the format used by Song.get_chart_details'''
+        details = {
+            'has_charted': True,
+            'initial_position': self.initial_position,
+            'initial_timestamp': self.initial_timestamp,
+            'peak_position': self.peak_position,
+            'peak_timestamp': self.peak_timestamp,
+            'current_position': None,
+        }
+        if self.final_timestamp == strip_to_hour(utcnow()):
+            details['current_position'] = self.final_position
+        else:
+            details['final_position'] = self.final_position
+            details['final_timestamp'] = self.final_timestamp
+        return details
+
+    @classmethod
+    def get_details_for(cls, summary):
+        if summary:
+            return summary.get_details()
+        return {'has_charted': False}
+
+    @classmethod
+    def _entries_sql(cls, service, hourly_chart_id=None, song_ids=None):
+        '''Return SQL (and params) selecting (song_id, position, hour) for charted entries
+
+        :param MusicService service: The service, or None for the aggregate chart
+        :param int hourly_chart_id: Only select entries from this chart
+        :param list song_ids: Only select entries for these songs
+        :rtype: tuple
+        '''
+        if service:
+            entry_model = HourlySongChartEntry
+        else:
+            entry_model = AggregateHourlySongChartEntry
+        sql = '''
+            SELECT e.song_id, e.position, c.hour
+            FROM {entry_table} AS e
+            INNER JOIN {chart_table} AS c ON c.id = e.hourly_chart_id
+            WHERE e.position <= 100
+        '''.format(
+            entry_table=entry_model._meta.db_table,
+            chart_table=entry_model.chart_model()._meta.db_table,
+        )
+        params = []
+        if service:
+            sql += ' AND c.chart_id IN (SELECT id FROM {} WHERE service_id = %s)'.format(Chart._meta.db_table)
+            params.append(service.pk)
+        if hourly_chart_id is not None:
+            sql += ' AND e.hourly_chart_id = %s'
+            params.append(hourly_chart_id)
+        if song_ids is not None:
+            sql += ' AND e.song_id = ANY(%s)'
+            params.append(list(song_ids))
+        return (sql, params)
+
+    @classmethod
+    def _upsert_sql(cls, service, select_sql):
+        '''Return SQL inserting the summaries selected by select_sql
+
+        Summaries which already exist (possibly written concurrently) are merged
+        with the selected ones. Aggregate chart summaries (with no service) are
+        unique by song through a partial index, since NULL services are distinct
+        in the (song, service) unique constraint.
+
+        :param MusicService service: The service, or None for the aggregate chart
+        :param str select_sql: SQL selecting (song_id, service_id, initial_position, initial_timestamp,
+            peak_position, peak_timestamp, final_position, final_timestamp)
+        :rtype: str
+        '''
+        if service:
+            conflict = '(song_id, service_id)'
+        else:
+            conflict = '(song_id) WHERE service_id IS NULL'
+        return '''
+            INSERT INTO {table} AS s (
+                song_id, service_id,
+                initial_position, initial_timestamp,
+                peak_position, peak_timestamp,
+                final_position, final_timestamp
+            )
+            {select_sql}
+            ON CONFLICT {conflict} DO UPDATE SET
+                initial_position = CASE
+                    WHEN EXCLUDED.initial_timestamp < s.initial_timestamp
+                    THEN EXCLUDED.initial_position ELSE s.initial_position END,
+                initial_timestamp = LEAST(s.initial_timestamp, EXCLUDED.initial_timestamp),
+                peak_position = CASE
+                    WHEN EXCLUDED.peak_position < s.peak_position OR (
+                        EXCLUDED.peak_position = s.peak_position AND EXCLUDED.peak_timestamp < s.peak_timestamp)
+                    THEN EXCLUDED.peak_position ELSE s.peak_position END,
+                peak_timestamp = CASE
+                    WHEN EXCLUDED.peak_position < s.peak_position OR (
+                        EXCLUDED.peak_position = s.peak_position AND EXCLUDED.peak_timestamp < s.peak_timestamp)
+                    THEN EXCLUDED.peak_timestamp ELSE s.peak_timestamp END,
+                final_position = CASE
+                    WHEN EXCLUDED.final_timestamp >= s.final_timestamp
+                    THEN EXCLUDED.final_position ELSE s.final_position END,
+                final_timestamp = GREATEST(s.final_timestamp, EXCLUDED.final_timestamp)
+        '''.format(table=cls._meta.db_table, select_sql=select_sql, conflict=conflict)
+
+    @classmethod
+    def rebuild(cls, service=None, song_ids=None):
+        '''Rebuild summaries from scratch
+
+        :param MusicService service: The service to rebuild, or None for the aggregate chart
+        :param list song_ids: Only rebuild summaries for these songs
+        :returns: The number of summaries written
+        :rtype: int
+        '''
+        (entries_sql, params) = cls._entries_sql(service, song_ids=song_ids)
+        sql = '''
+            WITH e AS ({entries_sql}),
+            i AS (SELECT DISTINCT ON (song_id) song_id, position, hour FROM e ORDER BY song_id, hour),
+            p AS (SELECT DISTINCT ON (song_id) song_id, position, hour FROM e ORDER BY song_id, position, hour),
+            f AS (SELECT DISTINCT ON (song_id) song_id, position, hour FROM e ORDER BY song_id, hour DESC)
+            {upsert_sql}
+        '''.format(
+            entries_sql=entries_sql,
+            upsert_sql=cls._upsert_sql(service, '''
+                SELECT i.song_id, %s, i.position, i.hour, p.position, p.hour, f.position, f.hour
+                FROM i
+                INNER JOIN p ON p.song_id = i.song_id
+                INNER JOIN f ON f.song_id = i.song_id
+            '''),
+        )
+        params.append(service.pk if service else None)
+        q = cls.objects.filter(service=service)
+        if song_ids is not None:
+            q = q.filter(song_id__in=song_ids)
+        with transaction.atomic():
+            q.delete()
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                return cursor.rowcount
+
+    @classmethod
+    def update_for_chart(cls, hourly_chart):
+        '''Update summaries after the entries for an hourly chart have been written
+
+        New chart positions are merged into the existing summaries with a single
+        set-based upsert. Summaries which referenced this hour but no longer match its
+        entries (because the hour was re-written) are rebuilt.
+
+        :param hourly_chart: The HourlySongChart or AggregateHourlySongChart which was written
+        '''
+        if isinstance(hourly_chart, AggregateHourlySongChart):
+            service = None
+        else:
+            service = hourly_chart.chart.service
+        service_id = service.pk if service else None
+        hour = hourly_chart.hour
+        (entries_sql, entries_params) = cls._entries_sql(service, hourly_chart_id=hourly_chart.pk)
+        table = cls._meta.db_table
+        upsert_sql = cls._upsert_sql(service, '''
+            SELECT e.song_id, %s, e.position, e.hour, e.position, e.hour, e.position, e.hour
+            FROM ({entries_sql}) AS e
+        '''.format(entries_sql=entries_sql))
+        if service:
+            service_sql = 'service_id = %s'
+            service_params = [service_id]
+        else:
+            service_sql = 'service_id IS NULL'
+            service_params = []
+        # only summaries with a timestamp at this hour can be stale, each
+        # timestamp is looked up through its own (service, timestamp) index
+        stale_sql = '''
+            WITH s AS (
+                SELECT * FROM {table} WHERE {service_sql} AND initial_timestamp = %s
+                UNION SELECT * FROM {table} WHERE {service_sql} AND peak_timestamp = %s
+                UNION SELECT * FROM {table} WHERE {service_sql} AND final_timestamp = %s
+            )
+            SELECT s.song_id
+            FROM s
+            LEFT OUTER JOIN ({entries_sql}) AS e ON e.song_id = s.song_id
+            WHERE (s.initial_timestamp = %s AND s.initial_position IS DISTINCT FROM e.position)
+                OR (s.peak_timestamp = %s AND s.peak_position IS DISTINCT FROM e.position)
+                OR (s.final_timestamp = %s AND s.final_position IS DISTINCT FROM e.position)
+        '''.format(table=table, service_sql=service_sql, entries_sql=entries_sql)
+        stale_params = (service_params + [hour]) * 3 + entries_params + [hour, hour, hour]
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(upsert_sql, [service_id] + entries_params)
+                cursor.execute(stale_sql, stale_params)
+                stale_song_ids = [row[0] for row in cursor.fetchall()]
+            if stale_song_ids:
+                cls.rebuild(service, song_ids=stale_song_ids)
+
+
+class ChartStats(models.Model):
+    '''Site-wide chart statistics, stored in a single row
+
+    Songs, albums and artists are marked with the hour they first charted (on
+    any service), and newly charted ones are added to the counts whenever an
+    hourly chart is written (see update_for_chart). Counts are never decreased
+    when a re-written chart drops a song, rebuild recomputes everything from
+    scratch.
+    '''
+
+    STATS_ID = 1
+
+    song_count = models.PositiveIntegerField(_('Charted songs'), default=0)
+    artist_count = models.PositiveIntegerField(_('Charted artists'), default=0)
+    album_count = models.PositiveIntegerField(_('Charted albums'), default=0)
+    # {<service slug>: <first chart hour (seconds since the epoch)>}
+    first_hours = models.TextField(_('First chart hour for each service'), default='{}')
+
+    def get_first_hours(self):
+        '''Return the first available chart hour for each service
+
+        :returns: {<service slug>: <datetime>}
+        :rtype: dict
+        '''
+        return dict(
+            (slug, EPOCH + timedelta(seconds=timestamp))
+            for (slug, timestamp) in json.loads(self.first_hours).items()
+        )
+
+    def _set_first_hours(self, first_hours):
+        self.first_hours = json.dumps(dict(
+            (slug, int((hour - EPOCH).total_seconds())) for (slug, hour) in first_hours.items()
+        ))
+
+    @classmethod
+    def get(cls):
+        '''Return the statistics
+
+        The statistics are created by migration 0016 or with the rebuildstats
+        command, until then (unsaved) empty statistics are returned.
+
+        :rtype: ChartStats
+        '''
+        try:
+            return cls.objects.get(pk=cls.STATS_ID)
+        except cls.DoesNotExist:
+            return cls(pk=cls.STATS_ID)
+
+    @classmethod
+    def _first_charted_sql(cls, model, ids_sql):
+        '''Return SQL marking rows of model as first charted at an hour
+
+        The query returns the number of rows which had not charted before.
+        ids_sql selects the ids to mark, the hour is passed twice after its params.
+        '''
+        return '''
+            WITH old AS (
+                SELECT id, first_charted FROM {table}
+                WHERE id IN ({ids_sql}) AND (first_charted IS NULL OR first_charted > %s)
+            ), marked AS (
+                UPDATE {table} AS t SET first_charted = %s FROM old WHERE t.id = old.id
+            )
+            SELECT COUNT(*) FROM old WHERE old.first_charted IS NULL
+        '''.format(table=model._meta.db_table, ids_sql=ids_sql)
+
+    @classmethod
+    def update_for_chart(cls, hourly_chart):
+        '''Update statistics after the entries for an hourly chart have been written
+
+        Nothing is updated until the statistics have been built once.
+
+        :param HourlySongChart hourly_chart: The hourly chart which was written
+        '''
+        song_ids_sql = 'SELECT song_id FROM {} WHERE hourly_chart_id = %s'.format(
+            HourlySongChartEntry._meta.db_table)
+        album_ids_sql = 'SELECT album_id FROM {} WHERE id IN ({})'.format(Song._meta.db_table, song_ids_sql)
+        artist_ids_sql = 'SELECT artist_id FROM {} WHERE song_id IN ({})'.format(
+            Song.artists.through._meta.db_table, song_ids_sql)
+        params = [hourly_chart.pk, hourly_chart.hour, hourly_chart.hour]
+        slug = Chart.objects.filter(pk=hourly_chart.chart_id).values_list('service__slug', flat=True).first()
+        with transaction.atomic():
+            # concurrent chart writes are serialized on the stats row, so a
+            # newly charted song can only be counted once
+            stats = cls.objects.select_for_update().filter(pk=cls.STATS_ID).first()
+            if stats is None:
+                return
+            with connection.cursor() as cursor:
+                cursor.execute(cls._first_charted_sql(Song, song_ids_sql), params)
+                stats.song_count += cursor.fetchone()[0]
+                cursor.execute(cls._first_charted_sql(Album, album_ids_sql), params)
+                stats.album_count += cursor.fetchone()[0]
+                cursor.execute(cls._first_charted_sql(Artist, artist_ids_sql), params)
+                stats.artist_count += cursor.fetchone()[0]
+            first_hours = stats.get_first_hours()
+            if slug not in first_hours or hourly_chart.hour < first_hours[slug]:
+                first_hours[slug] = hourly_chart.hour
+                stats._set_first_hours(first_hours)
+            stats.save()
+
+    @classmethod
+    def rebuild(cls):
+        '''Rebuild statistics (and first chart hours) from scratch
+
+        :rtype: ChartStats
+        '''
+        song_table = Song._meta.db_table
+        songs_sql = '''
+            UPDATE {song_table} AS s SET first_charted = f.hour
+            FROM (
+                SELECT e.song_id, MIN(c.hour) AS hour
+                FROM {entry_table} AS e
+                INNER JOIN {chart_table} AS c ON c.id = e.hourly_chart_id
+                GROUP BY e.song_id
+            ) AS f
+            WHERE s.id = f.song_id
+        '''.format(
+            song_table=song_table,
+            entry_table=HourlySongChartEntry._meta.db_table,
+            chart_table=HourlySongChart._meta.db_table,
+        )
+        albums_sql = '''
+            UPDATE {album_table} AS a SET first_charted = f.hour
+            FROM (
+                SELECT album_id, MIN(first_charted) AS hour
+                FROM {song_table}
+                WHERE first_charted IS NOT NULL
+                GROUP BY album_id
+            ) AS f
+            WHERE a.id = f.album_id
+        '''.format(album_table=Album._meta.db_table, song_table=song_table)
+        artists_sql = '''
+            UPDATE {artist_table} AS a SET first_charted = f.hour
+            FROM (
+                SELECT sa.artist_id, MIN(s.first_charted) AS hour
+                FROM {song_artists_table} AS sa
+                INNER JOIN {song_table} AS s ON s.id = sa.song_id
+                WHERE s.first_charted IS NOT NULL
+                GROUP BY sa.artist_id
+            ) AS f
+            WHERE a.id = f.artist_id
+        '''.format(
+            artist_table=Artist._meta.db_table,
+            song_artists_table=Song.artists.through._meta.db_table,
+            song_table=song_table,
+        )
+        with transaction.atomic():
+            (stats, created) = cls.objects.select_for_update().get_or_create(pk=cls.STATS_ID)
+            for model in (Song, Album, Artist):
+                model.objects.filter(first_charted__isnull=False).update(first_charted=None)
+            with connection.cursor() as cursor:
+                cursor.execute(songs_sql)
+                stats.song_count = cursor.rowcount
+                cursor.execute(albums_sql)
+                stats.album_count = cursor.rowcount
+                cursor.execute(artists_sql)
+                stats.artist_count = cursor.rowcount
+            stats._set_first_hours(dict(
+                HourlySongChart.objects.values_list('chart__service__slug').annotate(Min('hour')).order_by()
+            ))
+            stats.save()
+        return stats
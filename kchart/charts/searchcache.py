@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+'''Memoization of Melon search API results
+
+Song matching repeats the same artist, album and song searches for every
+try_artist/try_album combination, and again for the same songs in later
+hours. Search results are stored in the shared django cache, keyed by the
+search function and its (case and whitespace insensitive) arguments. Searches
+without results are cached for MELON_SEARCH_NEGATIVE_TTL seconds, which is
+shorter than MELON_SEARCH_TTL so that new releases become searchable quickly.
+Failed API requests are never cached.
+'''
+from __future__ import unicode_literals, absolute_import
+
+from functools import wraps
+from hashlib import sha1
+import inspect
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+
+HITS = metrics.register('melon-search-hits', 'Melon searches answered from the search cache')
+NEGATIVE_HITS = metrics.register('melon-search-negative-hits',
+                                 'Cached Melon searches without results (included in hits)')
+MISSES = metrics.register('melon-search-misses', 'Melon searches sent to the API')
+
+
+def _normalize(value):
+    if isinstance(value, str):
+        return ' '.join(value.lower().split())
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def get_key(name, arguments):
+    '''Return the cache key for a search
+
+    :param str name: The search name
+    :param dict arguments: The search arguments
+    :rtype: str
+    '''
+    normalized = json.dumps(sorted((k, _normalize(v)) for (k, v) in arguments.items()))
+    return 'melon-search-{}-{}'.format(name, sha1(normalized.encode('utf-8')).hexdigest())
+
+
+def memoize_search(name):
+    '''Decorator for search classmethods returning (results, next_page) tuples
+
+    Should be applied below @classmethod. Recursive retries made through the
+    decorated method are memoized as well.
+
+    :param str name: The search name, used in cache keys
+    '''
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def inner(cls, *args, **kwargs):
+            bound = signature.bind(cls, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            arguments.pop(next(iter(signature.parameters)))
+            key = get_key(name, arguments)
+            result = cache.get(key)
+            if result is not None:
+                metrics.incr(HITS)
+                if not result[0]:
+                    metrics.incr(NEGATIVE_HITS)
+                return result
+            metrics.incr(MISSES)
+            result = func(cls, *args, **kwargs)
+            if result[0]:
+                timeout = settings.MELON_SEARCH_TTL
+            else:
+                timeout = settings.MELON_SEARCH_NEGATIVE_TTL
+            cache.set(key, tuple(result), timeout)
+            return result
+        return inner
+    return decorator
+
+
+def get_hit_ratio():
+    '''Return the fraction of searches answered from the cache, or None if there were no searches
+
+    :rtype: float
+    '''
+    counters = metrics.get_counters([HITS, MISSES])
+    total = counters[HITS] + counters[MISSES]
+    if not total:
+        return None
+    return counters[HITS] / total
@@ -62,7 +62,7 @@ class SongDetailSerializer(serializers.ModelSerializer):
 
     def get_chart_details(self, song):
         include_service_slugs = self.context.get('include_service_slugs', [])
-        return song.get_chart_details(include_service_slugs)
+        return song.get_chart_details(include_service_slugs, services=self.context.get('include_services'))
 
 
 class MusicServiceSerializer(serializers.ModelSerializer):
@@ -131,3 +131,83 @@ class AggregateHourlySongChartSerializer(serializers.ModelSerializer):
         entries = AggregateHourlySongChartEntry.objects.filter(hourly_chart=hourly_chart)[:100]
         serializer = AggregateChartEntrySerializer(instance=entries, many=True)
         return serializer.data
+
+
+class CachedArtistSerializer(serializers.Serializer):
+    '''Serializer for kchart.charts.chartcache.CachedArtist'''
+
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    debut_date = serializers.DateField()
+
+
+class CachedAlbumTitleSerializer(serializers.Serializer):
+    '''Serializer for kchart.charts.chartcache.CachedAlbum'''
+
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+
+
+class CachedSongSerializer(serializers.Serializer):
+    '''Serializer for kchart.charts.chartcache.CachedSong'''
+
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    artists = CachedArtistSerializer(many=True)
+    album = CachedAlbumTitleSerializer()
+    release_date = serializers.DateField()
+
+
+class CachedAggregateChartSerializer(serializers.Serializer):
+    '''Serializer for kchart.charts.chartcache.CachedHourlyChart component charts'''
+
+    name = serializers.CharField()
+    url = serializers.CharField()
+    weight = serializers.FloatField()
+
+
+class CachedAggregateChartEntrySerializer(serializers.Serializer):
+    '''Serializer for kchart.charts.chartcache.CachedEntry'''
+
+    song = CachedSongSerializer()
+    score = serializers.FloatField()
+    position = serializers.IntegerField()
+    prev_position = serializers.IntegerField()
+
+
+class CachedAggregateHourlySongChartSerializer(serializers.Serializer):
+    '''Serializer for kchart.charts.chartcache.CachedAggregateChart
+
+    The output matches AggregateHourlySongChartSerializer
+    '''
+
+    name = serializers.CharField()
+    component_charts = CachedAggregateChartSerializer(source='charts', many=True)
+    hour = serializers.DateTimeField()
+    entries = CachedAggregateChartEntrySerializer(many=True)
+
+
+class CachedChartSerializer(serializers.Serializer):
+    '''Serializer for kchart.charts.chartcache.CachedHourlyChart chart details'''
+
+    name = serializers.CharField()
+    url = serializers.CharField()
+
+
+class CachedHourlySongChartEntrySerializer(serializers.Serializer):
+    '''Serializer for kchart.charts.chartcache.CachedEntry'''
+
+    song = CachedSongSerializer()
+    position = serializers.IntegerField()
+    prev_position = serializers.IntegerField()
+
+
+class CachedHourlySongChartSerializer(serializers.Serializer):
+    '''Serializer for kchart.charts.chartcache.CachedHourlyChart
+
+    The output matches HourlySongChartSerializer
+    '''
+
+    chart = CachedChartSerializer(source='*')
+    hour = serializers.DateTimeField()
+    entries = CachedHourlySongChartEntrySerializer(many=True)
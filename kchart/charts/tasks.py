@@ -2,21 +2,40 @@
 from __future__ import unicode_literals, absolute_import
 
 from datetime import timedelta
+from uuid import uuid4
 
 from celery import (
     chain,
     shared_task,
 )
+from django.conf import settings
+from django.core.cache import cache
 from requests.exceptions import RequestException
 
+from . import metrics
+from .asyncfetch import AsyncChartFetcher
 from .chartservice import (
     BugsChartService,
     GenieChartService,
     MelonChartService,
     MnetChartService,
 )
-from .models import AggregateHourlySongChart, HourlySongChart, HourlySongChartBacklog
-from .utils import utcnow, strip_to_hour
+from .models import (
+    AggregateHourlySongChart,
+    AggregateHourlySongChartEntry,
+    HourlySongChart,
+    HourlySongChartBacklog,
+    SongChartSummary,
+)
+from .utils import utcnow, strip_to_hour, KR_TZ
+
+
+# Seconds to keep full re-aggregation progress
+REAGGREGATION_TIMEOUT = 7 * 24 * 60 * 60
+
+AGGREGATIONS_SCHEDULED = metrics.register('aggregate-scheduled', 'Hourly chart aggregations scheduled')
+AGGREGATIONS_COALESCED = metrics.register('aggregate-coalesced',
+                                          'Chart updates coalesced into an already scheduled aggregation')
 
 
 @shared_task
@@ -24,18 +43,190 @@ def aggregate_hourly_chart(hour=utcnow()):
     return AggregateHourlySongChart.generate(hour=hour, regenerate=True)
 
 
+def _pending_aggregation_key(hour):
+    return 'charts-aggregate-pending-{}'.format(strip_to_hour(hour).astimezone(KR_TZ).strftime('%Y%m%d%H'))
+
+
+@shared_task
+def schedule_aggregation(hour):
+    '''Mark the specified hour as needing aggregation
+
+    The hour is aggregated once, CHART_AGGREGATE_DELAY seconds after it is
+    first marked. Updates for the same hour which arrive before then are
+    coalesced into that aggregation, later updates schedule another one.
+    '''
+    delay = settings.CHART_AGGREGATE_DELAY
+    # the marker outlives the delay, in case the aggregation task is lost
+    if cache.add(_pending_aggregation_key(hour), True, delay + 5 * 60):
+        metrics.incr(AGGREGATIONS_SCHEDULED)
+        aggregate_pending_hourly_chart.apply_async(args=(hour,), countdown=delay)
+    else:
+        metrics.incr(AGGREGATIONS_COALESCED)
+
+
+@shared_task
+def aggregate_pending_hourly_chart(hour):
+    '''Aggregate an hour marked by schedule_aggregation
+
+    Service chart changes are applied incrementally when possible, see
+    AggregateHourlySongChart.update_for_hour
+    '''
+    # clear the marker first so that updates which finish while this hour is
+    # being aggregated schedule a new aggregation
+    cache.delete(_pending_aggregation_key(hour))
+    return AggregateHourlySongChart.update_for_hour(hour, verify=settings.CHART_AGGREGATE_VERIFY)
+
+
+def _reaggregation_key(run_id, name):
+    return 'charts-reaggregate-{}-{}'.format(run_id, name)
+
+
+def get_reaggregation_progress(run_id):
+    '''Return the progress of a full re-aggregation
+
+    :param str run_id: The id returned by aggregate_all_hourly_charts
+    :returns: A dict with the total and completed number of ranges, the number of
+        hours aggregated and the (first hour, last hour) ranges which failed, or None
+        if the run is unknown (or expired)
+    :rtype: dict
+    '''
+    ranges = cache.get(_reaggregation_key(run_id, 'ranges'))
+    if ranges is None:
+        return None
+    names = ['ranges-done', 'finished']
+    for index in range(len(ranges)):
+        names.extend(['range-{}-hours'.format(index), 'range-{}-failed'.format(index)])
+    values = cache.get_many([_reaggregation_key(run_id, name) for name in names])
+    return {
+        'ranges': len(ranges),
+        'ranges_done': values.get(_reaggregation_key(run_id, 'ranges-done'), 0),
+        'hours_done': sum(
+            values.get(_reaggregation_key(run_id, 'range-{}-hours'.format(index)), 0) for index in range(len(ranges))
+        ),
+        'failed': [
+            values[_reaggregation_key(run_id, 'range-{}-failed'.format(index))] for index in range(len(ranges))
+            if _reaggregation_key(run_id, 'range-{}-failed'.format(index)) in values
+        ],
+        'finished': values.get(_reaggregation_key(run_id, 'finished'), False),
+    }
+
+
+def _incr(key, delta=1):
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        if cache.add(key, delta, REAGGREGATION_TIMEOUT):
+            return delta
+        return cache.incr(key, delta)
+
+
+def _range_done(run_id, index):
+    '''Count a finished (or failed) range, the range which completes last finishes the run'''
+    # a retried range must only be counted once
+    if cache.add(_reaggregation_key(run_id, 'range-{}'.format(index)), True, REAGGREGATION_TIMEOUT):
+        ranges = cache.get(_reaggregation_key(run_id, 'ranges'))
+        if ranges is not None and _incr(_reaggregation_key(run_id, 'ranges-done')) == len(ranges):
+            finish_reaggregation(run_id)
+
+
+@shared_task(default_retry_delay=60, max_retries=3)
+def aggregate_hourly_chart_range(start, end, run_id=None, index=None):
+    '''Re-aggregate every hour from start to end (inclusive) in order
+
+    prev_position for each hour is taken from the previous hour, which has
+    already been re-aggregated for every hour except start. When this is part
+    of a full re-aggregation, the number of hours done in each range is
+    recorded, a retried range resumes from the hour which failed, and the
+    range which completes last fixes the range boundaries and rebuilds the
+    aggregate song chart summaries.
+
+    If an hour fails this task will be retried every minute, ranges which
+    still fail are recorded by reaggregation_range_failed.
+    '''
+    count = 0
+    if run_id:
+        hours_key = _reaggregation_key(run_id, 'range-{}-hours'.format(index))
+        count = cache.get(hours_key, 0)
+    h = start + timedelta(hours=count)
+    while h <= end:
+        try:
+            AggregateHourlySongChart.generate(hour=h, regenerate=True, cache_result=False,
+                                              update_next=False, update_summary=False)
+        except Exception as exc:
+            raise aggregate_hourly_chart_range.retry(
+                args=[start, end],
+                kwargs={'run_id': run_id, 'index': index},
+                exc=exc
+            )
+        count += 1
+        if run_id:
+            cache.set(hours_key, count, REAGGREGATION_TIMEOUT)
+        h = h + timedelta(hours=1)
+    if run_id:
+        _range_done(run_id, index)
+    return count
+
+
 @shared_task
-def aggregate_all_hourly_charts():
+def reaggregation_range_failed(task_id, run_id, index):
+    '''Record the hours of a re-aggregation range which could not be aggregated
+
+    This is the error callback of aggregate_hourly_chart_range, the failed
+    range is still counted so that the rest of the run can finish.
+    '''
+    (start, end) = cache.get(_reaggregation_key(run_id, 'ranges'))[index]
+    count = cache.get(_reaggregation_key(run_id, 'range-{}-hours'.format(index)), 0)
+    cache.set(
+        _reaggregation_key(run_id, 'range-{}-failed'.format(index)),
+        (start + timedelta(hours=count), end),
+        REAGGREGATION_TIMEOUT
+    )
+    _range_done(run_id, index)
+
+
+def finish_reaggregation(run_id):
+    '''Fix prev_position across re-aggregation range boundaries and rebuild summaries'''
+    ranges = cache.get(_reaggregation_key(run_id, 'ranges'))
+    boundaries = [start for (start, end) in ranges]
+    AggregateHourlySongChartEntry.recompute_prev_positions(
+        AggregateHourlySongChart.objects.filter(hour__in=boundaries).values_list('pk', flat=True)
+    )
+    for hour in boundaries:
+        AggregateHourlySongChart.invalidate_cached_chart(hour)
+    SongChartSummary.rebuild(None)
+    cache.set(_reaggregation_key(run_id, 'finished'), True, REAGGREGATION_TIMEOUT)
+
+
+@shared_task
+def aggregate_all_hourly_charts(range_size=24 * 7):
     '''Re-aggregate everything
 
+    The chart history is split into contiguous ranges of range_size hours,
+    which are re-aggregated in parallel by aggregate_hourly_chart_range tasks.
+    Progress can be checked with get_reaggregation_progress.
+
     This task should only be run when the aggregation algorithm changes
+
+    :returns: The re-aggregation run id
+    :rtype: str
     '''
-    start = HourlySongChart.objects.latest('hour').hour
-    end = HourlySongChart.objects.earliest('hour').hour
-    h = start
-    while h >= end:
-        aggregate_hourly_chart.delay(h)
-        h = h - timedelta(hours=1)
+    end = HourlySongChart.objects.latest('hour').hour
+    start = HourlySongChart.objects.earliest('hour').hour
+    ranges = []
+    while start <= end:
+        range_end = min(start + timedelta(hours=range_size - 1), end)
+        ranges.append((start, range_end))
+        start = range_end + timedelta(hours=1)
+    run_id = uuid4().hex
+    cache.set(_reaggregation_key(run_id, 'ranges'), ranges, REAGGREGATION_TIMEOUT)
+    # most recent ranges first
+    for (i, (range_start, range_end)) in reversed(list(enumerate(ranges))):
+        aggregate_hourly_chart_range.apply_async(
+            args=(range_start, range_end),
+            kwargs={'run_id': run_id, 'index': i},
+            link_error=reaggregation_range_failed.s(run_id, i)
+        )
+    return run_id
 
 
 @shared_task(default_retry_delay=10 * 60, max_retries=5)
@@ -53,40 +244,131 @@ def update_hourly_chart(chart_service, hour=utcnow()):
 
 @shared_task
 def update_dependent_hourly_charts(hour=utcnow()):
-    chain(update_hourly_chart.s(GenieChartService, hour=hour), aggregate_hourly_chart.si(hour))()
-    chain(update_hourly_chart.s(BugsChartService, hour=hour), aggregate_hourly_chart.si(hour))()
-    chain(update_hourly_chart.s(MnetChartService, hour=hour), aggregate_hourly_chart.si(hour))()
+    chain(update_hourly_chart.s(GenieChartService, hour=hour), schedule_aggregation.si(hour))()
+    chain(update_hourly_chart.s(BugsChartService, hour=hour), schedule_aggregation.si(hour))()
+    chain(update_hourly_chart.s(MnetChartService, hour=hour), schedule_aggregation.si(hour))()
 
 
 @shared_task
 def update_melon_hourly_chart():
     melon = MelonChartService()
     result = melon.fetch_hourly()
+    schedule_aggregation(result.hour)
     update_dependent_hourly_charts.delay(result.hour)
-    aggregate_hourly_chart.delay(result.hour)
     return result
 
 
+@shared_task
+def update_hourly_charts_async(hours, chart_services=(BugsChartService, GenieChartService, MnetChartService)):
+    '''Fetch the specified hourly charts for every hour concurrently in this worker
+
+    Charts which could not be fetched are logged and skipped, every hour with
+    a newly fetched chart is scheduled for aggregation afterwards.
+    '''
+    jobs = [(chart_service(), hour) for hour in hours for chart_service in chart_services]
+    results = AsyncChartFetcher().fetch(jobs)
+    fetched = set(result.hour for result in results if result.error is None)
+    for hour in sorted(fetched):
+        schedule_aggregation(hour)
+    return results
+
+
+def _backlog_planned_key(chart_id, hour):
+    return 'charts-backlog-planned-{}-{}'.format(chart_id, strip_to_hour(hour).astimezone(KR_TZ).strftime('%Y%m%d%H'))
+
+
+def plan_backlog(chart_services, limit):
+    '''Find the next missing hours to backlog for each chart service
+
+    Missing hours are found from each service's stored backlog position (see
+    HourlySongChartBacklog.find_missing_hours), checking twice as many hours
+    as are planned so that hours which are already planned can be skipped.
+    The most recent missing hours are planned first.
+
+    :param list chart_services: The chart service classes to backlog
+    :param int limit: The maximum number of hours to plan per service
+    :returns: A list of (chart_service, chart_id, hour) tuples, alternating between services
+    :rtype: list
+    '''
+    end = strip_to_hour(utcnow()) - timedelta(hours=1)
+    services = dict((chart_service().hourly_chart.pk, chart_service) for chart_service in chart_services)
+    hours = {}
+    for chart_id in services:
+        (backlog, created) = HourlySongChartBacklog.objects.get_or_create(chart_id=chart_id)
+        hours[chart_id] = backlog.find_missing_hours(2 * limit, end)
+    planned = cache.get_many([
+        _backlog_planned_key(chart_id, hour) for (chart_id, chart_hours) in hours.items() for hour in chart_hours
+    ])
+    for (chart_id, chart_hours) in hours.items():
+        chart_hours = [hour for hour in chart_hours if _backlog_planned_key(chart_id, hour) not in planned]
+        hours[chart_id] = chart_hours[:limit]
+    plan = []
+    for i in range(limit):
+        for chart_id in sorted(hours):
+            if i < len(hours[chart_id]):
+                plan.append((services[chart_id], chart_id, hours[chart_id][i]))
+    return plan
+
+
+def split_backlog_waves(plan, size):
+    '''Split a backlog plan into waves of concurrent updates
+
+    Items keep their planned order as far as possible, but each wave contains
+    at most one update per hour, so that services updating the same hour (and
+    its aggregate chart) never run at the same time.
+
+    :param list plan: A list of (chart_service, chart_id, hour) tuples, see plan_backlog
+    :param int size: The maximum number of updates per wave
+    :rtype: list
+    '''
+    waves = []
+    for item in plan:
+        hour = item[2]
+        for wave in waves:
+            if len(wave) < size and all(planned_hour != hour for (_, _, planned_hour) in wave):
+                wave.append(item)
+                break
+        else:
+            waves.append([item])
+    return waves
+
+
 @shared_task
 def backlog_hourly_charts():
-    '''Fill hourly chart backlog'''
-    for chart_service in [
+    '''Fill hourly chart backlog
+
+    Up to CHART_BACKLOG_HOURS missing hours per service are scheduled on each
+    run, in waves of up to CHART_BACKLOG_CONCURRENCY updates (for different
+    hours) every CHART_BACKLOG_INTERVAL seconds. Each update schedules its
+    hour's aggregation. A scheduled hour is not planned again until
+    CHART_BACKLOG_RETRY_DELAY seconds after its update was due.
+    '''
+    plan = plan_backlog([
         BugsChartService,
         GenieChartService,
         MnetChartService,
-    ]:
-        svc = chart_service()
-        (backlog, created) = HourlySongChartBacklog.objects.get_or_create(chart=svc.hourly_chart)
-        hour = backlog.find_next_hour_to_backlog()
-        # if the chart update fails don't retry, let the celerybeat
-        # scheduler determine when to re-run this task
-        update_hourly_chart.apply_async(
-            args=(chart_service,),
-            kwargs={'hour': hour},
-            max_retries=0,
-            expires=30,
-            link=aggregate_hourly_chart.si(hour)
+    ], settings.CHART_BACKLOG_HOURS)
+    waves = split_backlog_waves(plan, settings.CHART_BACKLOG_CONCURRENCY)
+    for (i, wave) in enumerate(waves):
+        countdown = i * settings.CHART_BACKLOG_INTERVAL
+        cache.set_many(
+            dict((_backlog_planned_key(chart_id, hour), True) for (chart_service, chart_id, hour) in wave),
+            countdown + settings.CHART_BACKLOG_RETRY_DELAY
         )
+        for (chart_service, chart_id, hour) in wave:
+            # if the chart update fails don't retry, the hour will be planned
+            # again by a later run
+            chain(
+                update_hourly_chart.signature(
+                    (chart_service,),
+                    {'hour': hour},
+                    max_retries=0,
+                    countdown=countdown,
+                    expires=countdown + 30,
+                ),
+                schedule_aggregation.si(hour)
+            )()
+    return len(plan)
 
 
 @shared_task
@@ -101,7 +383,7 @@ def refetch_incomplete():
         for chart in svc.get_incomplete():
             (
                 update_hourly_chart.s(chart_service, chart.hour) |
-                aggregate_hourly_chart.si(chart.hour)
+                schedule_aggregation.si(chart.hour)
             ).apply_async(countdown=countdown)
             countdown += 30
 
@@ -41,7 +41,7 @@ def subtract(value, arg):
 @register.filter
 def chart_list(aggregate_chart):
     '''Return a flattened list consisting of this chart plus it's sub charts'''
-    return [aggregate_chart] + list(aggregate_chart.charts.all())
+    return [aggregate_chart] + list(aggregate_chart.charts)
 
 
 def _th_tooltip(text, tooltip):
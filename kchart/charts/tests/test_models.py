@@ -1,9 +1,28 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, absolute_import
 
+from datetime import date, datetime, timedelta
+
 from test_plus.test import TestCase
 
-from kchart.charts.models import MusicService
+from kchart.charts.catalog import find_song
+from kchart.charts.models import (
+    Album,
+    Artist,
+    AggregateHourlySongChart,
+    Chart,
+    ChartStats,
+    HourlySongChart,
+    HourlySongChartBacklog,
+    HourlySongChartEntry,
+    HourlySongChartSnapshot,
+    MusicService,
+    MusicServiceArtist,
+    MusicServiceSong,
+    Song,
+    SongChartSummary,
+)
+from kchart.charts.utils import KR_TZ
 
 
 class TestMusicService(TestCase):
@@ -37,3 +56,269 @@ class TestMusicService(TestCase):
             service.get_song_url(1),
             '/songs/1/'
         )
+
+
+class TestAggregateHourlySongChart(TestCase):
+
+    def setUp(self):
+        self.hour = KR_TZ.localize(datetime(2016, 6, 26, 13))
+        album = Album.objects.create(name='album', release_date=date(2016, 6, 1))
+        self.songs = [
+            Song.objects.create(name='song {}'.format(i), album=album, release_date=date(2016, 6, 1))
+            for i in range(3)
+        ]
+        self.charts = []
+        for (name, weight) in [('a', 0.75), ('b', 0.25)]:
+            service = MusicService.objects.create(name=name, slug=name)
+            self.charts.append(Chart.objects.create(service=service, name=name, weight=weight))
+
+    def _add_hourly_chart(self, chart, hour, songs):
+        hourly_chart = HourlySongChart.objects.create(chart=chart, hour=hour)
+        for (i, song) in enumerate(songs):
+            HourlySongChartEntry.objects.create(hourly_chart=hourly_chart, song=song, position=i + 1)
+        return hourly_chart
+
+    def test_generate(self):
+        prev_hour = self.hour - timedelta(hours=1)
+        self._add_hourly_chart(self.charts[0], prev_hour, [self.songs[1], self.songs[0]])
+        AggregateHourlySongChart.generate(hour=prev_hour, cache_result=False)
+        self._add_hourly_chart(self.charts[0], self.hour, [self.songs[0], self.songs[1]])
+        self._add_hourly_chart(self.charts[1], self.hour, [self.songs[2], self.songs[0]])
+        chart = AggregateHourlySongChart.generate(hour=self.hour, cache_result=False)
+        entries = list(chart.entries.values_list('song', 'position', 'prev_position'))
+        self.assertEqual(entries, [
+            (self.songs[0].pk, 1, 2),
+            (self.songs[1].pk, 2, 1),
+            (self.songs[2].pk, 3, None),
+        ])
+        self.assertAlmostEqual(chart.entries.get(song=self.songs[0]).score, (100 * 0.75 + 99 * 0.25) / 100.0)
+        # regenerating should replace rather than duplicate entries
+        chart = AggregateHourlySongChart.generate(hour=self.hour, regenerate=True, cache_result=False)
+        self.assertEqual(chart.entries.count(), 3)
+
+    def test_apply_delta(self):
+        hourly_chart = self._add_hourly_chart(self.charts[0], self.hour, [self.songs[0], self.songs[1]])
+        self._add_hourly_chart(self.charts[1], self.hour, [self.songs[2], self.songs[0]])
+        AggregateHourlySongChart.generate(hour=self.hour, cache_result=False)
+        old_positions = dict(hourly_chart.entries.values_list('song_id', 'position'))
+        hourly_chart.write_entries([(self.songs[2].pk, 1), (self.songs[1].pk, 2)])
+        chart = AggregateHourlySongChart.apply_delta(hourly_chart, old_positions, verify=True)
+        self.assertIsNotNone(chart)
+        self.assertEqual(
+            list(chart.entries.values_list('song', 'position')),
+            [(self.songs[2].pk, 1), (self.songs[1].pk, 2), (self.songs[0].pk, 3)]
+        )
+        self.assertAlmostEqual(chart.entries.get(song=self.songs[0]).score, 99 * 0.25 / 100.0)
+
+    def test_apply_delta_verify_failed(self):
+        hourly_chart = self._add_hourly_chart(self.charts[0], self.hour, [self.songs[0], self.songs[1]])
+        self._add_hourly_chart(self.charts[1], self.hour, [self.songs[2], self.songs[0]])
+        chart = AggregateHourlySongChart.generate(hour=self.hour, cache_result=False)
+        entries = list(chart.entries.values_list('song', 'score', 'position'))
+        hourly_chart.write_entries([(self.songs[2].pk, 1), (self.songs[1].pk, 2)])
+        # the wrong previous positions leave songs[0] with its old contribution
+        self.assertIsNone(AggregateHourlySongChart.apply_delta(hourly_chart, {}, verify=True))
+        self.assertEqual(list(chart.entries.values_list('song', 'score', 'position')), entries)
+
+    def test_update_for_hour(self):
+        hourly_chart = self._add_hourly_chart(self.charts[0], self.hour, [self.songs[0], self.songs[1]])
+        self._add_hourly_chart(self.charts[1], self.hour, [self.songs[2], self.songs[0]])
+        AggregateHourlySongChart.generate(hour=self.hour, cache_result=False)
+        # changes made by consecutive writes are applied together
+        hourly_chart.write_entries([(self.songs[1].pk, 1)])
+        hourly_chart.write_entries([(self.songs[2].pk, 1), (self.songs[1].pk, 2)])
+        self.assertEqual(
+            HourlySongChart.objects.get(pk=hourly_chart.pk).get_aggregated_positions(),
+            {self.songs[0].pk: 1, self.songs[1].pk: 2}
+        )
+        chart = AggregateHourlySongChart.update_for_hour(self.hour, verify=True)
+        self.assertEqual(
+            list(chart.entries.values_list('song', 'position')),
+            [(self.songs[2].pk, 1), (self.songs[1].pk, 2), (self.songs[0].pk, 3)]
+        )
+        self.assertIsNone(HourlySongChart.objects.get(pk=hourly_chart.pk).aggregated_positions)
+
+    def test_find_gaps(self):
+        hours = [self.hour - timedelta(hours=i) for i in range(6)]
+        for hour in [hours[0], hours[1], hours[3]]:
+            HourlySongChart.objects.create(chart=self.charts[0], hour=hour)
+        HourlySongChart.objects.create(chart=self.charts[1], hour=hours[0])
+        self.assertEqual(HourlySongChart.find_gaps([self.charts[0].pk], hours[5], hours[0]), [
+            (self.charts[0].pk, hours[2], hours[2]),
+            (self.charts[0].pk, hours[5], hours[4]),
+        ])
+        self.assertEqual(HourlySongChart.find_gaps([c.pk for c in self.charts], hours[2], hours[0]), [
+            (self.charts[1].pk, hours[2], hours[1]),
+            (self.charts[0].pk, hours[2], hours[2]),
+        ])
+
+    def test_find_missing_hours(self):
+        hours = [self.hour - timedelta(hours=i) for i in range(8)]
+        for hour in [hours[0], hours[1], hours[3], hours[6]]:
+            HourlySongChart.objects.create(chart=self.charts[0], hour=hour)
+        backlog = HourlySongChartBacklog.objects.create(chart=self.charts[0])
+        self.assertEqual(backlog.find_missing_hours(4, hours[0]), [hours[2]])
+        self.assertEqual(HourlySongChartBacklog.objects.get(pk=backlog.pk).next_backlog_timestamp, hours[2])
+        # hours after the stored position are never checked again
+        HourlySongChart.objects.filter(hour=hours[1]).delete()
+        self.assertEqual(backlog.find_missing_hours(4, hours[0]), [hours[2], hours[4], hours[5]])
+        HourlySongChart.objects.create(chart=self.charts[0], hour=hours[2])
+        self.assertEqual(backlog.find_missing_hours(2, hours[0]), [])
+        self.assertEqual(backlog.next_backlog_timestamp, hours[4])
+        self.assertEqual(backlog.find_missing_hours(4, hours[0]), [hours[4], hours[5], hours[7]])
+
+    def test_recompute_prev_positions(self):
+        prev_hour = self.hour - timedelta(hours=1)
+        self._add_hourly_chart(self.charts[0], prev_hour, [self.songs[1], self.songs[0]])
+        self._add_hourly_chart(self.charts[1], prev_hour, [self.songs[2]])
+        hourly_chart = self._add_hourly_chart(self.charts[0], self.hour, [self.songs[0], self.songs[2]])
+        updated = HourlySongChartEntry.recompute_prev_positions([hourly_chart.pk])
+        self.assertEqual(updated, 1)
+        self.assertEqual(
+            list(hourly_chart.entries.values_list('song', 'prev_position')),
+            [(self.songs[0].pk, 2), (self.songs[2].pk, None)]
+        )
+
+    def test_write_entries(self):
+        prev_chart = HourlySongChart.objects.create(chart=self.charts[0], hour=self.hour - timedelta(hours=1))
+        hourly_chart = self._add_hourly_chart(self.charts[0], self.hour, [self.songs[0], self.songs[1]])
+        prev_chart.write_entries([(self.songs[0].pk, 3), (self.songs[1].pk, 1), (self.songs[0].pk, 2)])
+        self.assertEqual(
+            list(prev_chart.entries.values_list('song', 'position')),
+            [(self.songs[1].pk, 1), (self.songs[0].pk, 2)]
+        )
+        self.assertEqual(HourlySongChart.objects.get(pk=prev_chart.pk).entry_count, 2)
+        self.assertFalse(prev_chart.is_complete)
+        # the next hour's prev positions are updated as well
+        self.assertEqual(
+            list(hourly_chart.entries.values_list('song', 'prev_position')),
+            [(self.songs[0].pk, 2), (self.songs[1].pk, 1)]
+        )
+
+    def test_chart_stats(self):
+        artist = Artist.objects.create(name='artist')
+        self.songs[2].artists.add(artist)
+        self._add_hourly_chart(self.charts[0], self.hour, [self.songs[0]])
+        # reading statistics never builds them
+        ChartStats.objects.all().delete()
+        self.assertEqual(ChartStats.get().song_count, 0)
+        self.assertFalse(ChartStats.objects.exists())
+        stats = ChartStats.rebuild()
+        self.assertEqual((stats.song_count, stats.album_count, stats.artist_count), (1, 1, 0))
+        self.assertEqual(stats.get_first_hours(), {'a': self.hour})
+        prev_hour = self.hour - timedelta(hours=1)
+        hourly_chart = HourlySongChart.objects.create(chart=self.charts[1], hour=prev_hour)
+        hourly_chart.write_entries([(self.songs[0].pk, 1), (self.songs[2].pk, 2)])
+        ChartStats.update_for_chart(hourly_chart)
+        stats = ChartStats.get()
+        self.assertEqual((stats.song_count, stats.album_count, stats.artist_count), (2, 1, 1))
+        self.assertEqual(stats.get_first_hours(), {'a': self.hour, 'b': prev_hour})
+        self.assertEqual(Song.objects.get(pk=self.songs[0].pk).first_charted, prev_hour)
+        # incremental updates should match a full rebuild
+        rebuilt = ChartStats.rebuild()
+        self.assertEqual(
+            (rebuilt.song_count, rebuilt.album_count, rebuilt.artist_count, rebuilt.get_first_hours()),
+            (stats.song_count, stats.album_count, stats.artist_count, stats.get_first_hours())
+        )
+
+    def test_cached_chart(self):
+        self._add_hourly_chart(self.charts[0], self.hour, [self.songs[0], self.songs[1]])
+        self._add_hourly_chart(self.charts[1], self.hour, [self.songs[2], self.songs[0]])
+        AggregateHourlySongChart.generate(hour=self.hour)
+        chart = AggregateHourlySongChart.get_cached_chart(self.hour)
+        self.assertEqual(chart.hour, self.hour)
+        self.assertEqual([entry.song.id for entry in chart.entries], [s.pk for s in self.songs])
+        self.assertEqual([c.slug for c in chart.charts], ['a', 'b'])
+        self.assertEqual(chart.charts[1].entries[0].song.name, 'song 2')
+        self.assertEqual(chart.charts[1].entries[0].song.album.name, 'album')
+
+    def test_song_chart_summary(self):
+        service = self.charts[0].service
+        hours = [self.hour - timedelta(hours=2), self.hour - timedelta(hours=1), self.hour]
+        hourly_charts = [
+            self._add_hourly_chart(self.charts[0], hours[0], [self.songs[1], self.songs[0]]),
+            self._add_hourly_chart(self.charts[0], hours[1], [self.songs[0], self.songs[1]]),
+            self._add_hourly_chart(self.charts[0], hours[2], [self.songs[1], self.songs[0]]),
+        ]
+        for hourly_chart in hourly_charts:
+            SongChartSummary.update_for_chart(hourly_chart)
+        summary = SongChartSummary.objects.get(song=self.songs[0], service=service)
+        self.assertEqual((summary.initial_position, summary.initial_timestamp), (2, hours[0]))
+        self.assertEqual((summary.peak_position, summary.peak_timestamp), (1, hours[1]))
+        self.assertEqual((summary.final_position, summary.final_timestamp), (2, hours[2]))
+        # re-writing the peak hour should rebuild the summary
+        hourly_charts[1].entries.all().delete()
+        SongChartSummary.update_for_chart(hourly_charts[1])
+        summary = SongChartSummary.objects.get(song=self.songs[0], service=service)
+        self.assertEqual((summary.peak_position, summary.peak_timestamp), (2, hours[0]))
+        self.assertEqual(self.songs[2].get_chart_details(['a']), {
+            'realtime': {'kchart': {'has_charted': False}, 'a': {'has_charted': False}},
+        })
+
+    def test_aggregate_song_chart_summary(self):
+        hours = [self.hour - timedelta(hours=1), self.hour]
+        for hour in hours:
+            self._add_hourly_chart(self.charts[0], hour, [self.songs[0]])
+            AggregateHourlySongChart.generate(hour=hour, cache_result=False)
+        # rebuilding merges into summaries written in the meantime rather than duplicating them
+        SongChartSummary.rebuild(None)
+        SongChartSummary.update_for_chart(AggregateHourlySongChart.objects.get(hour=hours[0]))
+        summary = SongChartSummary.objects.get(song=self.songs[0], service=None)
+        self.assertEqual((summary.initial_timestamp, summary.final_timestamp), (hours[0], hours[1]))
+
+    def test_position_history(self):
+        service = self.charts[0].service
+        hours = [self.hour - timedelta(hours=1), self.hour]
+        self._add_hourly_chart(self.charts[0], hours[0], [self.songs[1], self.songs[0]])
+        self._add_hourly_chart(self.charts[0], hours[1], [self.songs[0], self.songs[1]])
+        history = self.songs[0].get_position_history(hours[0], hours[1], services=[service])
+        self.assertEqual(history['kchart'], [])
+        self.assertEqual(history['a'], [(hours[0], 2), (hours[1], 1)])
+        history = self.songs[0].get_position_history(hours[0], hours[1], resolution='day_best', services=[service])
+        self.assertEqual(history['a'], [(date(2016, 6, 26), 1)])
+        history = self.songs[0].get_position_history(hours[0], hours[1], resolution='day_avg', services=[service])
+        self.assertEqual(history['a'], [(date(2016, 6, 26), 1.5)])
+
+
+class TestHourlySongChartSnapshot(TestCase):
+
+    def setUp(self):
+        self.hour = KR_TZ.localize(datetime(2016, 6, 26, 13))
+        service = MusicService.objects.create(name='a', slug='a')
+        self.chart = Chart.objects.create(service=service, name='a', weight=1.0)
+
+    def test_archive(self):
+        HourlySongChartSnapshot.archive(self.chart, self.hour, ['old'])
+        latest = HourlySongChartSnapshot.archive(self.chart, self.hour, ['<html>첫 페이지</html>', '{}'])
+        prev = HourlySongChartSnapshot.archive(self.chart, self.hour - timedelta(hours=1), ['prev'])
+        self.assertEqual(HourlySongChartSnapshot.get_latest_ids(self.chart), [prev.pk, latest.pk])
+        self.assertEqual(HourlySongChartSnapshot.get_latest_ids(self.chart, start=self.hour), [latest.pk])
+        snapshot = HourlySongChartSnapshot.objects.get(pk=latest.pk)
+        self.assertEqual(snapshot.texts, ['<html>첫 페이지</html>', '{}'])
+        with self.assertRaises(ValueError):
+            snapshot.save()
+
+
+class TestCatalog(TestCase):
+
+    def setUp(self):
+        self.melon = MusicService.objects.create(name='Melon', slug='melon')
+        self.genie = MusicService.objects.create(name='Genie', slug='genie')
+        self.artist = Artist.objects.create(name='방탄소년단')
+        MusicServiceArtist.objects.create(artist=self.artist, service=self.melon, service_artist_id=10)
+        album = Album.objects.create(name='화양연화 pt.2', release_date=date(2015, 11, 30))
+        self.song = Song.objects.create(name='RUN', album=album, release_date=date(2015, 11, 30))
+        self.song.artists.add(self.artist)
+        MusicServiceSong.objects.create(song=self.song, service=self.melon, service_song_id=100)
+
+    def test_normalized_name(self):
+        self.assertEqual(Song.objects.get(pk=self.song.pk).normalized_name, 'run')
+
+    def test_find_song(self):
+        artists = [{'artist_name': '방탄소년단 (BTS)', 'artist_id': 20}]
+        song = find_song(self.melon, self.genie, {'song_name': 'Run', 'song_id': 200},
+                         {'album_name': '화양연화 Pt. 2', 'album_id': 300}, artists)
+        self.assertEqual(song, self.song)
+        self.assertEqual(artists[0]['melon_id'], 10)
+        self.assertIsNone(find_song(self.melon, self.genie, {'song_name': 'Run', 'song_id': 200},
+                                    {'album_name': 'other', 'album_id': 300}, artists))
@@ -2,6 +2,7 @@
 from __future__ import unicode_literals, absolute_import
 
 from datetime import datetime
+import re
 
 from pytz import timezone, utc
 
@@ -21,3 +22,20 @@ def strip_to_hour(time):
 def melon_hour(day, hour):
     '''Return a datetime object from the melon formatted day and hour parameters'''
     return KR_TZ.localize(datetime.strptime('{} {}'.format(day, hour), '%Y%m%d %H'))
+
+
+def melonify_name(name):
+    '''Convert a song, album or artist name to melon's conventions'''
+    # Melon use U+FFE6 FULLWIDTH WON SIGN
+    # Other services use U+20A9 WON SIGN
+    name = re.sub('[₩]', '￦', name)
+    name = re.sub('[\'"`‘]', '', name)
+    return name
+
+
+def normalize_name(name):
+    '''Return the key used to compare names between services
+
+    melonify_name is applied, and case, whitespace and punctuation are ignored
+    '''
+    return re.sub(r'[\W_]+', '', melonify_name(name).lower())
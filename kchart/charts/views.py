@@ -4,7 +4,8 @@ from __future__ import absolute_import, unicode_literals
 from datetime import datetime
 
 from django.contrib import messages
-from django.db.models import Count
+from django.http import Http404
+from django.utils.decorators import method_decorator
 from django.views.generic import (
     DetailView,
     TemplateView,
@@ -12,27 +13,60 @@ from django.views.generic import (
 
 from .models import (
     AggregateHourlySongChart,
-    HourlySongChart,
-    HourlySongChartEntry,
+    ChartStats,
     Song,
 )
+from .httpcache import conditional, get_validators
 from .utils import KR_TZ
 
 
+def get_requested_hour(request):
+    '''Return the chart hour requested with the date and hour parameters
+
+    :returns: The requested hour, or None if no date was specified
+    :raises ValueError: if the parameters are invalid
+    '''
+    chart_date = request.GET.get('date', None)
+    if chart_date:
+        hour = request.GET.get('hour', '00')
+        return KR_TZ.localize(datetime.strptime('{}{}'.format(chart_date, hour), '%Y%m%d%H'))
+    return None
+
+
+def hourly_chart_validators(request, *args, **kwargs):
+    try:
+        hour = get_requested_hour(request)
+    except ValueError:
+        return None
+    latest = hour is None
+    if latest:
+        hour = AggregateHourlySongChart.get_latest_hour()
+        if not hour:
+            return None
+    # pages include per-user messages and account links, so they must not be stored by shared caches
+    return get_validators(AggregateHourlySongChart.get_cache_key(hour), hour, 'html', latest=latest, private=True)
+
+
 class HourlySongChartView(DetailView):
 
     template_name = 'charts/hourlysongchart_detail.html'
 
+    @method_decorator(conditional(hourly_chart_validators))
+    def get(self, request, *args, **kwargs):
+        return super(HourlySongChartView, self).get(request, *args, **kwargs)
+
     def _get_hour(self, msg=False):
-        chart_date = self.request.GET.get('date', None)
-        if chart_date:
-            try:
-                hour = self.request.GET.get('hour', '00')
-                return KR_TZ.localize(datetime.strptime('{}{}'.format(chart_date, hour), '%Y%m%d%H'))
-            except ValueError:
-                if msg:
-                    messages.error(self.request, 'Invalid date/hour parameters.')
-        return AggregateHourlySongChart.objects.latest('hour').hour.astimezone(KR_TZ)
+        try:
+            hour = get_requested_hour(self.request)
+            if hour:
+                return hour
+        except ValueError:
+            if msg:
+                messages.error(self.request, 'Invalid date/hour parameters.')
+        hour = AggregateHourlySongChart.get_latest_hour()
+        if not hour:
+            raise Http404('No chart data available')
+        return hour.astimezone(KR_TZ)
 
     def get_context_data(self, **kwargs):
         context = super(HourlySongChartView, self).get_context_data(**kwargs)
@@ -50,13 +84,11 @@ class StatsView(TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super(StatsView, self).get_context_data(**kwargs)
+        stats = ChartStats.get()
+        first_hours = stats.get_first_hours()
         for slug in ['melon', 'genie', 'bugs', 'mnet']:
-            context['{}_earliest'.format(slug)] = HourlySongChart.objects.filter(
-                chart__service__slug=slug).earliest('hour').hour
-        context['song_count'] = HourlySongChartEntry.objects.aggregate(
-            song_count=Count('song', distinct=True))['song_count']
-        context['artist_count'] = HourlySongChartEntry.objects.aggregate(
-            artist_count=Count('song__artists', distinct=True))['artist_count']
-        context['album_count'] = HourlySongChartEntry.objects.aggregate(
-            album_count=Count('song__album', distinct=True))['album_count']
+            context['{}_earliest'.format(slug)] = first_hours.get(slug)
+        context['song_count'] = stats.song_count
+        context['artist_count'] = stats.artist_count
+        context['album_count'] = stats.album_count
         return context